@@ -2,13 +2,19 @@
 import base64
 import secrets
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, flash, session, render_template, request, redirect, url_for, send_from_directory, jsonify, \
-    make_response, Blueprint, json
+    make_response, Blueprint, json, g, has_request_context, Response, stream_with_context
 import secrets, datetime
 import os
 import io
+import csv
+import zipfile
+import tempfile
 from io import BytesIO
 from datetime import datetime, timedelta, date
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 import re
 import shutil
@@ -19,8 +25,11 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import Paragraph, Table, TableStyle
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_LEFT
+from reportlab import rl_config
 import psycopg2
 from psycopg2 import sql, errors
+from psycopg2.extras import execute_values
+from openpyxl import Workbook
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash  # password hashing
 from dotenv import load_dotenv
@@ -30,6 +39,13 @@ from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
 from psycopg2 import pool
 import threading
+import hashlib
+import multiprocessing
+import fcntl
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+import time
+import itertools
 from contextlib import contextmanager
 import traceback
 # Load environment variables
@@ -49,6 +65,20 @@ app.config['PAYMENTS_FOLDER'] = 'payments'
 
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 
+# Background PDF rendering: worker processes (0 renders inline) and how long downloads wait for a render
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', 2))
+PDF_RENDER_WAIT = float(os.getenv('PDF_RENDER_WAIT', 10))
+PDF_RENDER_STALE = 300
+pdf_executor = None
+pdf_executor_lock = threading.Lock()
+
+# Content-addressed document cache (view_invoice): total size kept on disk before LRU eviction
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv('DOCUMENT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+document_locks = [threading.Lock() for _ in range(64)]
+
+# Set on first use by ensure_pg_trgm()
+pg_trgm_available = None
+
 admin_bp = Blueprint('admin', __name__)
 app.register_blueprint(admin_bp)
 
@@ -58,7 +88,23 @@ GMAIL_PASS = os.getenv("GMAIL_PASS")
 
 # Database connection pool (at the module level, not inside any function)
 connection_pool = None
-pool_lock = threading.Lock()
+
+# Tenant table layout: 'prefix' keeps every org's tables in public as {org_id}_sales etc.,
+# 'schema' gives each org a schema of identically named tables (tenant_{org_id}.sales),
+# 'partitioned' is 'prefix' with each SHARED_TABLES table a list partition of shared_<name>
+TENANCY_MODE = os.getenv('TENANCY_MODE', 'prefix')
+SHARED_TABLES = ['sales', 'sales_list', 'receipts', 'mpesa_requests']
+
+# Server-side prepared statements kept per pooled connection before the least recently used is deallocated
+PREPARED_STATEMENTS_PER_CONNECTION = int(os.getenv('PREPARED_STATEMENTS_PER_CONNECTION', 200))
+prepared_statement_metrics = {'hits': 0, 'misses': 0, 'evictions': 0}
+prepared_statement_metrics_lock = threading.Lock()
+
+# Pool sizing, checkout wait and connection validation (seconds)
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_VALIDATE_IDLE = float(os.getenv('DB_POOL_VALIDATE_IDLE', 30))
+DB_POOL_MAX_AGE = float(os.getenv('DB_POOL_MAX_AGE', 1800))
 
 # MPESA API Configuration
 MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY')
@@ -68,9 +114,35 @@ MPESA_TILL = os.getenv('MPESA_TILL')
 MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
 MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL')
 SALES_MPESA_CALLBACK_URL = os.getenv('SALES_MPESA_CALLBACK_URL')
+MPESA_API_BASE_URL = os.getenv('MPESA_API_BASE_URL', 'https://api.safaricom.co.ke').rstrip('/')
+MPESA_OAUTH_URL = f"{MPESA_API_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
+
+# Shared HTTP client settings for Safaricom API calls
+MPESA_HTTP_POOL_SIZE = int(os.getenv('MPESA_HTTP_POOL_SIZE', 10))
+MPESA_HTTP_TIMEOUT = (float(os.getenv('MPESA_HTTP_CONNECT_TIMEOUT', 5)), float(os.getenv('MPESA_HTTP_READ_TIMEOUT', 30)))
+MPESA_HTTP_RETRIES = int(os.getenv('MPESA_HTTP_RETRIES', 3))
+MPESA_HTTP_BACKOFF = float(os.getenv('MPESA_HTTP_BACKOFF', 0.5))
+
+# M-Pesa OAuth token cache: {(owner, consumer_key): (access_token, refresh_at)}
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', 60))
+mpesa_token_cache = {}
+mpesa_token_locks = {}
+mpesa_token_lock = threading.Lock()
 
 ERROR_LOG_FILE = "error_log.txt"
 
+# Per-org subscription status cache: {org_id: (expires_at, status_dict)}
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 300))
+SUBSCRIPTION_CACHE_INACTIVE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_INACTIVE_TTL', 30))
+subscription_cache = {}
+subscription_cache_lock = threading.Lock()
+
+# Per-org dropdown lookup cache: {(org_id, name): (version, expires_at, values)}
+LOOKUP_CACHE_TTL = int(os.getenv('LOOKUP_CACHE_TTL', 300))
+lookup_cache = {}
+lookup_versions = {}
+lookup_cache_lock = threading.Lock()
+
 
 def log_error_to_file(error_message):
     """Append error details with a timestamp to error_log.txt"""
@@ -78,12 +150,140 @@ def log_error_to_file(error_message):
         f.write(f"[{datetime.utcnow().isoformat()}] {error_message}\n")
 
 
+class TrackedConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that records when it was opened and last returned to the pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # {(org_id, name): server-side statement name}, least recently used first
+        self.prepared_statements = OrderedDict()
+
+
+class DatabasePoolTimeout(Exception):
+    """Raised when no pooled connection became free within DB_POOL_TIMEOUT seconds"""
+
+
+class ConnectionPool:
+    """
+    Bounded connection pool without a global lock around checkout.
+    A semaphore caps open connections and bounds the wait; idle connections sit in a
+    deque (atomic append/pop) and a thread gets back its last connection when it is idle.
+    Connections are opened lazily on first demand.
+    """
+
+    def __init__(self, maxconn, timeout, **connect_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.idle = deque()
+        self.local = threading.local()
+        self.metrics_lock = threading.Lock()
+        self.metrics = {
+            'checkouts': 0,
+            'waiters': 0,
+            'max_waiters': 0,
+            'timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'opened': 0,
+            'closed': 0,
+            'in_use': 0
+        }
+
+    def count(self, **deltas):
+        with self.metrics_lock:
+            for name, delta in deltas.items():
+                self.metrics[name] += delta
+            self.metrics['max_waiters'] = max(self.metrics['max_waiters'], self.metrics['waiters'])
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self.slots.acquire(blocking=False):
+            self.count(waiters=1)
+            try:
+                acquired = self.slots.acquire(timeout=self.timeout)
+            finally:
+                self.count(waiters=-1)
+            if not acquired:
+                self.count(timeouts=1)
+                raise DatabasePoolTimeout(
+                    f"No database connection available within {self.timeout}s "
+                    f"({self.maxconn} connections in use)"
+                )
+
+        waited = time.monotonic() - started
+        self.count(checkouts=1, in_use=1, wait_seconds_total=waited)
+        with self.metrics_lock:
+            self.metrics['wait_seconds_max'] = max(self.metrics['wait_seconds_max'], waited)
+
+        connection = self.take_idle()
+        if connection is not None:
+            return connection
+
+        try:
+            connection = psycopg2.connect(connection_factory=TrackedConnection, **self.connect_kwargs)
+        except Exception:
+            self.count(in_use=-1)
+            self.slots.release()
+            raise
+        self.count(opened=1)
+        return connection
+
+    def take_idle(self):
+        """Prefer the connection this thread used last, else the most recently returned one"""
+        preferred = getattr(self.local, 'connection', None)
+        if preferred is not None:
+            try:
+                self.idle.remove(preferred)
+                return preferred
+            except ValueError:
+                pass
+        try:
+            return self.idle.pop()
+        except IndexError:
+            return None
+
+    def putconn(self, connection, close=False):
+        if not close and not connection.closed:
+            try:
+                if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception:
+                close = True
+
+        if close or connection.closed:
+            try:
+                connection.close()
+            except Exception:
+                pass
+            self.count(closed=1)
+        else:
+            self.local.connection = connection
+            self.idle.append(connection)
+
+        self.count(in_use=-1)
+        self.slots.release()
+
+    def snapshot(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        metrics['idle'] = len(self.idle)
+        metrics['max_connections'] = self.maxconn
+        metrics['wait_seconds_avg'] = (
+            metrics['wait_seconds_total'] / metrics['checkouts'] if metrics['checkouts'] else 0.0
+        )
+        return metrics
+
+
 def initialize_db_pool():
     global connection_pool
     try:
-        connection_pool = psycopg2.pool.ThreadedConnectionPool(
-            minconn=1,
-            maxconn=10,
+        connection_pool = ConnectionPool(
+            maxconn=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
             dbname=os.getenv('DB_NAME'),
             user=os.getenv('DB_USERNAME'),
             password=os.getenv('DB_PASSWORD'),
@@ -99,16 +299,152 @@ def initialize_db_pool():
         raise
 
 
+def get_pool_metrics():
+    """Current pool counters: waiters, checkout latency, timeouts, open/idle connections"""
+    return connection_pool.snapshot()
+
+
+def release_connection(connection, discard=False):
+    """Return a connection to the pool, closing it instead if it is broken or discarded"""
+    discard = discard or connection.closed
+    if not discard:
+        connection.last_used = time.monotonic()
+    connection_pool.putconn(connection, close=discard)
+
+
+def checkout_connection():
+    """
+    Take a usable connection from the pool.
+    Connections past DB_POOL_MAX_AGE are recycled, and only connections idle for more
+    than DB_POOL_VALIDATE_IDLE seconds are probed; broken ones are replaced transparently.
+    """
+    while True:
+        connection = connection_pool.getconn()
+
+        now = time.monotonic()
+        if connection.closed or now - connection.created_at > DB_POOL_MAX_AGE:
+            release_connection(connection, discard=True)
+            continue
+
+        if now - connection.last_used > DB_POOL_VALIDATE_IDLE:
+            try:
+                with connection.cursor() as cur:
+                    cur.execute("SELECT 1")
+                connection.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                log_error_to_file("Discarded broken pooled connection")
+                release_connection(connection, discard=True)
+                continue
+
+        return connection
+
+
+@contextmanager
+def request_db_connection():
+    """
+    Share one pooled connection across every get_db_connection2() block in a request.
+    The outermost block commits or rolls back as before; nested blocks run inside a
+    SAVEPOINT so a failure only undoes their own work. The connection is returned to
+    the pool by release_request_db_connection() when the request ends.
+    """
+    if 'db_connection' not in g:
+        g.db_connection = checkout_connection()
+        g.db_depth = 0
+    connection = g.db_connection
+    depth = g.db_depth
+    savepoint = f"request_sp_{depth}"
+    nested = depth > 0 and connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    if nested:
+        with connection.cursor() as cur:
+            cur.execute(f"SAVEPOINT {savepoint}")
+    g.db_depth = depth + 1
+
+    try:
+        yield connection
+
+        status = connection.info.transaction_status
+        if not nested:
+            connection.commit()
+        # An explicit commit/rollback inside the block already ended the transaction
+        elif status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            # The block caught its own database error; undo it like commit() would
+            with connection.cursor() as cur:
+                cur.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            with connection.cursor() as cur:
+                cur.execute(f"RELEASE SAVEPOINT {savepoint}")
+
+    except psycopg2.OperationalError as e:
+        # Connection dropped; log, stop handing it out and re-raise
+        log_error_to_file("Database OperationalError")
+        g.db_discard = True
+        raise
+    except Exception as e:
+        log_error_to_file("Database Error")
+        try:
+            if not nested:
+                connection.rollback()
+            elif connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                with connection.cursor() as cur:
+                    cur.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        except Exception:
+            g.db_discard = True
+        raise
+    finally:
+        g.db_depth = depth
+        if depth == 0 and g.get('db_discard'):
+            g.pop('db_connection', None)
+            g.pop('db_discard', None)
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+            release_connection(connection, discard=True)
+
+
+@app.teardown_request
+def release_request_db_connection(exc):
+    """Return the request's connection to the pool, committing statements run after a block closed"""
+    connection = g.pop('db_connection', None)
+    if connection is None:
+        return
+
+    discard = False
+    try:
+        if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            if exc is None:
+                connection.commit()
+            else:
+                connection.rollback()
+    except Exception as e:
+        log_error_to_file(f"Error releasing request connection: {str(e)}")
+        discard = True
+    release_connection(connection, discard=discard)
+
+
 @contextmanager
 def get_db_connection2():
+    if has_request_context():
+        with request_db_connection() as connection:
+            yield connection
+        return
+
+    with pooled_db_connection() as connection:
+        yield connection
+
+
+@contextmanager
+def pooled_db_connection():
+    """
+    A connection of its own for the duration of the block, committed at the end.
+    Used outside requests, and by streamed responses whose generators outlive the
+    request's connection.
+    """
     connection = None
+    discard = False
     try:
-        with pool_lock:
-            connection = connection_pool.getconn()
-
-        # Check if the connection is alive
-        with connection.cursor() as cur:
-            cur.execute("SELECT 1")
+        connection = checkout_connection()
 
         yield connection
 
@@ -118,6 +454,7 @@ def get_db_connection2():
     except psycopg2.OperationalError as e:
         # Connection dropped; log and re-raise
         log_error_to_file("Database OperationalError")
+        discard = True
         if connection:
             try:
                 connection.rollback()
@@ -134,8 +471,78 @@ def get_db_connection2():
         raise
     finally:
         if connection:
-            with pool_lock:
-                connection_pool.putconn(connection)
+            release_connection(connection, discard=discard)
+
+
+def count_prepared_statements(**deltas):
+    with prepared_statement_metrics_lock:
+        for name, delta in deltas.items():
+            prepared_statement_metrics[name] += delta
+
+
+def get_prepared_statement_metrics():
+    """Prepared statement cache hits (no parse or plan), misses (PREPARE) and evictions"""
+    with prepared_statement_metrics_lock:
+        metrics = dict(prepared_statement_metrics)
+    lookups = metrics['hits'] + metrics['misses']
+    metrics['hit_ratio'] = metrics['hits'] / lookups if lookups else 0.0
+    return metrics
+
+
+def prepared_statement_command(cur, command, already_done):
+    """
+    Run a PREPARE or DEALLOCATE. Raising `already_done` means the server is already in
+    the state the command asks for (the statement exists, or is gone), which is not an
+    error here. A savepoint keeps that failure from aborting the caller's transaction.
+    """
+    in_transaction = not cur.connection.autocommit
+    if in_transaction:
+        cur.execute("SAVEPOINT prepared_statement")
+    try:
+        cur.execute(command)
+    except already_done:
+        if in_transaction:
+            cur.execute("ROLLBACK TO SAVEPOINT prepared_statement")
+        return
+    if in_transaction:
+        cur.execute("RELEASE SAVEPOINT prepared_statement")
+
+
+def execute_prepared(cur, org_id, name, query, params=()):
+    """
+    Execute one of the hot tenant statements through a server-side prepared statement.
+    It is prepared the first time a connection sees (org_id, name), so later calls skip
+    parsing and planning. `query` uses the usual %s placeholders, and a name must always
+    be used with the same query. Prepared statements outlive rollbacks, and they go
+    away with the connection.
+    """
+    statements = cur.connection.prepared_statements
+    key = (org_id, name)
+    statement = statements.get(key)
+
+    if statement is not None:
+        statements.move_to_end(key)
+        count_prepared_statements(hits=1)
+    else:
+        # The cache only changes once the server has, so the two cannot drift apart
+        if len(statements) >= PREPARED_STATEMENTS_PER_CONNECTION:
+            evicted_key, evicted = next(iter(statements.items()))
+            prepared_statement_command(cur, f"DEALLOCATE {evicted}", errors.InvalidSqlStatementName)
+            del statements[evicted_key]
+            count_prepared_statements(evictions=1)
+
+        statement = f"{org_id}_{name}"
+        placeholders = itertools.count(1)
+        prepared_statement_command(cur, f"PREPARE {statement} AS " +
+                                   re.sub(r'%s', lambda match: f"${next(placeholders)}", query).replace('%%', '%'),
+                                   errors.DuplicatePreparedStatement)
+        statements[key] = statement
+        count_prepared_statements(misses=1)
+
+    if params:
+        cur.execute(f"EXECUTE {statement} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {statement}")
 
 
 # Initialize database pool AFTER the functions are defined
@@ -269,7 +676,8 @@ def onboard_admin(token):
                                 (email, email))
                     existing_user = cur.fetchone()
 
-                    if existing_user:
+                    # The admin's email is also their tenant username, unique across organizations
+                    if existing_user or username_taken(cur, email):
                         msg = ("An account with this email address already exists. "
                                "Please use a different email or try logging in.")
                         flash(msg, "error")
@@ -297,10 +705,14 @@ def onboard_admin(token):
                     user_id = cur.fetchone()[0]
 
                     cur.execute(f"""
-                        INSERT INTO {org_id}_users (username, password, role, full_name, email, phone_number, org_id)
+                        INSERT INTO {tenant_prefix(org_id)}users (username, password, role, full_name, email, phone_number, org_id)
                         VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        RETURNING user_id
                     """, (email, password_hash, 2, full_name, email, phone_number, org_id))
 
+                    tenant_user_id = cur.fetchone()[0]
+                    sync_user_directory(cur, org_id, tenant_user_id, email)
+
                     # Update organization with superuser_id
                     cur.execute("""
                         UPDATE organizations
@@ -326,6 +738,8 @@ def onboard_admin(token):
                     return redirect(url_for('subscription_required'))
 
                 except Exception as e:
+                    # Nothing of a half-finished onboarding is kept, so the invite can be used again
+                    conn.rollback()
                     log_error_to_file(f"Database/Processing Error: {str(e)} Token: {token}")
                     error_message = str(e)
                     if "organizations_username_key" in error_message or "duplicate key" in error_message.lower():
@@ -373,14 +787,34 @@ def generate_next_org_id():
         return ''.join(chars)
 
 
-def create_tenant_tables(org_id):
-    """
-    Create all tenant-specific tables based on the provided structures.
-    Each table name is prefixed with the tenant org_id.
-    """
-    table_definitions = {
+def tenant_schema(org_id):
+    return f"tenant_{org_id}"
+
+
+def tenant_prefix(org_id):
+    """What goes in front of a tenant table, sequence or function name: '{org_id}_' or 'tenant_{org_id}.'"""
+    if TENANCY_MODE == 'schema':
+        return f"{tenant_schema(org_id)}."
+    return f"{org_id}_"
+
+
+def tenant_object_name(org_id, name):
+    """Unqualified name for a tenant index or trigger, which always lives in its table's schema"""
+    if TENANCY_MODE == 'schema':
+        return name
+    return f"{org_id}_{name}"
+
+
+def shared_table(name):
+    """The all-tenant table holding every org's partition of `name` (TENANCY_MODE=partitioned)"""
+    return f"shared_{name}"
+
+
+def tenant_table_definitions(org_id):
+    """CREATE TABLE statements for every tenant-specific table, prefixed with the tenant org_id"""
+    return {
         "sales": f"""
-                CREATE TABLE IF NOT EXISTS {org_id}_sales (
+                CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}sales (
                     sales_id SERIAL PRIMARY KEY,
                     invoice_date DATE NOT NULL,
                     invoice_no VARCHAR(255) NOT NULL,
@@ -399,7 +833,7 @@ def create_tenant_tables(org_id):
                 )
             """,
         "sales_account": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_sales_account (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}sales_account (
                 sales_acc_id SERIAL PRIMARY KEY,
                 invoice_date DATE NOT NULL,
                 invoice_number VARCHAR(255) NOT NULL,
@@ -418,7 +852,7 @@ def create_tenant_tables(org_id):
         """,
 
         "sales_list": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_sales_list (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}sales_list (
                 id SERIAL PRIMARY KEY,
                 customer_name VARCHAR(255) NOT NULL,
                 invoice_no VARCHAR(255) NOT NULL UNIQUE,
@@ -435,7 +869,7 @@ def create_tenant_tables(org_id):
         """,
 
         "suppliers": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_suppliers (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}suppliers (
                 supplier_id SERIAL PRIMARY KEY,
                 supplier VARCHAR(255) NOT NULL,
                 contact VARCHAR(255),
@@ -447,7 +881,7 @@ def create_tenant_tables(org_id):
         """,
 
         "users": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_users (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}users (
                 user_id SERIAL PRIMARY KEY,
                 username VARCHAR(255) NOT NULL,
                 full_name VARCHAR(255) NOT NULL,
@@ -460,7 +894,7 @@ def create_tenant_tables(org_id):
         """,
 
         "receipts": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_receipts (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}receipts (
                 receipt_id SERIAL PRIMARY KEY,
                 paid_date DATE NOT NULL,
                 invoice_number VARCHAR(255) NOT NULL,
@@ -470,13 +904,13 @@ def create_tenant_tables(org_id):
                 balance NUMERIC NOT NULL,
                 receipt_invoice_number VARCHAR(255) NOT NULL,
                 category VARCHAR(255) NOT NULL,
-                account_owner VARCHAR(255) NOT NULL
-                mpesa_receipt_number VARCHAR(255) 
+                account_owner VARCHAR(255) NOT NULL,
+                mpesa_receipt_number VARCHAR(255)
             )
         """,
 
         "products": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_products (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}products (
                 product_number SERIAL,
                 product VARCHAR(255) NOT NULL,
                 edition VARCHAR(255),
@@ -492,7 +926,7 @@ def create_tenant_tables(org_id):
         """,
 
         "invoices": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_invoices (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}invoices (
                 id SERIAL PRIMARY KEY,
                 invoice_number VARCHAR(20) NOT NULL UNIQUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -500,7 +934,7 @@ def create_tenant_tables(org_id):
         """,
 
         "clients": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_clients (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}clients (
                 customer_id SERIAL PRIMARY KEY,
                 customer_name VARCHAR(255) NOT NULL,
                 institution VARCHAR(255) NOT NULL,
@@ -514,7 +948,7 @@ def create_tenant_tables(org_id):
         """,
 
         "bills": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_bills (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}bills (
                 bill_id SERIAL PRIMARY KEY,
                 service_provider VARCHAR(255) NOT NULL,
                 account_name VARCHAR(255) NOT NULL,
@@ -530,12 +964,14 @@ def create_tenant_tables(org_id):
                 bill_invoice_number VARCHAR(50),
                 invoice_number VARCHAR(100),
                 status VARCHAR(100) DEFAULT 'Active',
-                bank_account VARCHAR(100)
+                bank_account VARCHAR(100),
+                total_paid DOUBLE PRECISION NOT NULL DEFAULT 0,
+                balance DOUBLE PRECISION GENERATED ALWAYS AS (bill_amount - total_paid) STORED
             )
         """,
 
         "billing_account": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_billing_account (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}billing_account (
                 billing_account_id SERIAL PRIMARY KEY,
                 service_provider VARCHAR(255) NOT NULL,
                 account_name VARCHAR(255) NOT NULL,
@@ -555,7 +991,7 @@ def create_tenant_tables(org_id):
         """,
 
         "banks": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_banks (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}banks (
                 bank_account_id SERIAL PRIMARY KEY,
                 account_name VARCHAR(255) NOT NULL,
                 bank_name VARCHAR(255) NOT NULL,
@@ -566,7 +1002,7 @@ def create_tenant_tables(org_id):
         """,
 
         "account_owner": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_account_owner (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}account_owner (
                 account_type_id SERIAL PRIMARY KEY,
                 account_owner VARCHAR(255) NOT NULL,
                 created_date DATE DEFAULT CURRENT_DATE
@@ -574,7 +1010,7 @@ def create_tenant_tables(org_id):
         """,
 
         "payments": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_payments (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}payments (
                 payment_id SERIAL PRIMARY KEY,
                 service_provider VARCHAR(255) NOT NULL,
                 account_name VARCHAR(255) NOT NULL,
@@ -596,7 +1032,7 @@ def create_tenant_tables(org_id):
         """,
 
         "mpesa_requests": f"""
-            CREATE TABLE IF NOT EXISTS {org_id}_payments (
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}mpesa_requests (
                 id SERIAL PRIMARY KEY,
                 checkout_request_id VARCHAR(255) UNIQUE NOT NULL,
                 merchant_request_id VARCHAR(255) NOT NULL,
@@ -613,14 +1049,557 @@ def create_tenant_tables(org_id):
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
+        """,
+
+        "payment_ledger": f"""
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}payment_ledger (
+                ledger_id BIGSERIAL PRIMARY KEY,
+                invoice_no VARCHAR(255) NOT NULL,
+                customer_name VARCHAR(255) NOT NULL,
+                amount NUMERIC NOT NULL,
+                entry_type VARCHAR(50) NOT NULL,
+                receipt_invoice_number VARCHAR(255),
+                posted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
         """
     }
 
+
+def create_tenant_tables(org_id):
+    """
+    Create all tenant-specific tables based on the provided structures.
+    Each table name is prefixed with the tenant org_id, or placed in the tenant's schema.
+    A tenant that already has its tables (a renewal) is left to migrate-tenants.py.
+    """
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass(%s)", (f"{tenant_prefix(org_id)}sales_list",))
+        if cur.fetchone()[0] is None:
+            if TENANCY_MODE == 'schema':
+                cur.execute(f"CREATE SCHEMA IF NOT EXISTS {tenant_schema(org_id)}")
+            for table_name, create_sql in tenant_table_definitions(org_id).items():
+                cur.execute(create_sql)
+            # New tables are empty, so the migrations' indexes are built in this transaction
+            apply_new_tenant_migrations(cur, org_id)
+            if TENANCY_MODE == 'partitioned':
+                attach_tenant_partitions(cur, org_id)
+            print(f"✅ Created tenant tables for org_id: {org_id}")
+
+    create_customer_search(org_id)
+
+
+def ensure_pg_trgm():
+    """Enable pg_trgm if the database allows it; customer search works without it, just unindexed"""
+    global pg_trgm_available
+    if pg_trgm_available is None:
+        try:
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            pg_trgm_available = True
+        except psycopg2.Error as e:
+            log_error_to_file(f"pg_trgm unavailable, customer search will not be trigram-indexed: {str(e)}")
+            pg_trgm_available = False
+    return pg_trgm_available
+
+
+def create_customer_search(org_id):
+    """
+    Per-customer open balances for the customer autocomplete, kept in step with sales_list by
+    a trigger. The autocomplete then searches one row per customer instead of every invoice.
+    """
+    trigram_index = ensure_pg_trgm()
+
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tenant_prefix(org_id)}customer_balances (
+                customer_name VARCHAR(255) PRIMARY KEY,
+                open_balance NUMERIC NOT NULL DEFAULT 0,
+                open_invoices INTEGER NOT NULL DEFAULT 0
+            ) WITH (fillfactor = 50)
+        """)
+        # Only customer_name is indexed (no partial predicate on the counters), so the
+        # trigger's balance updates stay HOT and do not bloat the table or its indexes
+        if trigram_index:
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {tenant_object_name(org_id, 'customer_balances_name_trgm')}
+                ON {tenant_prefix(org_id)}customer_balances USING gin (customer_name gin_trgm_ops)
+            """)
+
+        # get_unpaid_invoices: one customer's open invoices, newest first
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS {tenant_object_name(org_id, 'sales_list_open_by_customer')}
+            ON {tenant_prefix(org_id)}sales_list (customer_name, invoice_date DESC)
+            WHERE balance > 0
+        """)
+
+        cur.execute(f"""
+            CREATE OR REPLACE FUNCTION {tenant_prefix(org_id)}sync_customer_balance() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.balance > 0 THEN
+                    UPDATE {tenant_prefix(org_id)}customer_balances
+                    SET open_balance = open_balance - OLD.balance,
+                        open_invoices = open_invoices - 1
+                    WHERE customer_name = OLD.customer_name;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.balance > 0 THEN
+                    INSERT INTO {tenant_prefix(org_id)}customer_balances (customer_name, open_balance, open_invoices)
+                    VALUES (NEW.customer_name, NEW.balance, 1)
+                    ON CONFLICT (customer_name) DO UPDATE
+                    SET open_balance = {tenant_prefix(org_id)}customer_balances.open_balance + EXCLUDED.open_balance,
+                        open_invoices = {tenant_prefix(org_id)}customer_balances.open_invoices + 1;
+                END IF;
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+
+        cur.execute("""
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = %s AND tgrelid = to_regclass(%s)
+        """, (tenant_object_name(org_id, 'sync_customer_balance'), f"{tenant_prefix(org_id)}sales_list"))
+        if cur.fetchone() is None:
+            # CREATE TRIGGER locks out sales_list writers until commit, so the backfill
+            # below cannot miss a row written in between
+            cur.execute(f"""
+                CREATE TRIGGER {tenant_object_name(org_id, 'sync_customer_balance')}
+                AFTER INSERT OR DELETE OR UPDATE OF customer_name, balance ON {tenant_prefix(org_id)}sales_list
+                FOR EACH ROW EXECUTE FUNCTION {tenant_prefix(org_id)}sync_customer_balance()
+            """)
+
+            cur.execute(f"DELETE FROM {tenant_prefix(org_id)}customer_balances")
+            cur.execute(f"""
+                INSERT INTO {tenant_prefix(org_id)}customer_balances (customer_name, open_balance, open_invoices)
+                SELECT customer_name, SUM(balance), COUNT(*)
+                FROM {tenant_prefix(org_id)}sales_list
+                WHERE balance > 0
+                GROUP BY customer_name
+            """)
+
+
+def create_customer_search_for_all_tenants():
+    """Set up customer search for tenants created before it existed"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT org_id FROM organizations")
+        org_ids = [row[0] for row in cur.fetchall()]
+
+    for org_id in org_ids:
+        with get_db_connection2() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT to_regclass(%s)", (f"{tenant_prefix(org_id)}sales_list",))
+            if cur.fetchone()[0] is None:
+                continue
+        try:
+            create_customer_search(org_id)
+        except Exception as e:
+            log_error_to_file(f"Error creating customer search for {org_id}: {str(e)}")
+
+
+# Sets every bill's total_paid to the sum of its payments ({prefix} as in TENANT_MIGRATIONS)
+RECOUNT_BILL_TOTALS = """
+    UPDATE {prefix}bills b
+    SET total_paid = COALESCE(p.total_paid, 0)
+    FROM {prefix}bills b2
+    LEFT JOIN (
+        SELECT invoice_number, SUM(paid_amount) AS total_paid
+        FROM {prefix}payments
+        GROUP BY invoice_number
+    ) p ON p.invoice_number = b2.bill_invoice_number
+    WHERE b2.bill_id = b.bill_id
+      AND b.total_paid IS DISTINCT FROM COALESCE(p.total_paid, 0)
+"""
+
+# Versioned changes to the per-tenant tables, applied in order to every tenant by
+# run_tenant_migrations() (migrate-tenants.py) and recorded in tenant_schema_migrations.
+# Index entries are (name, table, definition), named per tenant as tenant_object_name() and
+# tenant_prefix() do; statements are formatted with {prefix} for the tenant's table prefix.
+TENANT_MIGRATIONS = [
+    {
+        'version': 1,
+        'description': 'Tables and columns missing from the original tenant DDL',
+        'tables': ['mpesa_requests'],
+        'statements': [
+            "ALTER TABLE {prefix}receipts ADD COLUMN IF NOT EXISTS mpesa_receipt_number VARCHAR(255)"
+        ]
+    },
+    {
+        'version': 2,
+        'description': 'Lookup and listing indexes',
+        'indexes': [
+            # Invoice lines by invoice, in line order (view/edit/PDF/receipts)
+            ('sales_invoice_no', 'sales', '(invoice_no, sales_id)'),
+            ('sales_sales_acc_invoice_no', 'sales', '(sales_acc_invoice_no) WHERE sales_acc_invoice_no IS NOT NULL'),
+            ('sales_active_invoice_date', 'sales', "(invoice_date, sales_id) WHERE status = 'Active'"),
+            # Listings: date range plus (sort, key) keyset pages, open invoices only for receiving
+            ('sales_list_invoice_date', 'sales_list', '(invoice_date, id)'),
+            ('sales_list_open_invoice_date', 'sales_list', '(invoice_date, id) WHERE balance > 0'),
+            ('sales_list_account_owner', 'sales_list', '(account_owner, invoice_date)'),
+            ('sales_list_category', 'sales_list', '(category, invoice_date)'),
+            ('sales_list_reference_no', 'sales_list', '(reference_no) WHERE reference_no IS NOT NULL'),
+            ('receipts_paid_date', 'receipts', '(paid_date, receipt_id)'),
+            ('receipts_invoice_number', 'receipts', '(invoice_number)'),
+            ('receipts_account_owner', 'receipts', '(account_owner, paid_date)'),
+            ('sales_account_active_invoice_date', 'sales_account',
+             "(invoice_date, sales_acc_id) WHERE status = 'Active'"),
+            # Bills, their payments and the recurring billing accounts
+            ('bills_invoice_number', 'bills', '(invoice_number, billing_date)'),
+            ('bills_bill_invoice_number', 'bills', '(bill_invoice_number)'),
+            ('bills_billing_date', 'bills', '(billing_date)'),
+            ('billing_account_invoice_number', 'billing_account', '(invoice_number)'),
+            ('payments_invoice_number', 'payments', '(invoice_number)'),
+            ('payments_paid_date', 'payments', '(paid_date)'),
+            ('clients_phone_no', 'clients', '(phone_no)'),
+            ('clients_customer_name', 'clients', '(customer_name)')
+        ]
+    },
+    {
+        'version': 3,
+        'description': 'Append-only payment ledger',
+        'tables': ['payment_ledger'],
+        'statements': [
+            """
+            CREATE OR REPLACE FUNCTION public.payment_ledger_append_only() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION 'payment_ledger is append-only, post a correcting entry instead';
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE TRIGGER payment_ledger_append_only
+            BEFORE UPDATE OR DELETE ON {prefix}payment_ledger
+            FOR EACH ROW EXECUTE FUNCTION public.payment_ledger_append_only()
+            """,
+            # Opening entries: every receipt so far, plus the difference wherever an invoice's
+            # paid_amount disagrees with its receipts, so each invoice's entries sum to its
+            # paid_amount. Skipped once the ledger has entries, so a rerun cannot double them
+            """
+            INSERT INTO {prefix}payment_ledger (invoice_no, customer_name, amount, entry_type,
+                                                receipt_invoice_number, posted_at)
+            SELECT invoice_number, customer_name, paid_amount, 'receipt', receipt_invoice_number, paid_date
+            FROM {prefix}receipts
+            WHERE NOT EXISTS (SELECT 1 FROM {prefix}payment_ledger)
+            UNION ALL
+            SELECT l.invoice_no, l.customer_name, l.paid_amount - COALESCE(r.paid_amount, 0), 'opening',
+                   NULL, CURRENT_TIMESTAMP
+            FROM {prefix}sales_list l
+            LEFT JOIN (
+                SELECT invoice_number, SUM(paid_amount) AS paid_amount
+                FROM {prefix}receipts
+                GROUP BY invoice_number
+            ) r ON r.invoice_number = l.invoice_no
+            WHERE l.paid_amount <> COALESCE(r.paid_amount, 0)
+              AND NOT EXISTS (SELECT 1 FROM {prefix}payment_ledger)
+            """
+        ],
+        'indexes': [
+            ('payment_ledger_invoice_no', 'payment_ledger', '(invoice_no, ledger_id)')
+        ]
+    },
+    {
+        'version': 4,
+        'description': 'Running payment totals on bills',
+        'statements': [
+            "ALTER TABLE {prefix}bills ADD COLUMN IF NOT EXISTS total_paid DOUBLE PRECISION NOT NULL DEFAULT 0",
+            # A stored generated column rewrites the table once, under an exclusive lock
+            """
+            ALTER TABLE {prefix}bills ADD COLUMN IF NOT EXISTS balance DOUBLE PRECISION
+            GENERATED ALWAYS AS (bill_amount - total_paid) STORED
+            """,
+            RECOUNT_BILL_TOTALS
+        ]
+    }
+]
+
+# Session advisory lock held by a migration run, so two runs never build the same index
+TENANT_MIGRATION_LOCK = 72060001
+
+
+def create_tenant_schema_migrations_table():
+    """Create the record of which tenant migrations each org has had applied"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS tenant_schema_migrations (
+                org_id VARCHAR(4) NOT NULL,
+                version INTEGER NOT NULL,
+                description VARCHAR(255),
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (org_id, version)
+            )
+        """)
+
+
+def record_tenant_migration(cur, org_id, migration):
+    cur.execute("""
+        INSERT INTO tenant_schema_migrations (org_id, version, description)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (org_id, version) DO NOTHING
+    """, (org_id, migration['version'], migration['description']))
+
+
+# A migration statement changing a table's columns; group 1 is the table
+TENANT_COLUMN_CHANGE = re.compile(r'\s*ALTER TABLE\s+(?:IF EXISTS\s+)?(\S+)\s+(?:ADD|DROP|ALTER|RENAME)\s+COLUMN\b',
+                                  re.IGNORECASE)
+
+
+def run_tenant_migration_statement(cur, org_id, statement):
+    """
+    Run one of a migration's statements for the tenant. Columns of a table attached as a
+    partition can only change on its shared_<name> parent, so the statement is run there,
+    reaching every org's partition; the IF [NOT] EXISTS it needs to be rerunnable turns the
+    other orgs' runs into no-ops.
+    """
+    statement = statement.format(prefix=tenant_prefix(org_id))
+    column_change = TENANT_COLUMN_CHANGE.match(statement)
+    if column_change:
+        cur.execute("SELECT inhparent::regclass::text FROM pg_inherits WHERE inhrelid = to_regclass(%s)",
+                    (column_change.group(1),))
+        parent = cur.fetchone()
+        if parent:
+            statement = statement[:column_change.start(1)] + parent[0] + statement[column_change.end(1):]
+    cur.execute(statement)
+
+
+def apply_new_tenant_migrations(cur, org_id):
+    """Apply every migration to a tenant whose tables were just created, in the caller's transaction"""
+    for migration in TENANT_MIGRATIONS:
+        for table in migration.get('tables', []):
+            cur.execute(tenant_table_definitions(org_id)[table])
+        for statement in migration.get('statements', []):
+            run_tenant_migration_statement(cur, org_id, statement)
+        for name, table, definition in migration.get('indexes', []):
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {tenant_object_name(org_id, name)}
+                ON {tenant_prefix(org_id)}{table} {definition}
+            """)
+        record_tenant_migration(cur, org_id, migration)
+
+
+def build_tenant_index(cur, org_id, name, table, definition):
+    """
+    Build one index without blocking writes (CREATE INDEX CONCURRENTLY, autocommit cursor).
+    An interrupted concurrent build leaves an invalid index that IF NOT EXISTS would keep,
+    so it is dropped and rebuilt.
+    """
+    index_name = f"{tenant_prefix(org_id)}{name}"
+    table_name = f"{tenant_prefix(org_id)}{table}"
+    cur.execute("SELECT to_regclass(%s)", (table_name,))
+    if cur.fetchone()[0] is None:
+        log_error_to_file(f"Skipped index {index_name}: table {table_name} does not exist")
+        return
+
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index_name,))
+    existing = cur.fetchone()
+    if existing and existing[0]:
+        return
+    if existing:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+
+    cur.execute(f"""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS {tenant_object_name(org_id, name)}
+        ON {table_name} {definition}
+    """)
+
+
+def migrate_tenant(cur, org_id):
+    """Apply the tenant's outstanding migrations online; returns the versions applied"""
+    cur.execute("SELECT version FROM tenant_schema_migrations WHERE org_id = %s", (org_id,))
+    applied = {row[0] for row in cur.fetchall()}
+
+    versions = []
+    for migration in TENANT_MIGRATIONS:
+        if migration['version'] in applied:
+            continue
+        for table in migration.get('tables', []):
+            cur.execute(tenant_table_definitions(org_id)[table])
+        for statement in migration.get('statements', []):
+            run_tenant_migration_statement(cur, org_id, statement)
+        for name, table, definition in migration.get('indexes', []):
+            build_tenant_index(cur, org_id, name, table, definition)
+        # Recorded only once every step is in place; a rerun resumes from here
+        record_tenant_migration(cur, org_id, migration)
+        versions.append(migration['version'])
+    return versions
+
+
+def run_tenant_migrations(org_ids=None):
+    """
+    Bring every tenant (or just `org_ids`) up to the latest migration while the app is running.
+    Runs on an autocommit connection because CREATE INDEX CONCURRENTLY cannot run in a
+    transaction. Returns {org_id: versions applied}, or None for a tenant that failed.
+    """
+    connection = checkout_connection()
+    discard = False
+    try:
+        connection.autocommit = True
+        cur = connection.cursor()
+
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (TENANT_MIGRATION_LOCK,))
+        if not cur.fetchone()[0]:
+            print("Another tenant migration run is in progress")
+            return {}
+
+        try:
+            if org_ids is None:
+                cur.execute("SELECT org_id FROM organizations ORDER BY org_id")
+                org_ids = [row[0] for row in cur.fetchall()]
+
+            results = {}
+            for org_id in org_ids:
+                cur.execute("SELECT to_regclass(%s)", (f"{tenant_prefix(org_id)}sales_list",))
+                if cur.fetchone()[0] is None:
+                    continue
+                try:
+                    results[org_id] = migrate_tenant(cur, org_id)
+                    print(f"✅ {org_id}: applied {results[org_id] or 'nothing, up to date'}")
+                except psycopg2.OperationalError:
+                    raise
+                except psycopg2.Error as e:
+                    log_error_to_file(f"Tenant migration failed for {org_id}: {str(e)}")
+                    print(f"❌ {org_id}: {str(e)}")
+                    results[org_id] = None
+            return results
+        finally:
+            if not connection.closed:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (TENANT_MIGRATION_LOCK,))
+
+    except psycopg2.OperationalError:
+        discard = True
+        raise
+    finally:
+        if not connection.closed:
+            connection.autocommit = False
+        release_connection(connection, discard=discard)
+
+
+def tenant_migration_status():
+    """[(org_id, latest version applied or None)] for every org, against the latest available"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT o.org_id, MAX(m.version)
+            FROM organizations o
+            LEFT JOIN tenant_schema_migrations m ON m.org_id = o.org_id
+            GROUP BY o.org_id
+            ORDER BY o.org_id
+        """)
+        return cur.fetchall()
+
+
+def recount_bill_totals(org_id):
+    """
+    Recompute every bill's total_paid from the payments table; returns the number of bills corrected.
+    Bill payments are held off for the duration (bills, then payments, the order pay_bill locks
+    them in), so none is missed or counted twice; listings keep reading.
+    Run once after deploying the code that maintains the totals (migrate-tenants.py --recount-bills).
+    """
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute(f"LOCK TABLE {tenant_prefix(org_id)}bills IN EXCLUSIVE MODE")
+        cur.execute(f"LOCK TABLE {tenant_prefix(org_id)}payments IN SHARE MODE")
+        cur.execute(RECOUNT_BILL_TOTALS.format(prefix=tenant_prefix(org_id)))
+        return cur.rowcount
+
+
+def move_tenant_to_schema(org_id):
+    """
+    Move an org's {org_id}_ tables out of public into its own schema, dropping the prefix from
+    the table, index and sequence names. Only catalog entries change (no rows are copied).
+    Run with the app stopped and TENANCY_MODE=schema, then start the app in schema mode.
+    Returns False when the org has no prefixed tables left to move.
+    """
+    if TENANCY_MODE != 'schema':
+        raise RuntimeError("Set TENANCY_MODE=schema before moving tenants into schemas")
+
+    schema = tenant_schema(org_id)
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass(%s)", (f"public.{org_id}_sales_list",))
+        if cur.fetchone()[0] is None:
+            return False
+
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+        # The customer balance trigger function names the old tables; it is recreated below
+        cur.execute(f"DROP TRIGGER IF EXISTS {org_id}_sync_customer_balance ON public.{org_id}_sales_list")
+        cur.execute(f"DROP FUNCTION IF EXISTS public.{org_id}_sync_customer_balance()")
+
+        for table in list(tenant_table_definitions(org_id)) + ['customer_balances']:
+            cur.execute("SELECT to_regclass(%s)", (f"public.{org_id}_{table}",))
+            if cur.fetchone()[0] is None:
+                continue
+            # Indexes, constraints and SERIAL sequences move along with the table
+            cur.execute(f"ALTER TABLE public.{org_id}_{table} SET SCHEMA {schema}")
+            cur.execute(f"ALTER TABLE {schema}.{org_id}_{table} RENAME TO {table}")
+
+        # Invoice number sequences are not owned by a table
+        cur.execute("""
+            SELECT relname FROM pg_class
+            WHERE relkind = 'S' AND relnamespace = 'public'::regnamespace AND starts_with(relname, %s)
+        """, (f"{org_id}_invoice_seq_",))
+        for (name,) in cur.fetchall():
+            cur.execute(f"ALTER SEQUENCE public.{name} SET SCHEMA {schema}")
+
+        cur.execute("""
+            SELECT relname, relkind FROM pg_class
+            WHERE relnamespace = %s::regnamespace AND relkind IN ('i', 'S') AND starts_with(relname, %s)
+        """, (schema, f"{org_id}_"))
+        for name, kind in cur.fetchall():
+            object_type = 'INDEX' if kind == 'i' else 'SEQUENCE'
+            cur.execute(f"ALTER {object_type} {schema}.{name} RENAME TO {name[len(org_id) + 1:]}")
+
+    create_customer_search(org_id)
+    return True
+
+
+def attach_tenant_partitions(cur, org_id):
+    """
+    Attach the org's SHARED_TABLES as list partitions of the shared_<name> tables, adding an
+    org_id column to each. The tables keep their {org_id}_ names, so tenant queries keep
+    addressing their own partition directly while cross-tenant jobs query the shared table.
+    The first org attached defines the shared table's columns. Skips tables already attached.
+    """
+    for name in SHARED_TABLES:
+        table = f"{org_id}_{name}"
+        cur.execute("SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s)", (table,))
+        if cur.fetchone():
+            continue
+
+        # A constant default is stored in the catalog, so existing rows are not rewritten
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS org_id VARCHAR(4) NOT NULL DEFAULT %s",
+                    (org_id,))
+        # A validated CHECK matching the partition bound lets ATTACH skip scanning the table
+        # under its exclusive lock; VALIDATE only blocks schema changes, not writes
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_partition CHECK (org_id = %s) NOT VALID",
+                    (org_id,))
+        cur.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_partition")
+
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {shared_table(name)} (LIKE {table}) PARTITION BY LIST (org_id)")
+        cur.execute(f"ALTER TABLE {shared_table(name)} ATTACH PARTITION {table} FOR VALUES IN (%s)", (org_id,))
+        cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_partition")
+
+
+def move_tenant_to_partitions(org_id):
+    """
+    Attach an existing org's tables to the shared partitioned tables, in one transaction.
+    Run with TENANCY_MODE=partitioned after the tenant migrations, so every org's columns match.
+    Returns False when the org has no tenant tables.
+    """
+    if TENANCY_MODE != 'partitioned':
+        raise RuntimeError("Set TENANCY_MODE=partitioned before attaching tenants to the shared tables")
+
     with get_db_connection2() as conn:
         cur = conn.cursor()
-        for table_name, create_sql in table_definitions.items():
-            cur.execute(create_sql)
-        print(f"✅ Created tenant tables for org_id: {org_id}")
+        cur.execute("SELECT to_regclass(%s)", (f"{org_id}_sales_list",))
+        if cur.fetchone()[0] is None:
+            return False
+        attach_tenant_partitions(cur, org_id)
+    return True
 
 
 @app.route('/subscription_required')
@@ -659,20 +1638,81 @@ def subscription_required():
 #         port=os.getenv('DB_PORT')
 #     )
 
-def get_mpesa_access_token():
-    """Get M-Pesa access token"""
-    api_url = "https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-
-    credentials = f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}"
-    encoded_credentials = base64.b64encode(credentials.encode()).decode()
-
-    headers = {
-        'Authorization': f'Basic {encoded_credentials}',
-        'Content-Type': 'application/json'
-    }
+def create_mpesa_http_session():
+    """
+    Build the keep-alive, connection-pooled session used for every Safaricom call.
+    Read/status errors are only retried for GET, so an STK push is never sent twice;
+    failed connection attempts (nothing reached the server) are retried for all methods.
+    """
+    retry = Retry(
+        total=MPESA_HTTP_RETRIES,
+        connect=MPESA_HTTP_RETRIES,
+        read=MPESA_HTTP_RETRIES,
+        status=MPESA_HTTP_RETRIES,
+        backoff_factor=MPESA_HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MPESA_HTTP_POOL_SIZE, max_retries=retry)
+    http = requests.Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+
+mpesa_http = create_mpesa_http_session()
+
+
+def get_cached_mpesa_token(cache_key):
+    """Return a cached access token that is not yet due for refresh, else None"""
+    with mpesa_token_lock:
+        entry = mpesa_token_cache.get(cache_key)
+    if entry and entry[1] > datetime.now():
+        return entry[0]
+    return None
+
+
+def fetch_mpesa_access_token(cache_key, consumer_key, consumer_secret):
+    """
+    Return an OAuth token for a credential set, reusing it until shortly before it expires.
+    Concurrent callers for the same credentials wait for a single refresh request.
+    """
+    token = get_cached_mpesa_token(cache_key)
+    if token:
+        return token
+
+    with mpesa_token_lock:
+        key_lock = mpesa_token_locks.setdefault(cache_key, threading.Lock())
+
+    with key_lock:
+        # Another thread may have refreshed the token while we waited
+        token = get_cached_mpesa_token(cache_key)
+        if token:
+            return token
+
+        response = mpesa_http.get(MPESA_OAUTH_URL, auth=(consumer_key, consumer_secret), timeout=MPESA_HTTP_TIMEOUT)
+        if response.status_code != 200:
+            log_error_to_file(f"Failed to get M-Pesa access token ({cache_key[0]}): {response.text}")
+            return None
+
+        token_data = response.json()
+        token = token_data.get('access_token')
+        if not token:
+            return None
+
+        expires_in = int(token_data.get('expires_in', 3599))
+        refresh_at = datetime.now() + timedelta(seconds=max(expires_in - MPESA_TOKEN_REFRESH_MARGIN, 0))
+        with mpesa_token_lock:
+            mpesa_token_cache[cache_key] = (token, refresh_at)
+        return token
 
-    response = requests.get(api_url, headers=headers)
-    return response.json().get('access_token')
+
+def get_mpesa_access_token():
+    """Get M-Pesa access token"""
+    return fetch_mpesa_access_token(
+        ('platform', MPESA_CONSUMER_KEY), MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET
+    )
 
 
 def get_active_products():
@@ -922,7 +1962,7 @@ def initiate_mpesa_payment():
         with get_db_connection2() as conn:
             cur = conn.cursor()
             cur.execute(f"""
-                SELECT balance FROM {org_id}_sales_list 
+                SELECT balance FROM {tenant_prefix(org_id)}sales_list 
                 WHERE id = %s
             """, (data['sales_list_id'],))
             result = cur.fetchone()
@@ -975,11 +2015,11 @@ def initiate_mpesa_payment():
             'Content-Type': 'application/json'
         }
 
-        response = requests.post(
-            'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest',
+        response = mpesa_http.post(
+            f'{MPESA_API_BASE_URL}/mpesa/stkpush/v1/processrequest',
             json=payload,
             headers=headers,
-            timeout=30
+            timeout=MPESA_HTTP_TIMEOUT
         )
 
         response_data = response.json()
@@ -991,7 +2031,7 @@ def initiate_mpesa_payment():
                 cur = conn.cursor()
 
                 cur.execute(f"""
-                    INSERT INTO {org_id}_mpesa_requests 
+                    INSERT INTO {tenant_prefix(org_id)}mpesa_requests 
                     (checkout_request_id, merchant_request_id, invoice_no, phone_number, 
                      amount, customer_name, sales_list_id, status)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, 'Pending')
@@ -1005,6 +2045,13 @@ def initiate_mpesa_payment():
                     data['sales_list_id']
                 ))
 
+                # Let the callback resolve the tenant without scanning every org
+                cur.execute("""
+                    INSERT INTO mpesa_request_routes (checkout_request_id, org_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (checkout_request_id) DO NOTHING
+                """, (response_data['CheckoutRequestID'], org_id))
+
             log_error_to_file(
                 f"MPESA STK Push Initiated Successfully for {org_id}: "
                 f"CheckoutRequestID: {response_data['CheckoutRequestID']}")
@@ -1080,20 +2127,11 @@ def get_mpesa_access_token_for_org(org_id):
         return None
 
     try:
-        api_url = "https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-
-        response = requests.get(
-            api_url,
-            auth=(config['consumer_key'], config['consumer_secret']),
-            timeout=30
+        # Keyed on the consumer key too, so updated credentials never reuse a stale token
+        return fetch_mpesa_access_token(
+            (org_id, config['consumer_key']), config['consumer_key'], config['consumer_secret']
         )
 
-        if response.status_code == 200:
-            return response.json().get('access_token')
-        else:
-            log_error_to_file(f"Failed to get access token for {org_id}: {response.text}")
-            return None
-
     except Exception as e:
         log_error_to_file(f"Error getting access token for {org_id}: {str(e)}")
         return None
@@ -1136,20 +2174,55 @@ def sales_mpesa_callback():
         with get_db_connection2() as conn:
             cur = conn.cursor()
 
-            # Find the organization using a safer query
-            cur.execute("""
-                SELECT schemaname, tablename 
-                FROM pg_tables 
-                WHERE tablename LIKE '%_mpesa_requests' 
-                AND schemaname = 'public'
-            """)
-
-            tables = cur.fetchall()
             org_id = None
             table_name = None
             request_data = None
+            tables = []
+
+            # Resolve the organization from the routing table written by initiate_mpesa_payment
+            cur.execute("""
+                SELECT org_id FROM mpesa_request_routes WHERE checkout_request_id = %s
+            """, (checkout_request_id,))
+            route = cur.fetchone()
 
-            for schema, table in tables:
+            if route:
+                cur.execute(f"""
+                    SELECT sales_list_id, amount, invoice_no, customer_name 
+                    FROM {tenant_prefix(route[0])}mpesa_requests 
+                    WHERE checkout_request_id = %s
+                """, (checkout_request_id,))
+                result = cur.fetchone()
+                if result:
+                    org_id = route[0]
+                    table_name = f"{tenant_prefix(org_id)}mpesa_requests"
+                    request_data = result
+
+            if not request_data:
+                # Fall back to scanning tenant tables for requests without a route
+                if TENANCY_MODE == 'partitioned':
+                    # One lookup across every org's partition finds the table to use
+                    cur.execute(f"""
+                        SELECT org_id, tableoid::regclass::text
+                        FROM {shared_table('mpesa_requests')}
+                        WHERE checkout_request_id = %s
+                    """, (checkout_request_id,))
+                elif TENANCY_MODE == 'schema':
+                    cur.execute("""
+                        SELECT substring(schemaname FROM 8), schemaname || '.' || tablename
+                        FROM pg_tables
+                        WHERE tablename = 'mpesa_requests'
+                        AND left(schemaname, 7) = 'tenant_'
+                    """)
+                else:
+                    cur.execute("""
+                        SELECT replace(tablename, '_mpesa_requests', ''), tablename 
+                        FROM pg_tables 
+                        WHERE tablename LIKE '%_mpesa_requests' 
+                        AND schemaname = 'public'
+                    """)
+                tables = cur.fetchall()
+
+            for table_org_id, table in tables:
                 try:
                     cur.execute(f"""
                         SELECT sales_list_id, amount, invoice_no, customer_name 
@@ -1160,7 +2233,7 @@ def sales_mpesa_callback():
 
                     if result:
                         table_name = table
-                        org_id = table.replace('_mpesa_requests', '')
+                        org_id = table_org_id
                         request_data = result
                         break
                 except Exception as e:
@@ -1244,10 +2317,10 @@ def check_mpesa_status():
             # Add debugging
             log_error_to_file(f"Checking MPESA status for org_id: {org_id}, checkout_id: {checkout_request_id}")
 
-            cur.execute(f"""
+            execute_prepared(cur, org_id, 'mpesa_request_status', f"""
                 SELECT status, result_code, result_desc, mpesa_receipt_number, 
                        invoice_no, amount, updated_at
-                FROM {org_id}_mpesa_requests 
+                FROM {tenant_prefix(org_id)}mpesa_requests 
                 WHERE checkout_request_id = %s
             """, (checkout_request_id,))
 
@@ -1273,8 +2346,8 @@ def check_mpesa_status():
 
             # If payment is completed, check sales_list
             if status == 'Completed':
-                cur.execute(f"""
-                    SELECT payment_status, balance FROM {org_id}_sales_list 
+                execute_prepared(cur, org_id, 'sales_list_status_by_invoice_no', f"""
+                    SELECT payment_status, balance FROM {tenant_prefix(org_id)}sales_list 
                     WHERE invoice_no = %s
                 """, (invoice_no,))
                 sales_result = cur.fetchone()
@@ -1290,6 +2363,45 @@ def check_mpesa_status():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def post_payment(cur, org_id, invoice_no, amount, entry_type, receipt_invoice_number=None):
+    """
+    Append a payment to the tenant's ledger and move the invoice's paid_amount/balance by the same
+    amount, in one statement. A correction is posted as another entry (negative to take money off).
+    The UPDATE locks the invoice row and adds to its current totals, so concurrent payments add up
+    instead of overwriting each other; the customer_balances trigger follows the balance change.
+    Returns (sales_list_id, paid_amount, balance, payment_status), or None if the invoice is unknown.
+    """
+    execute_prepared(cur, org_id, 'post_payment', f"""
+        WITH entry AS (
+            INSERT INTO {tenant_prefix(org_id)}payment_ledger (invoice_no, customer_name, amount, entry_type,
+                                                           receipt_invoice_number)
+            SELECT invoice_no, customer_name, %s::numeric, %s::varchar, %s::varchar
+            FROM {tenant_prefix(org_id)}sales_list
+            WHERE invoice_no = %s
+            RETURNING invoice_no, amount
+        )
+        UPDATE {tenant_prefix(org_id)}sales_list l
+        SET paid_amount = l.paid_amount + entry.amount,
+            balance = l.balance - entry.amount,
+            payment_status = CASE WHEN l.balance - entry.amount <= 0 THEN 'Paid' ELSE 'Not Paid' END
+        FROM entry
+        WHERE l.invoice_no = entry.invoice_no
+        RETURNING l.id, l.paid_amount, l.balance, l.payment_status
+    """, (amount, entry_type, receipt_invoice_number, invoice_no))
+    posted = cur.fetchone()
+    if posted is None:
+        return None
+
+    # Only the invoice's lines whose status actually changes are rewritten
+    execute_prepared(cur, org_id, 'sync_sales_payment_status', f"""
+        UPDATE {tenant_prefix(org_id)}sales
+        SET payment_status = %s
+        WHERE invoice_no = %s
+          AND payment_status <> %s
+    """, (posted[3], invoice_no, posted[3]))
+    return posted
+
+
 def record_mpesa_payment(org_id, sales_list_id, amount, invoice_no, customer_name, mpesa_receipt_number):
     """Record MPESA payment in the system"""
     try:
@@ -1298,8 +2410,8 @@ def record_mpesa_payment(org_id, sales_list_id, amount, invoice_no, customer_nam
 
             # Get current invoice details
             cur.execute(f"""
-                SELECT paid_amount, invoice_amount, balance, category, account_owner
-                FROM {org_id}_sales_list 
+                SELECT invoice_no, category, account_owner
+                FROM {tenant_prefix(org_id)}sales_list 
                 WHERE id = %s
             """, (sales_list_id,))
 
@@ -1309,17 +2421,9 @@ def record_mpesa_payment(org_id, sales_list_id, amount, invoice_no, customer_nam
                 log_error_to_file(error_msg)
                 return False
 
-            current_paid, invoice_amount, current_balance, category, account_owner = result
-            current_paid = float(current_paid or 0)
-            invoice_amount = float(invoice_amount)
-            current_balance = float(current_balance)
+            invoice_no, category, account_owner = result
             amount = float(amount)
 
-            # Calculate new totals
-            total_paid = current_paid + amount
-            balance = invoice_amount - total_paid
-            payment_status = 'Paid' if balance == 0 else 'Not Paid'
-
             # Generate receipt number - NOW WITH org_id parameter
             receipt_invoice_number = generate_next_invoice_number_for_org(org_id)
 
@@ -1330,9 +2434,17 @@ def record_mpesa_payment(org_id, sales_list_id, amount, invoice_no, customer_nam
 
             log_error_to_file(f"Generated receipt number: {receipt_invoice_number} for org {org_id}")
 
+            # Post to the ledger; sales_list and sales follow in the same transaction
+            _, total_paid, balance, payment_status = post_payment(cur, org_id, invoice_no, amount, 'mpesa',
+                                                                  receipt_invoice_number)
+            balance = float(balance)
+
+            log_error_to_file(
+                f"Updated sales_list ID {sales_list_id}: paid={total_paid}, balance={balance}, status={payment_status}")
+
             # Insert receipt record
             cur.execute(f"""
-                INSERT INTO {org_id}_receipts (
+                INSERT INTO {tenant_prefix(org_id)}receipts (
                     paid_date, invoice_number, invoice_date, customer_name,
                     paid_amount, balance, receipt_invoice_number,
                     category, account_owner, mpesa_receipt_number
@@ -1356,36 +2468,13 @@ def record_mpesa_payment(org_id, sales_list_id, amount, invoice_no, customer_nam
 
             # Create invoice record
             cur.execute(f"""
-                INSERT INTO {org_id}_invoices (invoice_number, created_at)
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                 VALUES (%s, %s)
                 ON CONFLICT (invoice_number) DO NOTHING
             """, (receipt_invoice_number, datetime.now()))
 
             log_error_to_file(f"Invoice record created/confirmed for: {receipt_invoice_number}")
 
-            # Update sales_list table
-            cur.execute(f"""
-                UPDATE {org_id}_sales_list
-                SET 
-                    paid_amount = %s,
-                    balance = %s,
-                    payment_status = %s
-                WHERE id = %s
-            """, (total_paid, balance, payment_status, sales_list_id))
-
-            log_error_to_file(
-                f"Updated sales_list ID {sales_list_id}: paid={total_paid}, balance={balance}, status={payment_status}")
-
-            # Update sales records
-            cur.execute(f"""
-                UPDATE {org_id}_sales
-                SET 
-                    payment_status = %s
-                WHERE invoice_no = %s
-            """, (payment_status, invoice_no))
-
-            log_error_to_file(f"Updated sales records for invoice {invoice_no} to status: {payment_status}")
-
             # Explicitly commit the transaction
             conn.commit()
 
@@ -1470,6 +2559,162 @@ def create_subscription_tables():
             print("Default subscription products inserted.")
 
 
+def create_user_directory_table():
+    """Create the global username directory and backfill it from the tenant users tables"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+
+        # One row per tenant username so login can resolve the org with a single indexed lookup
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_directory (
+                username VARCHAR(255) PRIMARY KEY,
+                org_id VARCHAR(4) NOT NULL REFERENCES organizations(org_id),
+                user_id INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (org_id, user_id)
+            )
+        """)
+
+        # Tenant users whose username another user already holds (from before usernames were
+        # unique across organizations); login tries each of them until they are renamed
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_directory_conflicts (
+                username VARCHAR(255) NOT NULL,
+                org_id VARCHAR(4) NOT NULL REFERENCES organizations(org_id),
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (org_id, user_id)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS user_directory_conflicts_username ON user_directory_conflicts (username)")
+
+        # Add every tenant user missing from the directory
+        cur.execute("""
+            CREATE TEMP TABLE directory_backfill (
+                username VARCHAR(255), org_id VARCHAR(4), user_id INTEGER
+            ) ON COMMIT DROP
+        """)
+        cur.execute("SELECT org_id FROM organizations")
+        for (org_id,) in cur.fetchall():
+            cur.execute("SELECT to_regclass(%s)", (f"{tenant_prefix(org_id)}users",))
+            if cur.fetchone()[0] is None:
+                continue
+
+            cur.execute(f"""
+                INSERT INTO directory_backfill (username, org_id, user_id)
+                SELECT username, %s, user_id FROM {tenant_prefix(org_id)}users
+            """, (org_id,))
+
+        cur.execute("""
+            INSERT INTO user_directory (username, org_id, user_id)
+            SELECT MIN(username), MIN(org_id), MIN(user_id)
+            FROM directory_backfill
+            GROUP BY username
+            HAVING COUNT(*) = 1
+            ON CONFLICT DO NOTHING
+        """)
+        if cur.rowcount:
+            print(f"User directory backfilled with {cur.rowcount} user(s).")
+
+        # Whoever is still missing shares a username with another user
+        cur.execute("""
+            INSERT INTO user_directory_conflicts (username, org_id, user_id)
+            SELECT b.username, b.org_id, b.user_id
+            FROM directory_backfill b
+            WHERE NOT EXISTS (
+                SELECT 1 FROM user_directory d WHERE d.org_id = b.org_id AND d.user_id = b.user_id
+            )
+            ON CONFLICT DO NOTHING
+            RETURNING username, org_id, user_id
+        """)
+        conflicts = cur.fetchall()
+        if conflicts:
+            log_error_to_file(f"Usernames shared by more than one user, rename them to make them unique: "
+                              f"{', '.join(f'{username} ({org_id}/{user_id})' for username, org_id, user_id in conflicts)}")
+            print(f"⚠️ {len(conflicts)} user(s) share a username with another user, see error_log.txt")
+
+
+def sync_user_directory(cur, org_id, user_id, username):
+    """
+    Point `username` at the given tenant user inside the caller's transaction.
+    Raises ValueError if the username already belongs to another user.
+    """
+    # Drop the previous username of this user (username changed on edit)
+    cur.execute("""
+        DELETE FROM user_directory
+        WHERE org_id = %s AND user_id = %s AND username <> %s
+    """, (org_id, user_id, username))
+
+    cur.execute("""
+        INSERT INTO user_directory (username, org_id, user_id)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (username) DO UPDATE
+            SET updated_at = CURRENT_TIMESTAMP
+            WHERE user_directory.org_id = EXCLUDED.org_id
+              AND user_directory.user_id = EXCLUDED.user_id
+    """, (username, org_id, user_id))
+
+    if cur.rowcount == 0:
+        raise ValueError(f"Username '{username}' is already taken")
+
+    # The user now has a username of their own
+    cur.execute("DELETE FROM user_directory_conflicts WHERE org_id = %s AND user_id = %s", (org_id, user_id))
+
+
+def username_taken(cur, username, org_id=None, user_id=None):
+    """True if `username` already belongs to a user other than the given tenant user"""
+    cur.execute("""
+        SELECT 1 FROM user_directory
+        WHERE username = %s AND (org_id, user_id) IS DISTINCT FROM (%s, %s)
+        UNION ALL
+        SELECT 1 FROM user_directory_conflicts
+        WHERE username = %s AND (org_id, user_id) IS DISTINCT FROM (%s, %s)
+    """, (username, org_id, user_id, username, org_id, user_id))
+    return cur.fetchone() is not None
+
+
+def create_mpesa_request_routes_table():
+    """Create the global CheckoutRequestID -> org routing table used by sales_mpesa_callback"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS mpesa_request_routes (
+                checkout_request_id VARCHAR(255) PRIMARY KEY,
+                org_id VARCHAR(4) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Backfill pending requests only when the table is empty (first start after the upgrade)
+        cur.execute("SELECT COUNT(*) FROM mpesa_request_routes")
+        count = cur.fetchone()[0]
+
+        if count == 0 and TENANCY_MODE == 'partitioned':
+            cur.execute("SELECT to_regclass(%s)", (shared_table('mpesa_requests'),))
+            if cur.fetchone()[0] is not None:
+                cur.execute(f"""
+                    INSERT INTO mpesa_request_routes (checkout_request_id, org_id)
+                    SELECT checkout_request_id, org_id FROM {shared_table('mpesa_requests')}
+                    WHERE status = 'Pending'
+                    ON CONFLICT (checkout_request_id) DO NOTHING
+                """)
+            print("M-PESA request routes backfilled.")
+        elif count == 0:
+            cur.execute("SELECT org_id FROM organizations")
+            for (org_id,) in cur.fetchall():
+                cur.execute("SELECT to_regclass(%s)", (f"{tenant_prefix(org_id)}mpesa_requests",))
+                if cur.fetchone()[0] is None:
+                    continue
+
+                cur.execute(f"""
+                    INSERT INTO mpesa_request_routes (checkout_request_id, org_id)
+                    SELECT checkout_request_id, %s FROM {tenant_prefix(org_id)}mpesa_requests
+                    WHERE status = 'Pending'
+                    ON CONFLICT (checkout_request_id) DO NOTHING
+                """, (org_id,))
+            print("M-PESA request routes backfilled.")
+
+
 # Current date function
 def get_current_date():
     return datetime.now().strftime('%Y-%m-%d')
@@ -1480,20 +2725,52 @@ def get_current_datetime():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def cached_lookup(org_id, name, loader):
+    """
+    Return the lookup list `name` for an org, calling loader() on a miss.
+    Entries are dropped when bump_lookup_version() is called for them or after LOOKUP_CACHE_TTL.
+    """
+    key = (org_id, name)
+    with lookup_cache_lock:
+        version = lookup_versions.get(key, 0)
+        entry = lookup_cache.get(key)
+    if entry and entry[0] == version and entry[1] > datetime.now():
+        return list(entry[2])
+
+    values = loader()
+    with lookup_cache_lock:
+        # Skip storing if a write bumped the version while we were loading
+        if lookup_versions.get(key, 0) == version:
+            lookup_cache[key] = (version, datetime.now() + timedelta(seconds=LOOKUP_CACHE_TTL), values)
+    return list(values)
+
+
+def bump_lookup_version(org_id, *names):
+    """Invalidate cached lookup lists after a committed write to their tables"""
+    with lookup_cache_lock:
+        for name in names:
+            key = (org_id, name)
+            lookup_versions[key] = lookup_versions.get(key, 0) + 1
+            lookup_cache.pop(key, None)
+
+
 def read_product_names():
     if 'org_id' not in session:
         raise ValueError("No organization ID found in session")
 
     org_id = session['org_id']
 
-    with get_db_connection2() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(f"SELECT DISTINCT product FROM {org_id}_products ORDER BY product;")
+    def load():
+        with get_db_connection2() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT DISTINCT product FROM {tenant_prefix(org_id)}products ORDER BY product;")
             return [row[0] for row in cursor.fetchall()]
-        except Exception as e:
-            print(f"Error reading product names: {e}")
-            return []
+
+    try:
+        return cached_lookup(org_id, 'product_names', load)
+    except Exception as e:
+        print(f"Error reading product names: {e}")
+        return []
 
 
 def read_categories():
@@ -1527,14 +2804,17 @@ def read_account_owners():
 
     org_id = session['org_id']
 
-    with get_db_connection2() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(f"SELECT DISTINCT account_owner FROM {org_id}_account_owner ORDER BY account_owner;")
+    def load():
+        with get_db_connection2() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT DISTINCT account_owner FROM {tenant_prefix(org_id)}account_owner ORDER BY account_owner;")
             return [row[0] for row in cursor.fetchall()]
-        except Exception as e:
-            print(f"Error reading account owners: {e}")
-            return []
+
+    try:
+        return cached_lookup(org_id, 'account_owners', load)
+    except Exception as e:
+        print(f"Error reading account owners: {e}")
+        return []
 
 
 def read_client_names():
@@ -1543,19 +2823,14 @@ def read_client_names():
 
     org_id = session['org_id']
 
-    try:
+    def load():
         with get_db_connection2() as conn:
             cursor = conn.cursor()
-            # Check if the table has any rows
-            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {org_id}_clients);")
-            has_rows = cursor.fetchone()[0]
-
-            if not has_rows:
-                return []  # Return empty list if no data
-
-            # Fetch only if the table is not empty
-            cursor.execute(f"SELECT customer_name FROM {org_id}_clients ORDER BY customer_name;")
+            cursor.execute(f"SELECT customer_name FROM {tenant_prefix(org_id)}clients ORDER BY customer_name;")
             return [row[0] for row in cursor.fetchall()]
+
+    try:
+        return cached_lookup(org_id, 'client_names', load)
     except Exception as e:
         print(f"Error reading customer_name: {e}")
         return []
@@ -1567,15 +2842,18 @@ def read_bank_accounts():
 
     org_id = session['org_id']
 
-    try:
+    def load():
         with get_db_connection2() as conn:
             cursor = conn.cursor()
             cursor.execute(f"""
                 SELECT account_name || '-' || bank_name 
-                FROM {org_id}_banks 
+                FROM {tenant_prefix(org_id)}banks 
                 ORDER BY account_name;
             """)
             return [row[0] for row in cursor.fetchall()]
+
+    try:
+        return cached_lookup(org_id, 'bank_accounts', load)
     except Exception as e:
         print(f"Error reading bank accounts: {e}")
         return []
@@ -1603,6 +2881,82 @@ def validate_password(password):
         return "Password must contain at least one special symbol (!@#$%^&*)."
 
 
+# Document templates: static letterhead, styles and table styles are built once per process
+# (web and PDF worker processes alike), so each render only lays out its own data.
+# Page streams are left zlib-compressed but not ASCII85-wrapped, which is slow in pure Python
+# and makes the files bigger.
+rl_config.useA85 = 0
+
+COMPANY_LETTERHEAD = (
+    "Brightwoods Apartment, Chania Ave",
+    "PO. Box 74080-00200, Nairobi, KENYA ",
+    "Phone: +254-705917383",
+    "Email: info@teknobyte.ltd",
+    "PIN: P051155522R",
+)
+document_styles = getSampleStyleSheet()
+NOTES_STYLE = ParagraphStyle(name='Notes', alignment=TA_LEFT, parent=document_styles["Normal"],
+                             fontName='Helvetica', fontSize=10, leading=14)
+ITEMS_COL_WIDTHS = [3 * inch, 1 * inch, 1.5 * inch, 1.5 * inch]
+ITEMS_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.gray),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+])
+INVOICE_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.gray),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+])
+
+
+def draw_letterhead(c, title):
+    """Company address block and document title"""
+    header = c.beginText(430, 730)
+    header.setFont("Helvetica", 8)
+    header.setLeading(10)
+    header.textLines(COMPANY_LETTERHEAD)
+    c.drawText(header)
+
+    c.setFont("Helvetica-Bold", 20)
+    c.drawString(280, 640, title)
+
+
+def draw_labelled_value(c, y, label, value):
+    """Bold label with its value in regular type alongside"""
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, y, label)
+    label_width = c.stringWidth(label, "Helvetica-Bold", 12)
+    c.setFont("Helvetica", 12)
+    c.drawString(50 + label_width + 5, y, value)
+
+
+def draw_items_table(c, data, table_style, col_widths=ITEMS_COL_WIDTHS):
+    """Draw the line items below the document details; returns the table height used for the totals"""
+    table = Table(data, colWidths=col_widths)
+    table.setStyle(table_style)
+    table_height = len(data) * 20
+    table.wrapOn(c, 0, 0)
+    table.drawOn(c, 50, 500 - table_height)
+    return table_height
+
+
+def draw_signature(c):
+    c.setFont("Helvetica", 12)
+    c.drawString(50, 200, "John Kungu")
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, 180, "ACCOUNTANT")
+
+
 # Generate Receipt function
 def generate_receipt(receipt_data, filename):
     """
@@ -1631,54 +2985,14 @@ def generate_receipt(receipt_data, filename):
         tuple: (filepath, BytesIO buffer)
     """
 
-    # Create canvas
     c = canvas.Canvas(filename, pagesize=letter)
-    styles = getSampleStyleSheet()
-    style_normal = styles["Normal"]
-
-    # Company information
-    address = "Brightwoods Apartment, Chania Ave"
-    city_state_zip = "PO. Box 74080-00200, Nairobi, KENYA "
-    phone = "Phone: +254-705917383"
-    email = "Email: info@teknobyte.ltd"
-    kra_pin = "PIN: P051155522R"
-
-    c.setFont("Helvetica", 8)
-    c.drawString(430, 740, "")
-    c.drawString(430, 730, address)
-    c.drawString(430, 720, city_state_zip)
-    c.drawString(430, 710, phone)
-    c.drawString(430, 700, email)
-    c.drawString(430, 690, kra_pin)
-    c.drawString(430, 660, "")
-
-    # Receipt title
-    c.setFont("Helvetica-Bold", 20)
-    c.drawString(280, 640, "Receipt")
+    draw_letterhead(c, "Receipt")
 
     # Receipt details
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 620, "")
     c.drawString(50, 600, f"Date: {receipt_data['payment_date'].strftime('%d-%m-%Y')}")
-    receipt_label = "Receipt No:"
-
-    invoice_label = "Invoice No:"
-    invoice_number = receipt_data['invoice_no']
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 580, invoice_label)
-    label_width = c.stringWidth(invoice_label)
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 580, invoice_number)
-
-    c.drawString(50, 560, "")
-    client_label = "Client: "
-    client_name = receipt_data['customer_name']
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 540, client_label)
-
-    label_width = c.stringWidth(client_label, "Helvetica-Bold", 12)
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 540, client_name)
+    draw_labelled_value(c, 580, "Invoice No:", receipt_data['invoice_no'])
+    draw_labelled_value(c, 540, "Client: ", receipt_data['customer_name'])
 
     # Items table
     table_data = [
@@ -1691,35 +3005,14 @@ def generate_receipt(receipt_data, filename):
             f"Ksh {item['unit_price']:,.2f}",
             f"Ksh {item['total']:,.2f}"
         ])
-
-    table = Table(table_data,
-                  colWidths=[3 * inch, 1 * inch, 1.5 * inch, 1.5 * inch],
-                  )
-
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.gray),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-    ]))
-
-    table_height = len(table_data) * 20
-    table.wrapOn(c, 0, 0)
-    table.drawOn(c, 50, 500 - table_height)
+    table_height = draw_items_table(c, table_data, ITEMS_TABLE_STYLE)
 
     # Add total amount
     c.setFont("Helvetica-Bold", 12)
     c.drawString(400, 480 - table_height, f"Total Paid: {receipt_data['amount_paid']:,.2f} ")
     c.drawString(400, 460 - table_height, f"Balance: {receipt_data['new_bal']:,.2f} ")
 
-    c.setFont("Helvetica", 12)
-    c.drawString(50, 200, "John Kungu")
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 180, "ACCOUNTANT")
-
+    draw_signature(c)
     c.save()
 
 
@@ -1761,30 +3054,36 @@ def org_login():
                 return redirect(url_for('admin_dashboard'))
 
             else:
-                # Not a superuser, search in all tenant users tables
-                cur.execute("SELECT org_id FROM organizations WHERE is_active = TRUE")
-                org_ids = cur.fetchall()
+                # Not a superuser, resolve the tenant from the username directory. A username
+                # shared by several users is only in user_directory_conflicts; the password decides
+                cur.execute("""
+                    SELECT d.org_id, d.user_id
+                    FROM user_directory d
+                    JOIN organizations o ON o.org_id = d.org_id
+                    WHERE d.username = %s AND o.is_active = TRUE
+                    UNION ALL
+                    SELECT c.org_id, c.user_id
+                    FROM user_directory_conflicts c
+                    JOIN organizations o ON o.org_id = c.org_id
+                    WHERE c.username = %s AND o.is_active = TRUE
+                """, (username, username))
+                directory_entries = cur.fetchall()
 
                 user_found = None
                 user_org_id = None
 
-                for (org_id,) in org_ids:
-                    try:
-                        cur.execute(f"""
-                            SELECT user_id, username, full_name, email, role, password, status, org_id
-                            FROM {org_id}_users 
-                            WHERE username = %s AND status = 'Active'
-                        """, (username,))
-                        tenant_user = cur.fetchone()
-
-                        if tenant_user and check_password_hash(tenant_user[5], password):
-                            user_found = tenant_user
-                            user_org_id = org_id
-                            break
-
-                    except Exception as e:
-                        # Skip if tenant table doesn't exist or other error
-                        continue
+                for org_id, directory_user_id in directory_entries:
+                    cur.execute(f"""
+                        SELECT user_id, username, full_name, email, role, password, status, org_id
+                        FROM {tenant_prefix(org_id)}users
+                        WHERE user_id = %s AND username = %s AND status = 'Active'
+                    """, (directory_user_id, username))
+                    tenant_user = cur.fetchone()
+
+                    if tenant_user and check_password_hash(tenant_user[5], password):
+                        user_found = tenant_user
+                        user_org_id = org_id
+                        break
 
                 if user_found:
                     user_id, username, full_name, email, role, password_hash, status, org_id = user_found
@@ -1817,48 +3116,94 @@ def org_login():
     return render_template('login.html')
 
 
-def check_org_subscription(org_id):
-    """Check if organization has an active subscription"""
-    try:
-        with get_db_connection2() as conn:
-            cur = conn.cursor()
-            # Get the superuser for this organization
-            cur.execute("""
-                SELECT superuser_id FROM organizations WHERE org_id = %s
-            """, (org_id,))
-            org_result = cur.fetchone()
-            if not org_result:
-                return {'active': False, 'message': 'Organization not found'}
+def get_cached_subscription(org_id):
+    """Return the cached subscription status for an org, or None if missing/expired"""
+    with subscription_cache_lock:
+        entry = subscription_cache.get(org_id)
+        if not entry:
+            return None
+        expires_at, status = entry
+        if expires_at <= datetime.now():
+            del subscription_cache[org_id]
+            return None
+        return status
 
-            superuser_id = org_result[0]
 
-            # Check subscription for the superuser (organization owner)
-            cur.execute("""
-                SELECT subscription_id, start_date, end_date, status 
-                FROM subscriptions 
-                WHERE user_id = %s 
-                ORDER BY end_date DESC 
-                LIMIT 1
-            """, (superuser_id,))
-            subscription = cur.fetchone()
+def cache_subscription(org_id, status):
+    """Cache a subscription status; active entries never outlive their end_date"""
+    now = datetime.now()
+    if status.get('active'):
+        expires_at = now + timedelta(seconds=SUBSCRIPTION_CACHE_TTL)
+        # end_date is inclusive, so the subscription lapses at the following midnight
+        end_of_subscription = datetime.combine(status['end_date'] + timedelta(days=1), datetime.min.time())
+        expires_at = min(expires_at, end_of_subscription)
+    else:
+        expires_at = now + timedelta(seconds=SUBSCRIPTION_CACHE_INACTIVE_TTL)
+    with subscription_cache_lock:
+        subscription_cache[org_id] = (expires_at, status)
 
-            if not subscription:
-                return {'active': False, 'message': 'No subscription found for organization'}
 
-            subscription_id, start_date, end_date, status = subscription
-            current_date = datetime.now().date()
+def invalidate_subscription_cache(*org_ids):
+    """Drop cached subscription status for the given orgs"""
+    with subscription_cache_lock:
+        for org_id in org_ids:
+            subscription_cache.pop(org_id, None)
 
-            if status == 'active' and end_date >= current_date:
-                return {'active': True, 'end_date': end_date, 'org_id': org_id}
-            else:
-                return {'active': False, 'message': 'Organization subscription expired', 'end_date': end_date}
 
+def load_org_subscription(org_id):
+    """Read an organization's subscription status from the database"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        # Get the superuser for this organization
+        cur.execute("""
+            SELECT superuser_id FROM organizations WHERE org_id = %s
+        """, (org_id,))
+        org_result = cur.fetchone()
+        if not org_result:
+            return {'active': False, 'message': 'Organization not found'}
+
+        superuser_id = org_result[0]
+
+        # Check subscription for the superuser (organization owner)
+        cur.execute("""
+            SELECT subscription_id, start_date, end_date, status 
+            FROM subscriptions 
+            WHERE user_id = %s 
+            ORDER BY end_date DESC 
+            LIMIT 1
+        """, (superuser_id,))
+        subscription = cur.fetchone()
+
+        if not subscription:
+            return {'active': False, 'message': 'No subscription found for organization'}
+
+        subscription_id, start_date, end_date, status = subscription
+        current_date = datetime.now().date()
+
+        if status == 'active' and end_date >= current_date:
+            return {'active': True, 'end_date': end_date, 'org_id': org_id}
+        else:
+            return {'active': False, 'message': 'Organization subscription expired', 'end_date': end_date}
+
+
+def check_org_subscription(org_id):
+    """Check if organization has an active subscription"""
+    status = get_cached_subscription(org_id)
+    if status is not None:
+        return status
+
+    try:
+        status = load_org_subscription(org_id)
     except Exception as e:
         log_error_to_file(
             f"check_org_subscription error (org_id={org_id}): {str(e)}\n{traceback.format_exc()}"
         )
+        # Errors are not cached so the next request retries the database
         return {'active': False, 'message': f'Error checking subscription: {str(e)}'}
 
+    cache_subscription(org_id, status)
+    return status
+
 
 # Superuser dashboard route
 # @app.route('/superuser_dashboard')
@@ -1893,6 +3238,17 @@ def superuser_dashboard():
     #                        products=products)
 
 
+@app.route('/superuser/pool_metrics')
+def pool_metrics():
+    """Database pool metrics for operators"""
+    if 'user_id' not in session or session.get('role') != 1:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    metrics = get_pool_metrics()
+    metrics['prepared_statements'] = get_prepared_statement_metrics()
+    return jsonify(metrics)
+
+
 # Admin dashboard route
 @app.route('/admin_dashboard')
 def admin_dashboard():
@@ -1995,7 +3351,7 @@ def initiate_payment():
             password = base64.b64encode(password_string.encode()).decode()
 
             # STK Push request
-            stk_url = "https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
+            stk_url = f"{MPESA_API_BASE_URL}/mpesa/stkpush/v1/processrequest"
 
             headers = {
                 'Authorization': f'Bearer {access_token}',
@@ -2016,7 +3372,7 @@ def initiate_payment():
                 "TransactionDesc": f"{product_name} Subscription"
             }
 
-            response = requests.post(stk_url, json=payload, headers=headers)
+            response = mpesa_http.post(stk_url, json=payload, headers=headers, timeout=MPESA_HTTP_TIMEOUT)
             response_data = response.json()
 
             if response_data.get('ResponseCode') == '0':
@@ -2093,6 +3449,7 @@ def mpesa_callback():
 
             print(
                 f"Extracted - Amount: {amount}, Receipt: {mpesa_receipt_number}, Phone: {phone_number}, Date: {transaction_date}")  # Debug logging
+            renewed_org_ids = []
             with get_db_connection2() as conn:
                 cur = conn.cursor()
                 # Update transaction status
@@ -2148,6 +3505,12 @@ def mpesa_callback():
                                 VALUES (%s, %s, %s, %s, %s, 'active')
                             """, (user_id, product_id, start_date, end_date, amount))
 
+                        # Organizations owned by this user read their status from this subscription
+                        cur.execute("""
+                            SELECT org_id FROM organizations WHERE superuser_id = %s
+                        """, (user_id,))
+                        renewed_org_ids = [row[0] for row in cur.fetchall()]
+
                         cur.execute("""
                                            SELECT org_id FROM org_users WHERE user_id = %s
                                        """, (user_id,))
@@ -2155,6 +3518,7 @@ def mpesa_callback():
 
                         if org_row:
                             org_id = org_row[0]
+                            renewed_org_ids.append(org_id)
                             print(f"Creating tenant tables for org_id: {org_id}")
                             create_tenant_tables(org_id)  # ✅ Create tenant-specific tables
                         else:
@@ -2166,6 +3530,9 @@ def mpesa_callback():
                 else:
                     print(f"Transaction with checkout_request_id {checkout_request_id} not found")
 
+            # Invalidate only after the subscription change has been committed
+            invalidate_subscription_cache(*renewed_org_ids)
+
         else:  # Failed
             error_message = stk_callback.get('ResultDesc', 'Unknown error')
             print(f"Payment failed: {error_message}")
@@ -2224,6 +3591,95 @@ def sales_reports_menu():
     return render_template('sales_reports_menu.html')
 
 
+def upsert_sales_list_total(cursor, org_id, invoice_number, customer_name, invoice_date, category,
+                            account_owner, reference_no=None):
+    """Create or refresh an invoice's sales_list row from the sum of its sales lines in one statement"""
+    cursor.execute(f"""
+        INSERT INTO {tenant_prefix(org_id)}sales_list (
+            customer_name, invoice_no, invoice_date, invoice_amount, 
+            paid_amount, balance, payment_status, category, account_owner, reference_no
+        )
+        SELECT %s, %s, %s, COALESCE(SUM(total), 0), 0, COALESCE(SUM(total), 0), 'Not Paid', %s, %s, %s
+        FROM {tenant_prefix(org_id)}sales WHERE invoice_no = %s
+        ON CONFLICT (invoice_no) DO UPDATE
+            SET invoice_amount = EXCLUDED.invoice_amount,
+                balance = EXCLUDED.invoice_amount - {tenant_prefix(org_id)}sales_list.paid_amount
+        RETURNING invoice_amount
+    """, (customer_name, invoice_number, invoice_date, category, account_owner, reference_no, invoice_number))
+    return cursor.fetchone()[0]
+
+
+def backfill_recurring_invoices(cursor, org_id, due_dates, product, quantity, price, total, customer_name,
+                                category, account_owner, bank_account, reference_no, notes='', render_pdfs=True):
+    """
+    Create one invoice per due date for a recurring sales account.
+    Invoice numbers are reserved in one block, every period is written with one multi-row
+    statement per table, and the PDFs are queued to the render pool in parallel.
+    Returns [{'date', 'invoice_no', 'filename'}] in due-date order.
+    """
+    if not due_dates:
+        return []
+
+    invoice_numbers = allocate_invoice_numbers(org_id, len(due_dates))
+    periods = list(zip(due_dates, invoice_numbers))
+    current_datetime = datetime.now()
+
+    rows = execute_values(cursor, f"""
+        INSERT INTO {tenant_prefix(org_id)}sales (
+            invoice_date, invoice_no, customer_name, product, quantity, 
+            price, total, date_created, category, account_owner, 
+            sales_acc_invoice_no, bank_account
+        ) VALUES %s
+        RETURNING invoice_no, total
+    """, [
+        (due_date, invoice_no, customer_name, product, quantity, price, total,
+         current_datetime, category, account_owner, reference_no, bank_account)
+        for due_date, invoice_no in periods
+    ], page_size=len(periods), fetch=True)
+    invoice_totals = dict(rows)
+
+    execute_values(cursor, f"""
+        INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
+        VALUES %s
+        ON CONFLICT (invoice_number) DO NOTHING
+    """, [(invoice_no, current_datetime) for _, invoice_no in periods], page_size=len(periods))
+
+    execute_values(cursor, f"""
+        INSERT INTO {tenant_prefix(org_id)}sales_list (
+            customer_name, invoice_no, invoice_date, invoice_amount, 
+            paid_amount, balance, payment_status, category, account_owner, reference_no
+        ) VALUES %s
+    """, [
+        (customer_name, invoice_no, due_date, invoice_totals[invoice_no], 0, invoice_totals[invoice_no],
+         'Not Paid', category, account_owner, reference_no)
+        for due_date, invoice_no in periods
+    ], page_size=len(periods))
+
+    generated = []
+    for due_date, invoice_no in periods:
+        filename = None
+        if render_pdfs:
+            invoice_data = {
+                'customer_name': customer_name,
+                'invoice_number': invoice_no,
+                'invoice_date': due_date.strftime('%d/%m/%Y'),
+                'items': [{
+                    'description': product,
+                    'quantity': quantity,
+                    'unit_price': price,
+                    'total': total
+                }],
+                'total_amount': total,
+                'notes': notes,
+                'payment_status': 'Not Paid'
+            }
+            sanitized_invoice_no = re.sub(r'[^a-zA-Z0-9]', '_', invoice_no)
+            filename = f"invoice_{sanitized_invoice_no}.pdf"
+            submit_render(create_invoice, invoice_data, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        generated.append({'date': due_date, 'invoice_no': invoice_no, 'filename': filename})
+    return generated
+
+
 @app.route('/sales/entry', methods=['GET', 'POST'])
 def sales_entry():
     # Check for org_id in session
@@ -2259,7 +3715,9 @@ def sales_entry():
             # Get institution of selected client
             with get_db_connection2() as conn:
                 cursor = conn.cursor()
-                cursor.execute(f"SELECT institution FROM {org_id}_clients WHERE customer_name = %s", (client_name,))
+                execute_prepared(cursor, org_id, 'client_institution', f"""
+                    SELECT institution FROM {tenant_prefix(org_id)}clients WHERE customer_name = %s
+                """, (client_name,))
                 result = cursor.fetchone()
                 institution = result[0] if result else ""
 
@@ -2290,7 +3748,9 @@ def sales_entry():
                 with get_db_connection2() as conn:
                     cursor = conn.cursor()
 
-                    cursor.execute(f"SELECT frequency FROM {org_id}_products WHERE product = %s", (product,))
+                    execute_prepared(cursor, org_id, 'product_frequency', f"""
+                        SELECT frequency FROM {tenant_prefix(org_id)}products WHERE product = %s
+                    """, (product,))
                     product_frequency = cursor.fetchone()
                     if product_frequency is None:
                         return jsonify(
@@ -2307,8 +3767,8 @@ def sales_entry():
 
                     # Handle occasional products (immediate sale)
                     if frequency == 'Occasional':
-                        cursor.execute(f"""
-                            INSERT INTO {org_id}_sales (
+                        execute_prepared(cursor, org_id, 'insert_sale', f"""
+                            INSERT INTO {tenant_prefix(org_id)}sales (
                                 invoice_date, invoice_no, customer_name, product, quantity, 
                                 price, total, date_created, category, account_owner, 
                                 sales_acc_invoice_no, bank_account
@@ -2320,51 +3780,25 @@ def sales_entry():
                         ))
 
                         # Insert or update invoice in invoices table
-                        cursor.execute(f"""
-                            INSERT INTO {org_id}_invoices (invoice_number, created_at)
+                        execute_prepared(cursor, org_id, 'insert_invoice_number', f"""
+                            INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                             VALUES (%s, %s)
                             ON CONFLICT (invoice_number) DO NOTHING
                         """, (invoice_number, current_datetime))
 
-                        # Calculate the total for this invoice
-                        cursor.execute(f"""
-                            SELECT SUM(total) FROM {org_id}_sales WHERE invoice_no = %s
-                        """, (invoice_number,))
-                        invoice_total = cursor.fetchone()[0] or 0
-
-                        # Check if this invoice already exists in sales_list
-                        cursor.execute(f"""
-                            SELECT COUNT(*) FROM {org_id}_sales_list WHERE invoice_no = %s
-                        """, (invoice_number,))
-                        exists = cursor.fetchone()[0] > 0
-
-                        if exists:
-                            cursor.execute(f"""
-                                UPDATE {org_id}_sales_list 
-                                SET invoice_amount = %s, 
-                                    balance = %s
-                                WHERE invoice_no = %s
-                            """, (invoice_total, invoice_total, invoice_number))
-                        else:
-                            cursor.execute(f"""
-                                INSERT INTO {org_id}_sales_list (
-                                    customer_name, invoice_no, invoice_date, invoice_amount, 
-                                    paid_amount, balance, payment_status, category, account_owner, reference_no
-                                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            """, (
-                                customer_name, invoice_number, invoice_date.date(), invoice_total,
-                                0, invoice_total, 'Not Paid', category, account_owner, None
-                            ))
+                        # Recalculate the invoice total in sales_list
+                        upsert_sales_list_total(cursor, org_id, invoice_number, customer_name,
+                                                invoice_date.date(), category, account_owner)
 
                     # Handle recurring products (Monthly, Quarterly, Annual)
                     elif frequency in ['Monthly', 'Quarterly', 'Annual']:
-                        cursor.execute(f"SELECT MAX(sales_acc_id) FROM {org_id}_sales_account;")
+                        cursor.execute(f"SELECT MAX(sales_acc_id) FROM {tenant_prefix(org_id)}sales_account;")
                         max_result = cursor.fetchone()
                         last_sales_acc_id = max_result[0] if max_result and max_result[0] is not None else 0
                         sales_acc_id = last_sales_acc_id + 1
 
                         cursor.execute(f"""
-                            INSERT INTO {org_id}_sales_account (
+                            INSERT INTO {tenant_prefix(org_id)}sales_account (
                                 sales_acc_id, invoice_date, invoice_number, customer_name, 
                                 product, quantity, price, total, created_at, 
                                 category, account_owner, frequency, status, bank_account
@@ -2382,7 +3816,7 @@ def sales_entry():
                         sales_acc_invoice_no = result[0]
 
                         cursor.execute(f"""
-                            INSERT INTO {org_id}_invoices (invoice_number, created_at)
+                            INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                             VALUES (%s, %s)
                             ON CONFLICT (invoice_number) DO NOTHING
                         """, (sales_acc_invoice_no, current_datetime))
@@ -2399,70 +3833,15 @@ def sales_entry():
                             delta = None
 
                         if delta:
-                            next_due_date = invoice_date.date()
-                            pdf_urls = []
-
-                            while next_due_date <= today + delta:
-                                new_invoice_number = generate_next_invoice_number()
-
-                                cursor.execute(f"""
-                                    INSERT INTO {org_id}_sales (
-                                        invoice_date, invoice_no, customer_name, product, quantity, 
-                                        price, total, date_created, category, account_owner, 
-                                        sales_acc_invoice_no, bank_account
-                                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                """, (
-                                    next_due_date, new_invoice_number, customer_name, product, quantity,
-                                    price, total, current_datetime, category, account_owner,
-                                    sales_acc_invoice_no, bank_account
-                                ))
-
-                                cursor.execute(f"""
-                                    INSERT INTO {org_id}_invoices (invoice_number, created_at)
-                                    VALUES (%s, %s)
-                                    ON CONFLICT (invoice_number) DO NOTHING
-                                """, (new_invoice_number, current_datetime))
-
-                                cursor.execute(f"""
-                                    SELECT SUM(total) FROM {org_id}_sales WHERE invoice_no = %s
-                                """, (new_invoice_number,))
-                                invoice_total = cursor.fetchone()[0] or 0
-
-                                cursor.execute(f"""
-                                    INSERT INTO {org_id}_sales_list (
-                                        customer_name, invoice_no, invoice_date, invoice_amount, 
-                                        paid_amount, balance, payment_status, category, account_owner, reference_no
-                                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                """, (
-                                    customer_name, new_invoice_number, next_due_date, invoice_total,
-                                    0, invoice_total, 'Not Paid', category, account_owner, sales_acc_invoice_no
-                                ))
-
-                                invoice_data = {
-                                    'customer_name': customer_name,
-                                    'invoice_number': new_invoice_number,
-                                    'invoice_date': next_due_date.strftime('%d/%m/%Y'),
-                                    'items': [{
-                                        'description': product,
-                                        'quantity': quantity,
-                                        'unit_price': price,
-                                        'total': total
-                                    }],
-                                    'total_amount': total,
-                                    'notes': notes,
-                                    'payment_status': 'Not Paid'
-                                }
-
-                                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                                sanitized_invoice_no = re.sub(r'[^a-zA-Z0-9]', '_', new_invoice_number)
-                                filename = f"invoice_{sanitized_invoice_no}.pdf"
-                                create_invoice(invoice_data, os.path.join(app.config['UPLOAD_FOLDER'], filename))
-
-                                pdf_urls.append({
-                                    'date': next_due_date.strftime('%d/%m/%Y'),
-                                    'url': url_for('download_invoice', filename=filename)
-                                })
-                                next_due_date += delta
+                            due_dates = recurring_due_dates(invoice_date.date(), delta, today + delta)
+                            generated = backfill_recurring_invoices(
+                                cursor, org_id, due_dates, product, quantity, price, total, customer_name,
+                                category, account_owner, bank_account, sales_acc_invoice_no, notes
+                            )
+                            pdf_urls = [{
+                                'date': invoice['date'].strftime('%d/%m/%Y'),
+                                'url': url_for('download_invoice', filename=invoice['filename'])
+                            } for invoice in generated]
 
                             return jsonify({
                                 'status': 'success',
@@ -2473,7 +3852,7 @@ def sales_entry():
 
                     cursor.execute(f"""
                         SELECT product as description, quantity, price as unit_price, total
-                        FROM {org_id}_sales WHERE invoice_no = %s ORDER BY sales_id
+                        FROM {tenant_prefix(org_id)}sales WHERE invoice_no = %s ORDER BY sales_id
                     """, (invoice_number,))
                     items_result = cursor.fetchall()
                     columns = [desc[0] for desc in cursor.description]
@@ -2492,7 +3871,7 @@ def sales_entry():
                     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
                     sanitized_invoice_no = re.sub(r'[^a-zA-Z0-9]', '_', invoice_number)
                     filename = f"invoice_{sanitized_invoice_no}.pdf"
-                    create_invoice(invoice_data, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                    submit_render(create_invoice, invoice_data, os.path.join(app.config['UPLOAD_FOLDER'], filename))
 
                     response = {
                         'status': 'success',
@@ -2519,7 +3898,7 @@ def sales_entry():
                 return jsonify({'status': 'error', 'message': f'An error occurred: {str(e)}'}), 500
 
     product_names = read_product_names()
-    next_invoice_number = generate_next_invoice_number()
+    next_invoice_number = peek_next_invoice_number(org_id)
     categories = read_categories()
     accounts = read_account_owners()
     client_names = read_client_names()
@@ -2541,34 +3920,937 @@ def sales_entry():
                            date_created=date_created)
 
 
-# Download invoice route
-@app.route('/invoices/<filename>')
-def download_invoice(filename):
+@app.route('/sales/entry/invoice', methods=['POST'])
+def save_sales_invoice():
+    """
+    Save a whole invoice (all line items) in one request.
+    Expects JSON: invoice_date (YYYY-MM-DD), client_name, category, account, bank_account,
+    optional invoice_number, notes, transaction_type and items [{product, quantity, price}].
+    Uses a fixed number of statements regardless of how many lines the invoice has.
+    """
+    if 'org_id' not in session:
+        return jsonify({'status': 'error', 'message': 'Session expired. Please login again.'}), 401
+
+    org_id = session['org_id']
+    data = request.get_json(silent=True) or {}
+    items = data.get('items') or []
+
+    if not items:
+        return jsonify({'status': 'error', 'message': 'At least one item is required'}), 400
+
+    try:
+        invoice_date = datetime.strptime(data.get('invoice_date'), '%Y-%m-%d')
+        customer_name = data.get('client_name')
+        category = data.get('category')
+        account_owner = data.get('account')
+        bank_account = data.get('bank_account', '')
+        notes = data.get('notes', '')
+        transaction_type = data.get('transaction_type')
+        invoice_number = data.get('invoice_number') or generate_next_invoice_number_for_org(org_id)
+        current_datetime = datetime.now()
+
+        lines = []
+        for item in items:
+            quantity = int(item['quantity'])
+            price = float(item['price'])
+            if item.get('transaction_type', transaction_type) == 'take_back':
+                quantity = -abs(quantity)
+            lines.append((item['product'], quantity, price, round(quantity * price, 2)))
+
+        with get_db_connection2() as conn:
+            cursor = conn.cursor()
+
+            # One lookup for every product on the invoice
+            product_list = list({line[0] for line in lines})
+            cursor.execute(f"""
+                SELECT DISTINCT ON (product) product, frequency FROM {tenant_prefix(org_id)}products 
+                WHERE product = ANY(%s)
+            """, (product_list,))
+            frequencies = dict(cursor.fetchall())
+
+            missing = [product for product in product_list if product not in frequencies]
+            if missing:
+                return jsonify({'status': 'error',
+                                'message': f'Products not found in database: {", ".join(missing)}'}), 400
+
+            recurring = [product for product in product_list if frequencies[product] != 'Occasional']
+            if recurring:
+                return jsonify({'status': 'error',
+                                'message': f'Recurring products must be entered one at a time: '
+                                           f'{", ".join(recurring)}'}), 400
+
+            # All lines in one multi-row insert
+            execute_values(cursor, f"""
+                INSERT INTO {tenant_prefix(org_id)}sales (
+                    invoice_date, invoice_no, customer_name, product, quantity, 
+                    price, total, date_created, category, account_owner, 
+                    sales_acc_invoice_no, bank_account
+                ) VALUES %s
+            """, [
+                (invoice_date, invoice_number, customer_name, product, quantity, price, total,
+                 current_datetime, category, account_owner, None, bank_account)
+                for product, quantity, price, total in lines
+            ], page_size=len(lines))
+
+            cursor.execute(f"""
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
+                VALUES (%s, %s)
+                ON CONFLICT (invoice_number) DO NOTHING
+            """, (invoice_number, current_datetime))
+
+            upsert_sales_list_total(cursor, org_id, invoice_number, customer_name,
+                                    invoice_date.date(), category, account_owner)
+
+            # Lines saved earlier against the same invoice number are included in the PDF
+            cursor.execute(f"""
+                SELECT product as description, quantity, price as unit_price, total
+                FROM {tenant_prefix(org_id)}sales WHERE invoice_no = %s ORDER BY sales_id
+            """, (invoice_number,))
+            columns = [desc[0] for desc in cursor.description]
+            all_items = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        invoice_data = {
+            'customer_name': customer_name,
+            'invoice_number': invoice_number,
+            'invoice_date': invoice_date.strftime('%d-%m-%Y'),
+            'items': all_items,
+            'total_amount': sum(item['total'] for item in all_items),
+            'notes': notes,
+            'payment_status': 'Not Paid'
+        }
+
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        sanitized_invoice_no = re.sub(r'[^a-zA-Z0-9]', '_', invoice_number)
+        filename = f"invoice_{sanitized_invoice_no}.pdf"
+        submit_render(create_invoice, invoice_data, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+
+        return jsonify({
+            'status': 'success',
+            'message': 'Sales saved successfully!',
+            'invoice_url': url_for('download_invoice', filename=filename),
+            'invoice_number': invoice_number,
+            'current_items': all_items
+        })
+
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid invoice data: {str(e)}'}), 400
+    except Exception as e:
+        app.logger.error(f"Error saving invoice: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'An error occurred: {str(e)}'}), 500
+
+
+@contextmanager
+def render_folder_lock(filepath):
+    """Exclusive lock, across processes, on publishing renders into filepath's folder"""
+    with open(os.path.join(os.path.dirname(filepath) or '.', '.render.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_render_token(filepath):
+    try:
+        with open(f"{filepath}.pending") as marker:
+            return marker.read()
+    except FileNotFoundError:
+        return None
+
+
+def render_document(render_func, data, filepath, token):
+    """
+    Render a PDF to a temporary file and move it into place, so downloads never see
+    a partial document. Only the render whose token is still in the pending marker
+    written by submit_render() is published (and removes the marker); a render that
+    a newer submit_render() of the same file superseded is discarded.
+    """
+    tmp_path = f"{filepath}.{os.getpid()}.{token}.tmp"
+    rendered = False
+    try:
+        render_func(data, tmp_path)
+        rendered = True
+    finally:
+        with render_folder_lock(filepath):
+            # A failed render still releases waiters, unless a newer render is on its way
+            if read_render_token(filepath) == token:
+                if rendered:
+                    os.replace(tmp_path, filepath)
+                os.remove(f"{filepath}.pending")
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_pdf_executor():
+    """Process pool for ReportLab renders (CPU-bound), started on first use"""
+    global pdf_executor
+    with pdf_executor_lock:
+        if pdf_executor is None:
+            pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return pdf_executor
+
+
+def log_render_failure(filepath, future):
+    if future.exception() is not None:
+        log_error_to_file(f"PDF render failed for {filepath}: {future.exception()}")
+
+
+def submit_render(render_func, data, filepath):
+    """
+    Queue a PDF render (create_invoice, generate_receipt, create_payment) and return at once.
+    A `.pending` marker next to the file tells download routes in any process to wait for it.
+    The marker holds a token for this render, so when the same file is queued again the
+    newest render wins, whichever finishes last.
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    token = secrets.token_hex(8)
+    with render_folder_lock(filepath):
+        with open(f"{filepath}.pending", 'w') as marker:
+            marker.write(token)
+
+    if PDF_WORKERS <= 0:
+        render_document(render_func, data, filepath, token)
+        return None
+
+    try:
+        future = get_pdf_executor().submit(render_document, render_func, data, filepath, token)
+    except Exception:
+        with render_folder_lock(filepath):
+            if read_render_token(filepath) == token:
+                os.remove(f"{filepath}.pending")
+        raise
+    future.add_done_callback(lambda f: log_render_failure(filepath, f))
+    return future
+
+
+def wait_for_render(folder, filename, timeout=None):
+    """Wait until a queued render of folder/filename is finished; False if it is still running"""
+    marker = os.path.join(folder, f"{filename}.pending")
+    deadline = time.monotonic() + (PDF_RENDER_WAIT if timeout is None else timeout)
+    while os.path.exists(marker):
+        try:
+            # A marker left behind by a crashed worker should not block downloads forever
+            if time.time() - os.path.getmtime(marker) > PDF_RENDER_STALE:
+                return True
+        except FileNotFoundError:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def send_rendered_document(folder, filename, as_attachment=True):
+    """Serve a generated PDF, or a 202 placeholder while its render is still queued"""
+    if not wait_for_render(folder, secure_filename(filename)):
+        response = make_response("The document is still being generated. Please try again shortly.", 202)
+        response.headers['Retry-After'] = '2'
+        return response
+
     return send_from_directory(
-        app.config['UPLOAD_FOLDER'],
+        folder,
         filename,
-        as_attachment=True
+        as_attachment=as_attachment
     )
 
 
+def create_document_cache_table():
+    """Create the manifest of cached, regenerable documents"""
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS document_cache (
+                cache_key VARCHAR(64) PRIMARY KEY,
+                org_id VARCHAR(4) NOT NULL,
+                doc_type VARCHAR(50) NOT NULL,
+                doc_ref VARCHAR(255) NOT NULL,
+                folder VARCHAR(255) NOT NULL,
+                filename VARCHAR(255) NOT NULL,
+                size_bytes BIGINT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_accessed TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_document_cache_last_accessed 
+            ON document_cache (last_accessed)
+        """)
+
+
+def document_cache_key(org_id, doc_type, data):
+    """Hash of everything that ends up in the rendered document"""
+    payload = json.dumps({'org_id': org_id, 'doc_type': doc_type, 'data': data}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def record_cached_document(cache_key, org_id, doc_type, doc_ref, folder, filename):
+    """Add a rendered document to the manifest or mark it as used, evicting LRU entries when new"""
+    size_bytes = os.path.getsize(os.path.join(folder, filename))
+    with get_db_connection2() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO document_cache (cache_key, org_id, doc_type, doc_ref, folder, filename, size_bytes)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET last_accessed = CURRENT_TIMESTAMP
+            RETURNING (xmax = 0)
+        """, (cache_key, org_id, doc_type, doc_ref, folder, filename, size_bytes))
+        inserted = cur.fetchone()[0]
+
+        if not inserted:
+            return
+
+        # Keep the most recently used documents that fit in DOCUMENT_CACHE_MAX_BYTES
+        cur.execute("""
+            DELETE FROM document_cache WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key,
+                           SUM(size_bytes) OVER (ORDER BY last_accessed DESC, cache_key) AS retained_bytes
+                    FROM document_cache
+                ) ranked
+                WHERE retained_bytes > %s AND cache_key <> %s
+            )
+            RETURNING folder, filename
+        """, (DOCUMENT_CACHE_MAX_BYTES, cache_key))
+        evicted = cur.fetchall()
+
+    for evicted_folder, evicted_filename in evicted:
+        try:
+            os.remove(os.path.join(evicted_folder, evicted_filename))
+        except FileNotFoundError:
+            pass
+
+
+def queue_cached_document(org_id, doc_type, render_func, data, folder):
+    """
+    Start rendering `data` unless a document with the same content hash exists or is being
+    rendered. Concurrent requests for the same content share one render: threads in this
+    process via a lock stripe, other processes via the .pending marker.
+    Returns (cache_key, filename).
+    """
+    cache_key = document_cache_key(org_id, doc_type, data)
+    filename = f"{doc_type}_{cache_key}.pdf"
+    filepath = os.path.join(folder, filename)
+
+    with document_locks[int(cache_key[:8], 16) % len(document_locks)]:
+        if not os.path.exists(filepath) and not os.path.exists(f"{filepath}.pending"):
+            submit_render(render_func, data, filepath)
+
+    return cache_key, filename
+
+
+def get_cached_document(org_id, doc_type, doc_ref, render_func, data, folder):
+    """
+    Return the filename of a document rendered from `data`, rendering it only when needed.
+    Returns (filename, ready); ready is False if the render is still running.
+    """
+    cache_key, filename = queue_cached_document(org_id, doc_type, render_func, data, folder)
+
+    if not wait_for_render(folder, filename) or not os.path.exists(os.path.join(folder, filename)):
+        return filename, False
+
+    record_cached_document(cache_key, org_id, doc_type, doc_ref, folder, filename)
+    return filename, True
+
+
+def build_invoice_view_data(invoice_number, sales_items):
+    """
+    Invoice data for the preview/export PDFs from the invoice's sales lines:
+    (customer_name, invoice_date, product, quantity, price, total, payment_status)
+    """
+    return {
+        'customer_name': sales_items[0][0],
+        'invoice_number': invoice_number,
+        'invoice_date': sales_items[0][1],
+        'items': [{
+            'description': item[2],  # product
+            'quantity': item[3],
+            'unit_price': item[4],
+            'total': item[5]
+        } for item in sales_items],
+        'total_amount': sum(item[5] for item in sales_items),
+        'notes': '',
+        'payment_status': sales_items[0][6]
+    }
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only, unseekable sink for zipfile; drained after every chunk so the archive is never held whole"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Bulk PDF export route
+@app.route('/documents/export/<doc_type>', methods=['GET', 'POST'])
+def export_documents(doc_type):
+    """
+    Stream a ZIP of invoice or receipt PDFs matching the view_sales/search_receipts filters.
+    Missing documents are queued on the PDF pool up front and added to the archive in order
+    as they finish.
+    """
+    if 'org_id' not in session:
+        flash('Session expired. Please login again.', 'warning')
+        return redirect(url_for('org_login'))
+
+    if 'user_id' not in session:
+        return redirect(url_for('org_login'))
+
+    if doc_type not in ('invoices', 'receipts'):
+        return "Unknown document type", 404
+
+    org_id = session['org_id']
+    back_url = url_for('view_sales' if doc_type == 'invoices' else 'search_receipts')
+
+    today = datetime.today()
+    start_date = request.values.get('start_date') or (today - timedelta(days=730)).strftime('%Y-%m-%d')
+    end_date = request.values.get('end_date') or (today + timedelta(days=7)).strftime('%Y-%m-%d')
+    account_owner = request.values.get('account_owner')
+    category = request.values.get('category')
+
+    # Same filters as view_sales (invoice_date) and search_receipts (paid_date)
+    date_column = 'l.invoice_date' if doc_type == 'invoices' else 'r.paid_date'
+    table_alias = 'l' if doc_type == 'invoices' else 'r'
+    conditions = [f"{date_column} >= %s", f"{date_column} <= %s"]
+    params = [start_date, end_date]
+    if account_owner:
+        conditions.append(f"{table_alias}.account_owner = %s")
+        params.append(account_owner)
+    if category:
+        conditions.append(f"{table_alias}.category = %s")
+        params.append(category)
+    where_clause = " AND ".join(conditions)
+
+    entries = []
+    try:
+        with get_db_connection2() as conn:
+            cur = conn.cursor()
+
+            if doc_type == 'invoices':
+                cur.execute(f"""
+                    SELECT s.invoice_no, s.customer_name, s.invoice_date, s.product,
+                           s.quantity, s.price, s.total, s.payment_status
+                    FROM {tenant_prefix(org_id)}sales_list l
+                    JOIN {tenant_prefix(org_id)}sales s ON s.invoice_no = l.invoice_no
+                    WHERE {where_clause}
+                    ORDER BY l.invoice_date DESC, s.invoice_no, s.sales_id
+                """, tuple(params))
+
+                invoices = {}
+                for row in cur.fetchall():
+                    invoices.setdefault(row[0], []).append(row[1:])
+
+                folder = app.config['UPLOAD_FOLDER']
+                for invoice_no, sales_items in invoices.items():
+                    invoice_data = build_invoice_view_data(invoice_no, sales_items)
+                    cache_key, filename = queue_cached_document(org_id, 'invoice', create_invoice,
+                                                                invoice_data, folder)
+                    entries.append({
+                        'arcname': f"invoice_{re.sub(r'[^a-zA-Z0-9]', '_', invoice_no)}.pdf",
+                        'folder': folder,
+                        'filename': filename,
+                        'doc_ref': invoice_no,
+                        'cache_key': cache_key
+                    })
+            else:
+                cur.execute(f"""
+                    SELECT r.receipt_id, r.invoice_number, r.customer_name, r.invoice_date,
+                           r.paid_amount, r.balance, r.paid_date, r.receipt_invoice_number,
+                           r.category, r.account_owner
+                    FROM {tenant_prefix(org_id)}receipts r
+                    WHERE {where_clause}
+                    ORDER BY r.paid_date DESC
+                """, tuple(params))
+                receipts = cur.fetchall()
+
+                folder = app.config['RECEIPT_FOLDER']
+                missing = []
+                for receipt in receipts:
+                    filename = f"receipt_{re.sub(r'[^a-zA-Z0-9]', '_', receipt[7])}.pdf"
+                    entries.append({'arcname': filename, 'folder': folder, 'filename': filename,
+                                    'doc_ref': receipt[7], 'cache_key': None})
+                    filepath = os.path.join(folder, filename)
+                    if not os.path.exists(filepath) and not os.path.exists(f"{filepath}.pending"):
+                        missing.append((receipt, filepath))
+
+                # Receipts are rendered once when the payment is recorded; rebuild any that are gone
+                if missing:
+                    cur.execute(f"""
+                        SELECT invoice_no, product, quantity, price, total
+                        FROM {tenant_prefix(org_id)}sales
+                        WHERE invoice_no = ANY(%s)
+                        ORDER BY sales_id
+                    """, (list({receipt[1] for receipt, _ in missing}),))
+                    items_by_invoice = {}
+                    for invoice_no, product, quantity, price, total in cur.fetchall():
+                        items_by_invoice.setdefault(invoice_no, []).append({
+                            'product': product,
+                            'quantity': quantity,
+                            'unit_price': price,
+                            'total': total
+                        })
+
+                    for receipt, filepath in missing:
+                        receipt_data = {
+                            'receipt_id': receipt[0],
+                            'invoice_no': receipt[1],
+                            'customer_name': receipt[2],
+                            'invoice_date': receipt[3],
+                            'amount_paid': receipt[4],
+                            'new_bal': float(receipt[5]),
+                            'payment_date': receipt[6],
+                            'receipt_invoice_number': receipt[7],
+                            'category': receipt[8],
+                            'account_owner': receipt[9],
+                            'items': items_by_invoice.get(receipt[1], [])
+                        }
+                        submit_render(generate_receipt, receipt_data, filepath)
+
+    except Exception as e:
+        log_error_to_file(f"Error exporting {doc_type} for {org_id}: {str(e)}")
+        flash(f"Error exporting documents: {str(e)}", 'danger')
+        return redirect(back_url)
+
+    if not entries:
+        flash(f'No {doc_type} found matching the selected filters.', 'info')
+        return redirect(back_url)
+
+    def generate():
+        buffer = ZipStreamBuffer()
+        written = []
+        skipped = []
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for entry in entries:
+                filepath = os.path.join(entry['folder'], entry['filename'])
+                if not wait_for_render(entry['folder'], entry['filename'], timeout=PDF_RENDER_STALE) \
+                        or not os.path.exists(filepath):
+                    skipped.append(entry['arcname'])
+                    continue
+
+                with open(filepath, 'rb') as source, archive.open(entry['arcname'], 'w') as target:
+                    for chunk in iter(lambda: source.read(64 * 1024), b''):
+                        target.write(chunk)
+                        data = buffer.drain()
+                        if data:
+                            yield data
+                written.append(entry)
+
+            if skipped:
+                archive.writestr('missing.txt', "Could not be generated:\n" + "\n".join(skipped) + "\n")
+        yield buffer.drain()
+
+        # Mark cached invoices as used only once the archive is complete, so eviction
+        # cannot remove a document this export still has to send
+        for entry in written:
+            if entry['cache_key']:
+                record_cached_document(entry['cache_key'], org_id, 'invoice', entry['doc_ref'],
+                                       entry['folder'], entry['filename'])
+
+    response = Response(stream_with_context(generate()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{doc_type}_{start_date}_{end_date}.zip"'
+    return response
+
+
+# Download invoice route
+@app.route('/invoices/<filename>')
+def download_invoice(filename):
+    return send_rendered_document(app.config['UPLOAD_FOLDER'], filename)
+
+
 # Download receipt route
 @app.route('/receipts/<filename>')
 def download_receipt(filename):
-    return send_from_directory(
-        app.config['RECEIPT_FOLDER'],
-        filename,
-        as_attachment=True
-    )
+    return send_rendered_document(app.config['RECEIPT_FOLDER'], filename)
 
 
 # Download payment route
 @app.route('/payments/<filename>')
 def download_payment(filename):
-    return send_from_directory(
-        app.config['PAYMENTS_FOLDER'],
-        filename,
-        as_attachment=True
-    )
+    return send_rendered_document(app.config['PAYMENTS_FOLDER'], filename)
+
+
+# Paginated listings for the search pages: keyset pagination on (sort column, primary key),
+# so every page costs the same no matter how deep it is. Only NOT NULL columns are sortable,
+# which keeps the row comparison in the cursor condition exact.
+PAGE_SIZES = (50, 100, 250, 500)
+DEFAULT_PAGE_SIZE = 100
+
+LISTINGS = {
+    # view_sales
+    'sales': {
+        'table': 'sales_list',
+        'key': 'id',
+        'date_column': 'invoice_date',
+        'columns': ['id', 'customer_name', 'invoice_no', 'invoice_date', 'invoice_amount', 'paid_amount',
+                    'balance', 'payment_status', 'category', 'account_owner', 'reference_no'],
+        'where': [],
+        'sortable': {'invoice_date': 'Invoice Date', 'invoice_no': 'Invoice Number',
+                     'customer_name': 'Customer Name', 'invoice_amount': 'Invoice Amount', 'balance': 'Balance'}
+    },
+    # invoices_menu, receive section
+    'open_sales': {
+        'table': 'sales_list',
+        'key': 'id',
+        'date_column': 'invoice_date',
+        'columns': ['id', 'customer_name', 'invoice_no', 'invoice_date', 'invoice_amount', 'paid_amount',
+                    'balance', 'payment_status', 'category', 'account_owner', 'reference_no'],
+        'where': ['balance > 0'],
+        'sortable': {'invoice_date': 'Invoice Date', 'invoice_no': 'Invoice Number',
+                     'customer_name': 'Customer Name', 'invoice_amount': 'Invoice Amount', 'balance': 'Balance'}
+    },
+    # search_invoices and invoices_menu, edit section
+    'invoices': {
+        'table': 'sales',
+        'key': 'sales_id',
+        'date_column': 'invoice_date',
+        'columns': ['sales_id', 'invoice_date', 'invoice_no', 'customer_name', 'product', 'quantity', 'price',
+                    'total', 'category', 'account_owner', 'sales_acc_invoice_no', 'status', 'bank_account'],
+        'where': ["status = 'Active'"],
+        'sortable': {'invoice_date': 'Invoice Date', 'invoice_no': 'Invoice Number',
+                     'customer_name': 'Customer Name', 'total': 'Total'}
+    },
+    # search_sales_account
+    'sales_accounts': {
+        'table': 'sales_account',
+        'key': 'sales_acc_id',
+        'date_column': 'invoice_date',
+        'columns': ['sales_acc_id', 'invoice_date', 'invoice_number', 'customer_name', 'product', 'quantity',
+                    'price', 'total', 'created_at', 'category', 'account_owner', 'frequency', 'status',
+                    'bank_account'],
+        'where': ["status = 'Active'"],
+        'sortable': {'invoice_date': 'Invoice Date', 'invoice_number': 'Invoice Number',
+                     'customer_name': 'Customer Name', 'total': 'Total'}
+    },
+    # search_receipts
+    'receipts': {
+        'table': 'receipts',
+        'key': 'receipt_id',
+        'date_column': 'paid_date',
+        'columns': ['receipt_id', 'paid_date', 'invoice_number', 'invoice_date', 'customer_name', 'paid_amount',
+                    'balance', 'receipt_invoice_number', 'category', 'account_owner', 'mpesa_receipt_number'],
+        'where': [],
+        'sortable': {'paid_date': 'Paid Date', 'receipt_invoice_number': 'Receipt Number',
+                     'invoice_number': 'Invoice Number', 'customer_name': 'Customer Name',
+                     'paid_amount': 'Paid Amount'}
+    },
+}
+
+
+def encode_page_cursor(sort, direction, value, key):
+    payload = json.dumps({'sort': sort, 'direction': direction, 'value': str(value), 'key': key})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_page_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return data['sort'], data['direction'], data['value'], int(data['key'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid page cursor")
+
+
+def read_listing_filters(default_start_date, default_end_date):
+    """Search filters plus sort/page size from the form (HTML pages) or query string (JSON)"""
+    try:
+        page_size = int(request.values.get('page_size') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        page_size = DEFAULT_PAGE_SIZE
+
+    return {
+        'start_date': request.values.get('start_date') or default_start_date,
+        'end_date': request.values.get('end_date') or default_end_date,
+        'category': request.values.get('category') or '',
+        'account_owner': request.values.get('account_owner') or '',
+        'sort': request.values.get('sort') or '',
+        'direction': request.values.get('direction') or 'desc',
+        'page_size': min(max(page_size, 1), PAGE_SIZES[-1])
+    }
+
+
+def fetch_listing_page(cur, org_id, name, filters, cursor=None):
+    """
+    One page of a listing ordered by (sort, key). Fills in the default sort (newest first)
+    on `filters` and returns (rows, next_cursor); next_cursor is None on the last page.
+    Raises ValueError for an unknown sort column or direction, or a cursor from another sort.
+    """
+    listing = LISTINGS[name]
+    sort = filters['sort'] = filters.get('sort') or listing['date_column']
+    direction = filters['direction'] = (filters.get('direction') or 'desc').lower()
+    if sort not in listing['sortable']:
+        raise ValueError(f"Cannot sort by {sort}")
+    if direction not in ('asc', 'desc'):
+        raise ValueError(f"Invalid sort direction {direction}")
+
+    key = listing['key']
+    date_column = listing['date_column']
+    query = f"""
+        SELECT {', '.join(listing['columns'])}
+        FROM {tenant_prefix(org_id)}{listing['table']}
+        WHERE 1=1
+    """
+    params = []
+    for condition in listing['where']:
+        query += f" AND {condition}"
+
+    # Same filters as the original search routes
+    if filters.get('start_date'):
+        query += f" AND {date_column} >= %s"
+        params.append(filters['start_date'])
+    if filters.get('end_date'):
+        query += f" AND {date_column} <= %s"
+        params.append(filters['end_date'])
+    if filters.get('account_owner'):
+        query += " AND account_owner = %s"
+        params.append(filters['account_owner'])
+    if filters.get('category'):
+        query += " AND category = %s"
+        params.append(filters['category'])
+
+    if cursor:
+        cursor_sort, cursor_direction, cursor_value, cursor_key = decode_page_cursor(cursor)
+        if (cursor_sort, cursor_direction) != (sort, direction):
+            raise ValueError("Page cursor belongs to a different sort order")
+        query += f" AND ({sort}, {key}) {'<' if direction == 'desc' else '>'} (%s, %s)"
+        params.extend([cursor_value, cursor_key])
+
+    # One extra row tells us whether there is a next page
+    query += f" ORDER BY {sort} {direction.upper()}, {key} {direction.upper()} LIMIT %s"
+    params.append(filters['page_size'] + 1)
+
+    cur.execute(query, tuple(params))
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > filters['page_size']:
+        rows = rows[:filters['page_size']]
+        last = rows[-1]
+        next_cursor = encode_page_cursor(sort, direction, last[listing['columns'].index(sort)],
+                                         last[listing['columns'].index(key)])
+    return rows, next_cursor
+
+
+def listing_json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+# Paginated listing JSON route, for tables that load page by page
+@app.route('/listings/<name>')
+def listing_page(name):
+    if 'org_id' not in session or 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'Session expired. Please login again.'}), 401
+
+    if name not in LISTINGS:
+        return jsonify({'status': 'error', 'message': 'Unknown listing'}), 404
+
+    org_id = session['org_id']
+    today = datetime.today()
+    filters = read_listing_filters((today - timedelta(days=730)).strftime('%Y-%m-%d'),
+                                   (today + timedelta(days=7)).strftime('%Y-%m-%d'))
+
+    try:
+        with get_db_connection2() as conn:
+            cur = conn.cursor()
+            rows, next_cursor = fetch_listing_page(cur, org_id, name, filters, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        log_error_to_file(f"Error loading {name} listing for {org_id}: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Failed to load records'}), 500
+
+    columns = LISTINGS[name]['columns']
+    return jsonify({
+        'status': 'success',
+        'rows': [{column: listing_json_value(value) for column, value in zip(columns, row)} for row in rows],
+        'next_cursor': next_cursor,
+        'filters': filters
+    })
+
+
+# Spreadsheet exports of the search pages. Rows come from a named (server-side) cursor a batch
+# at a time, so a full year of a tenant's records never sits in Python memory at once.
+EXPORT_BATCH_SIZE = 2000
+
+EXPORTS = {
+    # view_sales
+    'sales': {
+        'title': 'Sales',
+        'view': 'view_sales',
+        'from': "{prefix}sales_list",
+        'date_column': 'invoice_date',
+        'columns': [('invoice_date', 'Invoice Date'), ('invoice_no', 'Invoice Number'),
+                    ('customer_name', 'Customer Name'), ('invoice_amount', 'Invoice Amount'),
+                    ('paid_amount', 'Paid Amount'), ('balance', 'Balance'), ('payment_status', 'Payment Status'),
+                    ('category', 'Category'), ('account_owner', 'Account Owner'), ('reference_no', 'Reference No')],
+        'order_by': 'invoice_date DESC, id DESC'
+    },
+    # search_receipts
+    'receipts': {
+        'title': 'Receipts',
+        'view': 'search_receipts',
+        'from': "{prefix}receipts",
+        'date_column': 'paid_date',
+        'columns': [('paid_date', 'Paid Date'), ('receipt_invoice_number', 'Receipt Number'),
+                    ('invoice_number', 'Invoice Number'), ('invoice_date', 'Invoice Date'),
+                    ('customer_name', 'Customer Name'), ('paid_amount', 'Paid Amount'), ('balance', 'Balance'),
+                    ('category', 'Category'), ('account_owner', 'Account Owner'),
+                    ('mpesa_receipt_number', 'M-Pesa Receipt')],
+        'order_by': 'paid_date DESC, receipt_id DESC'
+    },
+    # view_bills
+    'bills': {
+        'title': 'Bills',
+        'view': 'view_bills',
+        'from': "{prefix}bills b",
+        'date_column': 'b.billing_date',
+        'category_column': 'b.category',
+        'account_owner_column': 'b.account_owner',
+        'columns': [('b.billing_date', 'Billing Date'), ('b.bill_invoice_number', 'Bill Number'),
+                    ('b.service_provider', 'Service Provider'), ('b.account_name', 'Account Name'),
+                    ('b.account_number', 'Account Number'), ('b.category', 'Category'),
+                    ('b.bill_amount', 'Bill Amount'), ('b.total_paid', 'Total Paid'),
+                    ('b.balance', 'Balance'), ('b.pay_status', 'Pay Status'),
+                    ('b.account_owner', 'Account Owner'), ('b.bank_account', 'Bank Account')],
+        'order_by': 'b.billing_date DESC, b.bill_id DESC'
+    },
+    # view_payments
+    'payments': {
+        'title': 'Payments',
+        'view': 'view_payments',
+        'from': "{prefix}payments",
+        'date_column': 'paid_date',
+        'columns': [('paid_date', 'Paid Date'), ('payment_reference_number', 'Reference Number'),
+                    ('invoice_number', 'Bill Number'), ('service_provider', 'Service Provider'),
+                    ('account_name', 'Account Name'), ('account_number', 'Account Number'),
+                    ('category', 'Category'), ('bill_amount', 'Bill Amount'), ('paid_amount', 'Paid Amount'),
+                    ('balance', 'Balance'), ('account_owner', 'Account Owner'), ('bank_account', 'Bank Account')],
+        'order_by': 'paid_date DESC, payment_id DESC'
+    },
+}
+
+
+def iter_export_rows(org_id, name, start_date, end_date, category=None, account_owner=None):
+    """Yield export rows through a named cursor, EXPORT_BATCH_SIZE rows per round trip"""
+    export = EXPORTS[name]
+    query = f"""
+        SELECT {', '.join(column for column, _ in export['columns'])}
+        FROM {export['from'].format(prefix=tenant_prefix(org_id))}
+        WHERE {export['date_column']} BETWEEN %s AND %s
+    """
+    params = [start_date, end_date]
+    if account_owner:
+        query += f" AND {export.get('account_owner_column', 'account_owner')} = %s"
+        params.append(account_owner)
+    if category:
+        query += f" AND {export.get('category_column', 'category')} = %s"
+        params.append(category)
+    query += f" ORDER BY {export['order_by']}"
+
+    # Flask releases the request's connection when the view returns, before the response has
+    # streamed, so the named cursor needs a connection of its own
+    with pooled_db_connection() as conn:
+        cur = conn.cursor(name=f"export_{name}_{secrets.token_hex(4)}")
+        cur.itersize = EXPORT_BATCH_SIZE
+        cur.execute(query, tuple(params))
+        try:
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+
+def stream_csv_export(headers, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_xlsx_export(title, headers, rows):
+    """
+    Write-only workbook: openpyxl spools rows to disk as they are appended. The finished
+    file is then sent from a temporary file in chunks.
+    """
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title)
+    worksheet.append(headers)
+    for row in rows:
+        worksheet.append(row)
+
+    with tempfile.TemporaryFile() as spool:
+        workbook.save(spool)
+        spool.seek(0)
+        for chunk in iter(lambda: spool.read(64 * 1024), b''):
+            yield chunk
+
+
+# Spreadsheet export route
+@app.route('/export/<name>/<fmt>', methods=['GET', 'POST'])
+def export_records(name, fmt):
+    if 'user_id' not in session:
+        flash("Please log in first.", "warning")
+        return redirect(url_for('org_login'))
+
+    if 'org_id' not in session:
+        flash('Session expired. Please login again.', 'warning')
+        return redirect(url_for('org_login'))
+
+    if name not in EXPORTS or fmt not in ('csv', 'xlsx'):
+        return "Unknown export", 404
+
+    org_id = session['org_id']
+    today = datetime.today()
+    start_date = request.values.get('start_date') or (today - timedelta(days=730)).strftime('%Y-%m-%d')
+    end_date = request.values.get('end_date') or (today + timedelta(days=7)).strftime('%Y-%m-%d')
+    category = request.values.get('category')
+    account_owner = request.values.get('account_owner')
+
+    export = EXPORTS[name]
+    headers = [header for _, header in export['columns']]
+    rows = iter_export_rows(org_id, name, start_date, end_date, category, account_owner)
+
+    # Run the query before the response starts, so a failure is reported instead of a truncated file
+    try:
+        first_row = next(rows, None)
+    except Exception as e:
+        log_error_to_file(f"Error exporting {name} for {org_id}: {str(e)}")
+        flash(f"Error exporting {export['title'].lower()}: {str(e)}", 'danger')
+        return redirect(url_for(export['view']))
+    if first_row is not None:
+        rows = itertools.chain([first_row], rows)
+
+    filename = f"{name}_{start_date}_{end_date}.{fmt}"
+
+    if fmt == 'csv':
+        response = Response(stream_with_context(stream_csv_export(headers, rows)), mimetype='text/csv')
+    else:
+        response = Response(stream_with_context(stream_xlsx_export(export['title'], headers, rows)),
+                            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 # Search Invoices Menu
@@ -2608,83 +4890,34 @@ def invoices_menu():
     default_end_date = (today + relativedelta(weeks=1)).strftime('%Y-%m-%d')
     current_date = today.strftime('%Y-%m-%d')
 
-    # Generate next invoice number
-    next_invoice_number = generate_next_invoice_number()
+    # Next invoice number (display only)
+    next_invoice_number = peek_next_invoice_number(org_id)
 
     # Initialize variables for search results
     invoices = None
     sales = None
+    next_cursor = None
+    section = None
+    page_filters = read_listing_filters(default_start_date, default_end_date)
 
     # Handle search form submission
     if request.method == 'POST':
         # Get the section from which the search was performed
         section = request.form.get('section', 'edit')  # Default to 'edit' for backward compatibility
 
-        # Get search parameters from form
-        start_date = request.form.get('start_date') or default_start_date
-        end_date = request.form.get('end_date') or default_end_date
-        category = request.form.get('category')
-        account_owner = request.form.get('account_owner')
-
         try:
             with get_db_connection2() as conn:
                 cur = conn.cursor()
 
-            # Only search invoices if the request came from the edit section
-            if section == 'edit':
-                # Search invoices from sales table
-                invoices_query = f"""
-                    SELECT sales_id, invoice_date, invoice_no, customer_name, product, 
-                           quantity, price, total, category, account_owner, sales_acc_invoice_no, status, bank_account
-                    FROM {org_id}_sales 
-                    WHERE status = 'Active'
-                """
-                invoices_params = []
-
-                if start_date:
-                    invoices_query += " AND invoice_date >= %s"
-                    invoices_params.append(start_date)
-                if end_date:
-                    invoices_query += " AND invoice_date <= %s"
-                    invoices_params.append(end_date)
-                if category:
-                    invoices_query += " AND category = %s"
-                    invoices_params.append(category)
-                if account_owner:
-                    invoices_query += " AND account_owner = %s"
-                    invoices_params.append(account_owner)
-
-                invoices_query += " ORDER BY invoice_date DESC"
-                cur.execute(invoices_query, invoices_params)
-                invoices = cur.fetchall()
-
-            # Only search sales if the request came from the receive section
-            elif section == 'receive':
-                # Search sales from sales_list table
-                sales_query = f"""
-                    SELECT id, customer_name, invoice_no, invoice_date, invoice_amount,
-                        paid_amount, balance, payment_status, category, account_owner, reference_no
-                    FROM {org_id}_sales_list
-                    WHERE balance > 0 AND 1=1  
-                """
-                sales_params = []
-
-                if start_date:
-                    sales_query += " AND invoice_date >= %s"
-                    sales_params.append(start_date)
-                if end_date:
-                    sales_query += " AND invoice_date <= %s"
-                    sales_params.append(end_date)
-                if category:
-                    sales_query += " AND category = %s"
-                    sales_params.append(category)
-                if account_owner:
-                    sales_query += " AND account_owner = %s"
-                    sales_params.append(account_owner)
+                # Only search invoices if the request came from the edit section
+                if section == 'edit':
+                    invoices, next_cursor = fetch_listing_page(cur, org_id, 'invoices', page_filters,
+                                                               request.form.get('cursor'))
 
-                sales_query += " ORDER BY invoice_date DESC"
-                cur.execute(sales_query, sales_params)
-                sales = cur.fetchall()
+                # Only search sales if the request came from the receive section
+                elif section == 'receive':
+                    sales, next_cursor = fetch_listing_page(cur, org_id, 'open_sales', page_filters,
+                                                            request.form.get('cursor'))
 
         except Exception as e:
             print(f"Error searching data: {e}")
@@ -2701,7 +4934,13 @@ def invoices_menu():
                            default_start_date=default_start_date,
                            default_end_date=default_end_date,
                            invoices=invoices,
-                           sales=sales)
+                           sales=sales,
+                           section=section,
+                           next_cursor=next_cursor,
+                           page_filters=page_filters,
+                           invoice_sort_options=LISTINGS['invoices']['sortable'],
+                           sales_sort_options=LISTINGS['open_sales']['sortable'],
+                           page_sizes=PAGE_SIZES)
 
 
 # Search invoices route
@@ -2725,47 +4964,15 @@ def search_invoices():
     default_start_date = (today - relativedelta(months=6)).strftime('%Y-%m-%d')
     default_end_date = (today + relativedelta(weeks=1)).strftime('%Y-%m-%d')
 
-    try:
-        with get_db_connection2() as conn:
-            cur = conn.cursor()
+    next_cursor = None
+    page_filters = read_listing_filters(default_start_date, default_end_date)
 
+    try:
         if request.method == 'POST':
-            start_date = request.form.get('start_date') or default_start_date
-            end_date = request.form.get('end_date') or default_end_date
-            account_owner = request.form.get('account_owner')
-            category = request.form.get('category')
-
-            # Start building query
-            query = f"""
-                       SELECT sales_id, invoice_date, invoice_no, customer_name, product, quantity, 
-                       price, total, category, account_owner, sales_acc_invoice_no, 
-                       status, bank_account
-                       FROM {org_id}_sales WHERE status = 'Active'
-                       AND 1=1
-                   """
-            params = []
-
-            # Apply filters only if they are selected
-            if start_date:
-                query += " AND invoice_date >= %s"
-                params.append(start_date)
-
-            if end_date:
-                query += " AND invoice_date <= %s"
-                params.append(end_date)
-
-            if account_owner:
-                query += " AND account_owner = %s"
-                params.append(account_owner)
-
-            if category:
-                query += " AND category = %s"
-                params.append(category)
-
-            query += " ORDER BY invoice_date DESC"
-
-            cur.execute(query, tuple(params))
-            invoices = cur.fetchall()
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                invoices, next_cursor = fetch_listing_page(cur, org_id, 'invoices', page_filters,
+                                                           request.form.get('cursor'))
 
             if not invoices:
                 flash('No invoices found matching the selected filters.', 'info')
@@ -2778,6 +4985,10 @@ def search_invoices():
                                categories=categories,
                                bank_accounts=bank_accounts,
                                products=products,
+                               next_cursor=next_cursor,
+                               page_filters=page_filters,
+                               sort_options=LISTINGS['invoices']['sortable'],
+                               page_sizes=PAGE_SIZES,
                                default_start_date=default_start_date,
                                default_end_date=default_end_date)
 
@@ -2787,6 +4998,10 @@ def search_invoices():
                            categories=categories,
                            bank_accounts=bank_accounts,
                            products=products,
+                           next_cursor=next_cursor,
+                           page_filters=page_filters,
+                           sort_options=LISTINGS['invoices']['sortable'],
+                           page_sizes=PAGE_SIZES,
                            default_start_date=default_start_date,
                            default_end_date=default_end_date)
 
@@ -2823,7 +5038,7 @@ def edit_sale(sales_id):
             with get_db_connection2() as conn:
                 cur = conn.cursor()
                 cur.execute(f"""
-                    UPDATE {org_id}_sales SET
+                    UPDATE {tenant_prefix(org_id)}sales SET
                         invoice_date = %s,
                         invoice_no = %s,
                         customer_name = %s,
@@ -2842,19 +5057,15 @@ def edit_sale(sales_id):
                 ))
 
                 # Update sales_list total and balance
-                cur.execute(f"SELECT SUM(total) FROM {org_id}_sales WHERE invoice_no = %s", (invoice_no,))
+                cur.execute(f"SELECT SUM(total) FROM {tenant_prefix(org_id)}sales WHERE invoice_no = %s", (invoice_no,))
                 invoice_total = cur.fetchone()[0] or 0
 
-                cur.execute(f"SELECT paid_amount FROM {org_id}_sales_list WHERE invoice_no = %s", (invoice_no,))
-                paid_amount_result = cur.fetchone()
-                paid_amount = paid_amount_result[0] if paid_amount_result else 0
-                new_balance = invoice_total - paid_amount
-
+                # Balance from the row's own paid_amount, so a payment posted meanwhile is kept
                 cur.execute(f"""
-                    UPDATE {org_id}_sales_list
-                    SET invoice_amount = %s, balance = %s
+                    UPDATE {tenant_prefix(org_id)}sales_list
+                    SET invoice_amount = %s, balance = %s - paid_amount
                     WHERE invoice_no = %s
-                """, (invoice_total, new_balance, invoice_no))
+                """, (invoice_total, invoice_total, invoice_no))
 
                 return jsonify({
                     "status": "success",
@@ -2882,7 +5093,7 @@ def edit_sale(sales_id):
         with get_db_connection2() as conn:
             cur = conn.cursor()
         # Fallback for GET (not used in modal AJAX)
-        cur.execute(f"SELECT * FROM {org_id}_sales WHERE sales_id = %s", (sales_id,))
+        cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}sales WHERE sales_id = %s", (sales_id,))
         invoice = cur.fetchone()
         return jsonify({"invoice": invoice})
 
@@ -2890,62 +5101,33 @@ def edit_sale(sales_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-# Search sales account route
-@app.route('/search_sales_account', methods=['GET', 'POST'])
-def search_sales_account():
-    # Check for org_id in session
-    if 'org_id' not in session:
-        flash('Session expired. Please login again.', 'warning')
-        return redirect(url_for('org_login'))
-
-    org_id = session['org_id']
-    invoices = []
-    categories = read_categories()
-    account_owners = read_account_owners()
-
-    # Set default date range
-    today = datetime.today()
-    default_start_date = (today - timedelta(days=730)).strftime('%Y-%m-%d')
-    default_end_date = (today + timedelta(days=7)).strftime('%Y-%m-%d')
-
-    try:
-        with get_db_connection2() as conn:
-            cur = conn.cursor()
-
-        if request.method == 'POST':
-            start_date = request.form.get('start_date') or default_start_date
-            end_date = request.form.get('end_date') or default_end_date
-            account_owner = request.form.get('account_owner')
-            category = request.form.get('category')
-
-            # Start building query
-            query = f"""
-                       SELECT * FROM {org_id}_sales_account
-                       WHERE 1=1 AND status = 'Active'
-                   """
-            params = []
-
-            # Apply filters only if they are selected
-            if start_date:
-                query += " AND invoice_date >= %s"
-                params.append(start_date)
-
-            if end_date:
-                query += " AND invoice_date <= %s"
-                params.append(end_date)
+# Search sales account route
+@app.route('/search_sales_account', methods=['GET', 'POST'])
+def search_sales_account():
+    # Check for org_id in session
+    if 'org_id' not in session:
+        flash('Session expired. Please login again.', 'warning')
+        return redirect(url_for('org_login'))
 
-            if account_owner:
-                query += " AND account_owner = %s"
-                params.append(account_owner)
+    org_id = session['org_id']
+    invoices = []
+    categories = read_categories()
+    account_owners = read_account_owners()
 
-            if category:
-                query += " AND category = %s"
-                params.append(category)
+    # Set default date range
+    today = datetime.today()
+    default_start_date = (today - timedelta(days=730)).strftime('%Y-%m-%d')
+    default_end_date = (today + timedelta(days=7)).strftime('%Y-%m-%d')
 
-            query += " ORDER BY invoice_date DESC"
+    next_cursor = None
+    page_filters = read_listing_filters(default_start_date, default_end_date)
 
-            cur.execute(query, tuple(params))
-            invoices = cur.fetchall()
+    try:
+        if request.method == 'POST':
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                invoices, next_cursor = fetch_listing_page(cur, org_id, 'sales_accounts', page_filters,
+                                                           request.form.get('cursor'))
 
             if not invoices:
                 flash('No invoices found matching the selected filters.', 'info')
@@ -2956,6 +5138,10 @@ def search_sales_account():
                                invoices=invoices,
                                account_owners=account_owners,
                                categories=categories,
+                               next_cursor=next_cursor,
+                               page_filters=page_filters,
+                               sort_options=LISTINGS['sales_accounts']['sortable'],
+                               page_sizes=PAGE_SIZES,
                                default_start_date=default_start_date,
                                default_end_date=default_end_date)
 
@@ -2963,6 +5149,10 @@ def search_sales_account():
                            invoices=invoices,
                            account_owners=account_owners,
                            categories=categories,
+                           next_cursor=next_cursor,
+                           page_filters=page_filters,
+                           sort_options=LISTINGS['sales_accounts']['sortable'],
+                           page_sizes=PAGE_SIZES,
                            default_start_date=default_start_date,
                            default_end_date=default_end_date)
 
@@ -3001,7 +5191,7 @@ def edit_sales_account(sales_acc_id):
 
             # Deactivate old sales account and related records
             cur.execute(f"""
-                UPDATE {org_id}_sales_account 
+                UPDATE {tenant_prefix(org_id)}sales_account 
                 SET status = 'Not Active' 
                 WHERE sales_acc_id = %s 
                 RETURNING invoice_number
@@ -3009,13 +5199,13 @@ def edit_sales_account(sales_acc_id):
             original_invoice_no = cur.fetchone()[0]
 
             cur.execute(f"""
-                UPDATE {org_id}_sales 
+                UPDATE {tenant_prefix(org_id)}sales 
                 SET status = 'Not Active' 
                 WHERE sales_acc_invoice_no = %s
             """, (original_invoice_no,))
 
             cur.execute(f"""
-                UPDATE {org_id}_sales_list 
+                UPDATE {tenant_prefix(org_id)}sales_list 
                 SET notes = 'Not Active' 
                 WHERE reference_no = %s
             """, (original_invoice_no,))
@@ -3024,12 +5214,12 @@ def edit_sales_account(sales_acc_id):
             new_invoice_no = generate_next_invoice_number()
 
             # Create new sales_account
-            cur.execute(f"SELECT MAX(sales_acc_id) FROM {org_id}_sales_account")
+            cur.execute(f"SELECT MAX(sales_acc_id) FROM {tenant_prefix(org_id)}sales_account")
             max_id = cur.fetchone()[0] or 0
             new_sales_acc_id = max_id + 1
 
             cur.execute(f"""
-                INSERT INTO {org_id}_sales_account (
+                INSERT INTO {tenant_prefix(org_id)}sales_account (
                     sales_acc_id, invoice_date, invoice_number, customer_name, product,
                     quantity, price, total, created_at, category, account_owner,
                     frequency, status, bank_account
@@ -3042,7 +5232,7 @@ def edit_sales_account(sales_acc_id):
 
             # Insert invoice
             cur.execute(f"""
-                INSERT INTO {org_id}_invoices (invoice_number, created_at)
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                 VALUES (%s, %s)
                 ON CONFLICT (invoice_number) DO NOTHING
             """, (new_invoice_no, datetime.now()))
@@ -3060,51 +5250,15 @@ def edit_sales_account(sales_acc_id):
                 delta = None
 
             if delta:
-                next_due_date = invoice_date
-                generated_invoices = []
-
-                while next_due_date <= today + delta:
-                    new_invoice_number = generate_next_invoice_number()
-
-                    cur.execute(f"""
-                        INSERT INTO {org_id}_sales (
-                            invoice_date, invoice_no, customer_name, product, quantity, 
-                            price, total, date_created, category, account_owner, 
-                            sales_acc_invoice_no, bank_account
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        next_due_date, new_invoice_number, customer_name, product, quantity,
-                        price, total, datetime.now(), category, account_owner,
-                        new_invoice_no, bank_account
-                    ))
-
-                    cur.execute(f"""
-                        INSERT INTO {org_id}_invoices (invoice_number, created_at)
-                        VALUES (%s, %s)
-                        ON CONFLICT (invoice_number) DO NOTHING
-                    """, (new_invoice_number, datetime.now()))
-
-                    generated_invoices.append({
-                        'date': next_due_date.strftime('%Y-%m-%d'),
-                        'invoice_no': new_invoice_number
-                    })
-
-                    # Calculate the total for this invoice
-                    cur.execute(f"""
-                        SELECT SUM(total) FROM {org_id}_sales WHERE invoice_no = %s
-                    """, (new_invoice_number,))
-                    invoice_total = cur.fetchone()[0] or 0
-
-                    cur.execute(f"""
-                        INSERT INTO {org_id}_sales_list (
-                            customer_name, invoice_no, invoice_date, invoice_amount, 
-                            paid_amount, balance, category, account_owner, reference_no
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        customer_name, new_invoice_number, next_due_date, invoice_total,
-                        0, invoice_total, category, account_owner, new_invoice_no
-                    ))
-                    next_due_date += delta
+                due_dates = recurring_due_dates(invoice_date, delta, today + delta)
+                generated = backfill_recurring_invoices(
+                    cur, org_id, due_dates, product, quantity, price, total, customer_name,
+                    category, account_owner, bank_account, new_invoice_no, render_pdfs=False
+                )
+                generated_invoices = [{
+                    'date': invoice['date'].strftime('%Y-%m-%d'),
+                    'invoice_no': invoice['invoice_no']
+                } for invoice in generated]
 
                 return jsonify({
                     'status': 'success',
@@ -3148,45 +5302,15 @@ def view_sales():
     default_start_date = (today - timedelta(days=730)).strftime('%Y-%m-%d')
     default_end_date = (today + timedelta(days=7)).strftime('%Y-%m-%d')
 
-    try:
-        with get_db_connection2() as conn:
-            cur = conn.cursor()
+    next_cursor = None
+    page_filters = read_listing_filters(default_start_date, default_end_date)
 
+    try:
         if request.method == 'POST':
-            start_date = request.form.get('start_date') or default_start_date
-            end_date = request.form.get('end_date') or default_end_date
-            account_owner = request.form.get('account_owner')
-            category = request.form.get('category')
-
-            # Start building query
-            query = f""" SELECT id, customer_name, invoice_no, invoice_date, invoice_amount,
-                           paid_amount, balance, payment_status, category, account_owner, reference_no
-                           FROM {org_id}_sales_list
-                           WHERE 1=1
-                       """
-            params = []
-
-            # Apply filters only if they are selected
-            if start_date:
-                query += " AND invoice_date >= %s"
-                params.append(start_date)
-
-            if end_date:
-                query += " AND invoice_date <= %s"
-                params.append(end_date)
-
-            if account_owner:
-                query += " AND account_owner = %s"
-                params.append(account_owner)
-
-            if category:
-                query += " AND category = %s"
-                params.append(category)
-
-            query += " ORDER BY invoice_date DESC"
-
-            cur.execute(query, tuple(params))
-            sales = cur.fetchall()
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                sales, next_cursor = fetch_listing_page(cur, org_id, 'sales', page_filters,
+                                                        request.form.get('cursor'))
 
             if not sales:
                 flash('No invoices found matching the selected filters.', 'info')
@@ -3194,16 +5318,24 @@ def view_sales():
     except Exception as e:
         return render_template('view_sales.html',
                                error=f"Database error: {str(e)}",
-                               sales=sales,
+                               invoices=sales,
                                account_owners=account_owners,
                                categories=categories,
+                               next_cursor=next_cursor,
+                               page_filters=page_filters,
+                               sort_options=LISTINGS['sales']['sortable'],
+                               page_sizes=PAGE_SIZES,
                                default_start_date=default_start_date,
                                default_end_date=default_end_date)
 
     return render_template('view_sales.html',
-                           sales=sales,
+                           invoices=sales,
                            account_owners=account_owners,
                            categories=categories,
+                           next_cursor=next_cursor,
+                           page_filters=page_filters,
+                           sort_options=LISTINGS['sales']['sortable'],
+                           page_sizes=PAGE_SIZES,
                            default_start_date=default_start_date,
                            default_end_date=default_end_date)
 
@@ -3246,34 +5378,29 @@ def record_payment(sales_list_id):
         category = data.get('category')
         account_owner = data.get('account_owner')
 
-        # Get current totals from sales_list
-        cur.execute(f""" SELECT paid_amount, invoice_amount
-            FROM {org_id}_sales_list
+        # Lock the invoice so a concurrent payment cannot slip past the overpayment check
+        execute_prepared(cur, org_id, 'sales_list_balance_for_update', f"""
+            SELECT invoice_no, invoice_amount, balance
+            FROM {tenant_prefix(org_id)}sales_list
             WHERE id = %s
+            FOR UPDATE
         """, (sales_list_id,))
         row = cur.fetchone()
         if not row:
             return jsonify({'success': False, 'message': 'Invoice not found'}), 404
 
-        current_paid, invoice_amount_db = row
-        current_paid = float(current_paid or 0)
+        invoice_no, invoice_amount_db, current_balance = row
         invoice_amount = float(invoice_amount_db)
 
-        # Calculate new totals
-        total_paid = current_paid + new_payment
-
-        if total_paid > invoice_amount:
+        if new_payment > float(current_balance):
             return jsonify({'success': False,
                             'message': 'Total paid cannot exceed invoice amount'}), 400
 
-        balance = invoice_amount - total_paid
-        payment_status = 'Paid' if balance == 0 else 'Not Paid'
-
         # Get all products for this invoice along with their frequencies
-        cur.execute(f"""
+        execute_prepared(cur, org_id, 'invoice_items_with_frequency', f"""
             SELECT s.product, s.quantity, s.price as unit_price, s.total, s.sales_acc_invoice_no, p.frequency, s.bank_account
-            FROM {org_id}_sales s
-            JOIN products p ON s.product = p.product
+            FROM {tenant_prefix(org_id)}sales s
+            JOIN {tenant_prefix(org_id)}products p ON s.product = p.product
             WHERE s.invoice_no = %s
         """, (invoice_no,))
         items_raw = cur.fetchall()
@@ -3300,16 +5427,23 @@ def record_payment(sales_list_id):
         # For safety, if we didn't get a frequency but have a sales account
         if sales_acc_invoice_no and not frequency and items:
             first_product = items[0]['product']
-            cur.execute(f"SELECT frequency FROM {org_id}_products WHERE product = %s", (first_product,))
+            execute_prepared(cur, org_id, 'product_frequency', f"""
+                SELECT frequency FROM {tenant_prefix(org_id)}products WHERE product = %s
+            """, (first_product,))
             frequency_result = cur.fetchone()
             if frequency_result:
                 frequency = frequency_result[0]
 
         receipt_invoice_number = generate_next_invoice_number()
 
+        # Post to the ledger; sales_list and sales follow in the same transaction
+        _, _, balance, payment_status = post_payment(cur, org_id, invoice_no, new_payment, 'receipt',
+                                                     receipt_invoice_number)
+        balance = float(balance)
+
         # Insert receipt record
-        cur.execute(f"""
-            INSERT INTO {org_id}_receipts (
+        execute_prepared(cur, org_id, 'insert_receipt', f"""
+            INSERT INTO {tenant_prefix(org_id)}receipts (
                 paid_date, invoice_number, invoice_date, customer_name,
                 paid_amount, balance, receipt_invoice_number,
                 category, account_owner
@@ -3322,32 +5456,14 @@ def record_payment(sales_list_id):
         ))
         receipt_id = cur.fetchone()[0]
 
-        cur.execute(f"""
-            INSERT INTO {org_id}_invoices (invoice_number, created_at)
-                VALUES (%s, %s)
-                ON CONFLICT (invoice_number) DO NOTHING
+        execute_prepared(cur, org_id, 'insert_invoice_number', f"""
+            INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
+            VALUES (%s, %s)
+            ON CONFLICT (invoice_number) DO NOTHING
         """, (receipt_invoice_number, datetime.now()))
 
         message = f'Payment recorded! Receipt #{receipt_invoice_number}'
 
-        # Update sales_list table
-        cur.execute(f"""
-            UPDATE {org_id}_sales_list
-            SET 
-                paid_amount = %s,
-                balance = %s,
-                payment_status = %s
-            WHERE id = %s
-        """, (total_paid, balance, payment_status, sales_list_id))
-
-        # Update sales records
-        cur.execute(f"""
-            UPDATE {org_id}_sales
-            SET 
-                payment_status = %s
-            WHERE invoice_no = %s
-        """, (payment_status, invoice_no))
-
         # Generate receipt PDF
         receipt_data = {
             'receipt_id': receipt_id,
@@ -3367,13 +5483,13 @@ def record_payment(sales_list_id):
         filename = f"receipt_{sanitized_invoice_no}.pdf"
         filepath = os.path.join(app.config['RECEIPT_FOLDER'], filename)
 
-        generate_receipt(receipt_data, filepath)
+        submit_render(generate_receipt, receipt_data, filepath)
         # Check if this is a sales account payment and create next due sale
         if sales_acc_invoice_no and frequency and payment_status == 'Paid':
             # Get the most recent invoice date for this sales account
             cur.execute(f"""
                 SELECT invoice_date, payment_status 
-                FROM {org_id}_sales_list 
+                FROM {tenant_prefix(org_id)}sales_list 
                 WHERE reference_no = %s 
                 ORDER BY invoice_date DESC 
                 LIMIT 1
@@ -3401,7 +5517,7 @@ def record_payment(sales_list_id):
 
                         # Check if this next invoice already exists
                         cur.execute(f"""
-                            SELECT COUNT(*) FROM {org_id}_sales_list 
+                            SELECT COUNT(*) FROM {tenant_prefix(org_id)}sales_list 
                             WHERE reference_no = %s 
                             AND invoice_date = %s
                         """, (sales_acc_invoice_no, next_due_date))
@@ -3414,7 +5530,7 @@ def record_payment(sales_list_id):
                             # Create new sales records for each product
                             for item in items:
                                 cur.execute(f"""
-                                    INSERT INTO {org_id}_sales (
+                                    INSERT INTO {tenant_prefix(org_id)}sales (
                                         invoice_date, invoice_no, customer_name, product, quantity, 
                                         price, total, date_created, category, account_owner, 
                                         sales_acc_invoice_no, bank_account
@@ -3428,14 +5544,14 @@ def record_payment(sales_list_id):
 
                             # Create invoice record
                             cur.execute(f"""
-                                INSERT INTO {org_id}_invoices (invoice_number, created_at)
+                                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                                 VALUES (%s, %s)
                                 ON CONFLICT (invoice_number) DO NOTHING
                             """, (new_invoice_number, current_datetime))
 
                             # Create sales_list entry
                             cur.execute(f"""
-                                INSERT INTO {org_id}_sales_list (
+                                INSERT INTO {tenant_prefix(org_id)}sales_list (
                                     customer_name, invoice_no, invoice_date, invoice_amount, 
                                     paid_amount, balance, category, 
                                     account_owner, reference_no
@@ -3482,44 +5598,15 @@ def search_receipts():
     default_start_date = (today - timedelta(days=730)).strftime('%Y-%m-%d')
     default_end_date = (today + timedelta(days=7)).strftime('%Y-%m-%d')
 
-    try:
-        with get_db_connection2() as conn:
-            cur = conn.cursor()
+    next_cursor = None
+    page_filters = read_listing_filters(default_start_date, default_end_date)
 
+    try:
         if request.method == 'POST':
-            start_date = request.form.get('start_date') or default_start_date
-            end_date = request.form.get('end_date') or default_end_date
-            account_owner = request.form.get('account_owner')
-            category = request.form.get('category')
-
-            # Start building query
-            query = f"""
-                           SELECT * FROM {org_id}_receipts
-                           WHERE 1=1
-                       """
-            params = []
-
-            # Apply filters only if they are selected
-            if start_date:
-                query += " AND paid_date >= %s"
-                params.append(start_date)
-
-            if end_date:
-                query += " AND paid_date <= %s"
-                params.append(end_date)
-
-            if account_owner:
-                query += " AND account_owner = %s"
-                params.append(account_owner)
-
-            if category:
-                query += " AND category = %s"
-                params.append(category)
-
-            query += " ORDER BY paid_date DESC"
-
-            cur.execute(query, tuple(params))
-            receipts = cur.fetchall()
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                receipts, next_cursor = fetch_listing_page(cur, org_id, 'receipts', page_filters,
+                                                           request.form.get('cursor'))
 
             if not receipts:
                 flash('No receipts found matching the selected filters.', 'info')
@@ -3530,6 +5617,10 @@ def search_receipts():
                                receipts=receipts,
                                account_owners=account_owners,
                                categories=categories,
+                               next_cursor=next_cursor,
+                               page_filters=page_filters,
+                               sort_options=LISTINGS['receipts']['sortable'],
+                               page_sizes=PAGE_SIZES,
                                default_start_date=default_start_date,
                                default_end_date=default_end_date)
 
@@ -3537,6 +5628,10 @@ def search_receipts():
                            receipts=receipts,
                            account_owners=account_owners,
                            categories=categories,
+                           next_cursor=next_cursor,
+                           page_filters=page_filters,
+                           sort_options=LISTINGS['receipts']['sortable'],
+                           page_sizes=PAGE_SIZES,
                            default_start_date=default_start_date,
                            default_end_date=default_end_date)
 
@@ -3581,8 +5676,8 @@ def edit_receipt(receipt_id):
                                    s.sales_acc_invoice_no,
                                    p.frequency,
                                    s.bank_account
-                            FROM {org_id}_sales s
-                                     JOIN {org_id}_products p ON s.product = p.product
+                            FROM {tenant_prefix(org_id)}sales s
+                                     JOIN {tenant_prefix(org_id)}products p ON s.product = p.product
                             WHERE s.invoice_no = %s
                             """, (invoice_number,))
                 items_raw = cur.fetchall()
@@ -3596,47 +5691,78 @@ def edit_receipt(receipt_id):
                         'total': float(item[3])
                     })
 
-                # Get the original total and reference_no from sales_list
+                # The receipt as it stands, locked so two edits cannot both post against it
+                cur.execute(f"""
+                            SELECT invoice_number, paid_amount, paid_amount + balance
+                            FROM {tenant_prefix(org_id)}receipts
+                            WHERE receipt_id = %s
+                            FOR UPDATE
+                            """, (receipt_id,))
+                original_receipt = cur.fetchone()
+                if not original_receipt:
+                    return jsonify({"status": "error", "message": "Receipt not found"}), 404
+
+                # Post the change as correcting ledger entries; the ledger itself is never rewritten
+                original_invoice_number, original_paid, original_total = original_receipt
+                if original_invoice_number != invoice_number:
+                    added_payment = paid_amount
+                else:
+                    added_payment = paid_amount - float(original_paid)
+
+                # Lock the invoice the receipt ends up on so the edit cannot overpay it
+                if added_payment > 0:
+                    cur.execute(f"""
+                                SELECT balance
+                                FROM {tenant_prefix(org_id)}sales_list
+                                WHERE invoice_no = %s
+                                FOR UPDATE
+                                """, (invoice_number,))
+                    target_invoice = cur.fetchone()
+                    if target_invoice and added_payment > float(target_invoice[0]):
+                        return jsonify({"status": "error",
+                                        "message": "Total paid cannot exceed invoice amount"}), 400
+
+                if original_invoice_number != invoice_number:
+                    post_payment(cur, org_id, original_invoice_number, -original_paid, 'receipt_edit',
+                                 receipt_invoice_number)
+                    post_payment(cur, org_id, invoice_number, paid_amount, 'receipt_edit', receipt_invoice_number)
+                elif paid_amount != float(original_paid):
+                    post_payment(cur, org_id, invoice_number, paid_amount - float(original_paid), 'receipt_edit',
+                                 receipt_invoice_number)
+
+                # The invoice's balance after the edit, and its reference_no from sales_list
                 cur.execute(f"""
-                            SELECT invoice_amount, reference_no
-                            FROM {org_id}_sales_list
+                            SELECT balance, payment_status, reference_no
+                            FROM {tenant_prefix(org_id)}sales_list
                             WHERE invoice_no = %s
                             """, (invoice_number,))
                 sales_list_result = cur.fetchone()
 
-                original_total = 0
                 sales_acc_invoice_no = None
                 frequency = None
 
                 if sales_list_result:
-                    original_total = float(sales_list_result[0]) if sales_list_result[0] else 0
-                    sales_acc_invoice_no = sales_list_result[1] if sales_list_result[1] else None
+                    new_balance = float(sales_list_result[0])
+                    payment_status = sales_list_result[1]
+                    sales_acc_invoice_no = sales_list_result[2] if sales_list_result[2] else None
 
                     # Get frequency from products table via sales table
                     cur.execute(f"""
                                 SELECT p.frequency
-                                FROM {org_id}_sales s
-                                         JOIN {org_id}_products p ON s.product = p.product
+                                FROM {tenant_prefix(org_id)}sales s
+                                         JOIN {tenant_prefix(org_id)}products p ON s.product = p.product
                                 WHERE s.invoice_no = %s LIMIT 1
                                 """, (invoice_number,))
                     freq_result = cur.fetchone()
                     frequency = freq_result[0] if freq_result and freq_result[0] else None
                 else:
-                    # If not found in sales_list, get from receipts table
-                    cur.execute(f"""
-                                SELECT paid_amount + balance
-                                FROM {org_id}_receipts
-                                WHERE receipt_id = %s
-                                """, (receipt_id,))
-                    result = cur.fetchone()
-                    original_total = float(result[0]) if result and result[0] else 0
-
-                new_balance = max(0, original_total - paid_amount)
-                payment_status = 'Paid' if new_balance == 0 else 'Not Paid'
+                    # If not found in sales_list, work from the receipt's own total
+                    new_balance = max(0, float(original_total or 0) - paid_amount)
+                    payment_status = 'Paid' if new_balance == 0 else 'Not Paid'
 
                 # Update receipts table
                 cur.execute(f"""
-                            UPDATE {org_id}_receipts
+                            UPDATE {tenant_prefix(org_id)}receipts
                             SET paid_date              = %s,
                                 invoice_number         = %s,
                                 invoice_date           = %s,
@@ -3653,22 +5779,6 @@ def edit_receipt(receipt_id):
                     category, account_owner, receipt_id
                 ))
 
-                # Update sales_list table
-                cur.execute(f"""
-                            UPDATE {org_id}_sales_list
-                            SET balance        = %s,
-                                paid_amount    = %s,
-                                payment_status = %s
-                            WHERE invoice_no = %s
-                            """, (new_balance, paid_amount, payment_status, invoice_number))
-
-                # Update sales table
-                cur.execute(f"""
-                    UPDATE {org_id}_sales
-                    SET payment_status = %s
-                    WHERE invoice_no = %s
-                """, (payment_status, invoice_number))
-
                 message = f'Receipt updated! Receipt #{receipt_invoice_number}'
                 # Generate receipt PDF
                 receipt_data = {
@@ -3689,7 +5799,7 @@ def edit_receipt(receipt_id):
                 filename = f"receipt_{sanitized_invoice_no}.pdf"
                 filepath = os.path.join(app.config['RECEIPT_FOLDER'], filename)
 
-                generate_receipt(receipt_data, filepath)
+                submit_render(generate_receipt, receipt_data, filepath)
 
                 # Check if we should create a next due sale
                 next_invoice_generated = False
@@ -3697,7 +5807,7 @@ def edit_receipt(receipt_id):
                     # Get the most recent invoice date for this sales account
                     cur.execute(f"""
                                 SELECT invoice_date, payment_status
-                                FROM {org_id}_sales_list
+                                FROM {tenant_prefix(org_id)}sales_list
                                 WHERE reference_no = %s
                                 ORDER BY invoice_date DESC LIMIT 1
                                 """, (sales_acc_invoice_no,))
@@ -3723,7 +5833,7 @@ def edit_receipt(receipt_id):
                                 # Check if this next invoice already exists
                                 cur.execute(f"""
                                             SELECT COUNT(*)
-                                            FROM {org_id}_sales_list
+                                            FROM {tenant_prefix(org_id)}sales_list
                                             WHERE reference_no = %s
                                               AND invoice_date = %s
                                             """, (sales_acc_invoice_no, next_due_date))
@@ -3733,8 +5843,8 @@ def edit_receipt(receipt_id):
                                     # Get product details from the original sale
                                     cur.execute(f"""
                                                 SELECT s.product, s.quantity, s.price, s.total, s.bank_account
-                                                FROM {org_id}_sales s
-                                                         JOIN {org_id}_products p ON s.product = p.product
+                                                FROM {tenant_prefix(org_id)}sales s
+                                                         JOIN {tenant_prefix(org_id)}products p ON s.product = p.product
                                                 WHERE s.invoice_no = %s
                                                 """, (invoice_number,))
                                     items = []
@@ -3755,7 +5865,7 @@ def edit_receipt(receipt_id):
                                         # Create new sales records for each product
                                         for item in items:
                                             cur.execute(f"""
-                                                        INSERT INTO {org_id}_sales (invoice_date, invoice_no, customer_name, product,
+                                                        INSERT INTO {tenant_prefix(org_id)}sales (invoice_date, invoice_no, customer_name, product,
                                                                            quantity,
                                                                            price, total, date_created, category,
                                                                            account_owner,
@@ -3770,14 +5880,14 @@ def edit_receipt(receipt_id):
 
                                         # Create invoice record
                                         cur.execute(f"""
-                                                    INSERT INTO {org_id})_invoices (invoice_number, created_at)
+                                                    INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number, created_at)
                                                     VALUES (%s, %s) ON CONFLICT (invoice_number) DO NOTHING
                                                     """, (new_invoice_number, current_datetime))
 
                                         # Create sales_list entry
                                         invoice_amount = sum(item['total'] for item in items)
                                         cur.execute(f"""
-                                                    INSERT INTO {org_id}_sales_list (customer_name, invoice_no, invoice_date,
+                                                    INSERT INTO {tenant_prefix(org_id)}sales_list (customer_name, invoice_no, invoice_date,
                                                                             invoice_amount, paid_amount, balance, category,
                                                                             account_owner, reference_no)
                                                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
@@ -3809,7 +5919,7 @@ def edit_receipt(receipt_id):
         with get_db_connection2() as conn:
             cur = conn.cursor()
             # GET request handling remains the same
-            cur.execute(f"SELECT * FROM {org_id}_receipts WHERE receipt_id = %s", (receipt_id,))
+            cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}receipts WHERE receipt_id = %s", (receipt_id,))
             receipt = cur.fetchone()
             return jsonify({"receipt": receipt})
     except Exception as e:
@@ -3832,25 +5942,25 @@ def search_customers():
     try:
         with get_db_connection2() as conn:
             cur = conn.cursor()
-        if search_term:
-            cur.execute(f"""
-                        SELECT DISTINCT customer_name
-                        FROM {org_id}_sales_list
-                        WHERE balance > 0
-                          AND customer_name ILIKE %s
-                        ORDER BY customer_name
-                            LIMIT 20
-                        """, (f'%{search_term}%',))
-        else:
-            # Return all customers with unpaid invoices when no search term
-            cur.execute(f"""
-                        SELECT DISTINCT customer_name
-                        FROM {org_id}_sales_list
-                        WHERE balance > 0
-                        ORDER BY customer_name
-                        """)
+            if search_term:
+                cur.execute(f"""
+                            SELECT customer_name
+                            FROM {tenant_prefix(org_id)}customer_balances
+                            WHERE open_invoices > 0
+                              AND customer_name ILIKE %s
+                            ORDER BY customer_name
+                                LIMIT 20
+                            """, (f'%{search_term}%',))
+            else:
+                # Return all customers with unpaid invoices when no search term
+                cur.execute(f"""
+                            SELECT customer_name
+                            FROM {tenant_prefix(org_id)}customer_balances
+                            WHERE open_invoices > 0
+                            ORDER BY customer_name
+                            """)
 
-        customers = [row[0] for row in cur.fetchall()]
+            customers = [row[0] for row in cur.fetchall()]
         return jsonify(customers)
     except Exception as e:
         app.logger.error(f"Error searching customers: {str(e)}")
@@ -3879,8 +5989,11 @@ def get_unpaid_invoices(customer_name):
         with get_db_connection2() as conn:
             cur = conn.cursor()
 
-            cur.execute(f"""
-                        SELECT * FROM {org_id}_sales_list
+            # Explicit columns: a prepared SELECT * fails once a migration adds a column
+            execute_prepared(cur, org_id, 'unpaid_invoices_by_customer', f"""
+                        SELECT id, customer_name, invoice_no, invoice_date, invoice_amount, paid_amount,
+                               balance, payment_status, notes, category, account_owner, reference_no
+                        FROM {tenant_prefix(org_id)}sales_list
                         WHERE customer_name = %s
                           AND balance > 0
                         ORDER BY invoice_date DESC
@@ -3899,10 +6012,19 @@ def get_unpaid_invoices(customer_name):
                     "message": f"No unpaid invoices found for {customer_name}"
                 })
 
+            # The customer's total outstanding, kept current by the sales_list trigger
+            execute_prepared(cur, org_id, 'customer_outstanding', f"""
+                        SELECT open_balance
+                        FROM {tenant_prefix(org_id)}customer_balances
+                        WHERE customer_name = %s
+                        """, (customer_name,))
+            outstanding = cur.fetchone()
+
             return jsonify({
                 "status": "success",
                 "invoices": unpaid_invoices,
-                "customer": customer_name
+                "customer": customer_name,
+                "outstanding": float(outstanding[0]) if outstanding else 0
             })
     except Exception as e:
         app.logger.error(f"Error getting unpaid invoices: {str(e)}")
@@ -3929,14 +6051,14 @@ def manage_users():
         if session.get('role') == 3:
             cur.execute(f"""
                 SELECT u.user_id, u.username, u.role, u.full_name, u.email, u.status
-                FROM {org_id}_users u
+                FROM {tenant_prefix(org_id)}users u
                 WHERE u.user_id = %s
             """, (session['user_id'],))
         # For roles 1 and 2, fetch all users from their org tenant table
         elif session.get('role') in [1, 2]:
             cur.execute(f"""
                 SELECT u.user_id, u.username, u.role, u.full_name, u.email, u.status
-                FROM {org_id}_users u
+                FROM {tenant_prefix(org_id)}users u
                 ORDER BY u.user_id ASC
             """)
         else:
@@ -3999,11 +6121,23 @@ def add_user():
         try:
             with get_db_connection2() as conn:
                 cur = conn.cursor()
+
+                # Usernames are unique across all organizations
+                if username_taken(cur, username):
+                    flash("Username is already taken. Please choose another one.", "danger")
+                    return render_template('add_users.html', roles=roles, username=username,
+                                           selected_role=int(role_id), full_name=full_name,
+                                           email=email)
+
                 cur.execute(f"""
-                    INSERT INTO {org_id}_users (username, role, password, full_name, email,  org_id) 
+                    INSERT INTO {tenant_prefix(org_id)}users (username, role, password, full_name, email,  org_id)
                     VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING user_id
                 """, (username, role_id, hashed_password, full_name, email, org_id))
 
+                new_user_id = cur.fetchone()[0]
+                sync_user_directory(cur, org_id, new_user_id, username)
+
             flash('User added successfully!', 'success')
             return redirect(url_for('manage_users'))
 
@@ -4048,12 +6182,12 @@ def change_password(user_id):
 
         with get_db_connection2() as conn:
             cur = conn.cursor()
-            cur.execute(f"SELECT password FROM {org_id}_users WHERE user_id = %s", (user_id,))
+            cur.execute(f"SELECT password FROM {tenant_prefix(org_id)}users WHERE user_id = %s", (user_id,))
             user = cur.fetchone()
 
             if user and check_password_hash(user[0], old_password):
                 hashed_password = generate_password_hash(new_password)
-                cur.execute(f"UPDATE {org_id}_users SET password = %s WHERE user_id = %s",
+                cur.execute(f"UPDATE {tenant_prefix(org_id)}users SET password = %s WHERE user_id = %s",
                             (hashed_password, user_id))
                 flash('Password changed successfully!', 'success')
             else:
@@ -4084,13 +6218,13 @@ def user_details(user_id):
             if session.get('role') == 1 or session.get('role') == 2:
                 cur.execute(f"""
                     SELECT u.user_id, u.username, u.role, u.full_name, u.email, u.status
-                    FROM {org_id}_users u
+                    FROM {tenant_prefix(org_id)}users u
                     WHERE u.user_id = %s
                 """, (user_id,))
             else:
                 cur.execute(f"""
                     SELECT u.user_id, u.username, u.role, u.full_name, u.email, u.status
-                    FROM {org_id}_users u
+                    FROM {tenant_prefix(org_id)}users u
                     WHERE u.user_id = %s AND u.user_id = %s
                 """, (user_id, session['user_id']))
 
@@ -4146,24 +6280,33 @@ def edit_users(user_id):
         try:
             with get_db_connection2() as conn:
                 cur = conn.cursor()
+
+                # Usernames are unique across all organizations
+                if username_taken(cur, username, org_id, user_id):
+                    flash("Username is already taken. Please choose another one.", "danger")
+                    return redirect(url_for('edit_users', user_id=user_id))
+
                 cur.execute(f"""
-                    UPDATE {org_id}_users
+                    UPDATE {tenant_prefix(org_id)}users
                     SET username = %s, role = %s, full_name = %s, email = %s, status = %s
                     WHERE user_id = %s
                 """, (username, role_id, full_name, email, status, user_id))
 
+                sync_user_directory(cur, org_id, user_id, username)
+
             flash("User updated successfully", "success")
             return redirect(url_for('manage_users'))
 
         except Exception as e:
             flash(f"Failed to update user: {e}", "danger")
+            return redirect(url_for('edit_users', user_id=user_id))
     else:
         try:
             with get_db_connection2() as conn:
                 cur = conn.cursor()
                 cur.execute(f""" 
                     SELECT u.user_id, u.username, u.role, u.full_name, u.email, u.status
-                    FROM {org_id}_users u 
+                    FROM {tenant_prefix(org_id)}users u 
                     WHERE u.user_id = %s
                 """, (user_id,))
                 user = cur.fetchone()
@@ -4202,7 +6345,7 @@ def manage_clients():
     org_id = session['org_id']
     with get_db_connection2() as conn:
         cur = conn.cursor()
-        cur.execute(f"SELECT * FROM {org_id}_clients ORDER BY customer_name ASC")
+        cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}clients ORDER BY customer_name ASC")
         clients = cur.fetchall()
 
     return render_template('manage_clients.html', clients=clients)
@@ -4235,16 +6378,19 @@ def add_client():
             with get_db_connection2() as conn:
                 cur = conn.cursor()
                 # Check if the client already exists
-                cur.execute(f"SELECT * FROM {org_id}_clients WHERE phone_no = %s", (phone_no,))
+                cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}clients WHERE phone_no = %s", (phone_no,))
                 existing_client = cur.fetchone()
 
+                if not existing_client:
+                    cur.execute(f"""
+                        INSERT INTO {tenant_prefix(org_id)}clients (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created) 
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """, (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created))
+
             if existing_client:
                 flash("Client already exists!", "warning")
             else:
-                cur.execute(f"""
-                    INSERT INTO {org_id}_clients (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created))
+                bump_lookup_version(org_id, 'client_names')
                 flash('Client added successfully!', 'success')
 
             return redirect(url_for('manage_clients'))
@@ -4281,17 +6427,19 @@ def add_client_ajax():
         with get_db_connection2() as conn:
             cur = conn.cursor()
             # Check if client already exists
-            cur.execute(f"SELECT * FROM {org_id}_clients WHERE phone_no = %s", (phone_no,))
+            cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}clients WHERE phone_no = %s", (phone_no,))
             existing_client = cur.fetchone()
 
             if existing_client:
                 return jsonify({'success': False, 'error': 'Client with this phone number already exists.'})
-            else:
-                cur.execute(f"""
-                    INSERT INTO {org_id}_clients (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created))
-                return jsonify({'success': True, 'customer_name': customer_name})
+
+            cur.execute(f"""
+                INSERT INTO {tenant_prefix(org_id)}clients (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (customer_name, institution, phone_no, phone_no_2, email, position, id_no, date_created))
+
+        bump_lookup_version(org_id, 'client_names')
+        return jsonify({'success': True, 'customer_name': customer_name})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -4329,19 +6477,21 @@ def edit_clients(customer_id):
                 cur = conn.cursor()
                 # Update user in the database
                 cur.execute(f"""
-                    UPDATE {org_id}_clients
+                    UPDATE {tenant_prefix(org_id)}clients
                     SET customer_name = %s, institution = %s, phone_no = %s, phone_no_2 = %s,
                     email = %s, position = %s, id_no = %s
                     WHERE customer_id = %s
                 """, (customer_name, institution, phone_no, phone_no_2, email, position, id_no, customer_id))
-                flash("Client updated successfully", "success")
-                return redirect(url_for('manage_clients'))
+
+            bump_lookup_version(org_id, 'client_names')
+            flash("Client updated successfully", "success")
+            return redirect(url_for('manage_clients'))
         except Exception as e:
             flash(f"Failed to update client: {e}", "danger")
     else:
         with get_db_connection2() as conn:
             cur = conn.cursor()
-            cur.execute(f"SELECT * FROM {org_id}_clients WHERE customer_id = %s", (customer_id,))
+            cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}clients WHERE customer_id = %s", (customer_id,))
             client = cur.fetchone()
 
         if client:
@@ -4367,7 +6517,8 @@ def view_invoice(invoice_number):
         with get_db_connection2() as conn:
             cursor = conn.cursor()
             cursor.execute(f"""
-                SELECT * FROM {org_id}_sales 
+                SELECT customer_name, invoice_date, product, quantity, price, total, payment_status
+                FROM {tenant_prefix(org_id)}sales 
                 WHERE invoice_no = %s
                 ORDER BY sales_id
             """, (invoice_number,))
@@ -4376,29 +6527,14 @@ def view_invoice(invoice_number):
         if not sales_items:
             return "Invoice not found", 404
 
-        # Generate filename from invoice number
-        sanitized_invoice_no = re.sub(r'[^a-zA-Z0-9]', '_', invoice_number)
-        filename = f"invoice_{sanitized_invoice_no}.pdf"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-        # Check if PDF already exists
-        if not os.path.exists(filepath):
-            # Create invoice data structure
-            invoice_data = {
-                'customer_name': sales_items[0][3],  # customer_name
-                'invoice_number': invoice_number,
-                'invoice_date': sales_items[0][1],  # invoice_date
-                'items': [{
-                    'description': item[6],  # product
-                    'quantity': item[7],  # qty
-                    'unit_price': item[8],  # amt
-                    'total': item[9]  # total
-                } for item in sales_items],
-                'total_amount': sum(item[9] for item in sales_items),
-                'notes': sales_items[0][10] or '',  # notes
-                'payment_status': sales_items[0][18]  # payment_status
-            }
-            create_invoice(invoice_data, filepath)
+        # The cache key covers the rendered data, so edits and payments produce a fresh document
+        invoice_data = build_invoice_view_data(invoice_number, sales_items)
+        filename, ready = get_cached_document(org_id, 'invoice', invoice_number, create_invoice,
+                                              invoice_data, app.config['UPLOAD_FOLDER'])
+        if not ready:
+            response = make_response("The invoice is still being generated. Please try again shortly.", 202)
+            response.headers['Retry-After'] = '2'
+            return response
 
         return send_from_directory(
             app.config['UPLOAD_FOLDER'],
@@ -4411,55 +6547,14 @@ def view_invoice(invoice_number):
 
 # Generate invoice route
 def create_invoice(invoice_data, filename):
-    # Create canvas
     c = canvas.Canvas(filename, pagesize=letter)
+    draw_letterhead(c, "Invoice")
 
-    # Create style
-    styles = getSampleStyleSheet()
-    style_normal = styles["Normal"]
-
-    # Company information
-    address = "Brightwoods Apartment, Chania Ave"
-    city_state_zip = "PO. Box 74080-00200, Nairobi, KENYA "
-    phone = "Phone: +254-705917383"
-    email = "Email: info@teknobyte.ltd"
-    kra_pin = "PIN: P051155522R"
-
-    c.setFont("Helvetica", 8)
-    c.drawString(430, 740, "")
-    c.drawString(430, 730, address)
-    c.drawString(430, 720, city_state_zip)
-    c.drawString(430, 710, phone)
-    c.drawString(430, 700, email)
-    c.drawString(430, 690, kra_pin)
-    c.drawString(430, 660, "")
-
-    # Invoice title and details
-    c.setFont("Helvetica-Bold", 20)
-    c.drawString(280, 640, "Invoice")
+    # Invoice details and customer information
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 620, "")
     c.drawString(50, 600, f"Date: {invoice_data['invoice_date']}")
-    invoice_label = "Invoice No:"
-    invoice_number = invoice_data['invoice_number']
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 580, invoice_label)
-    label_width = c.stringWidth(invoice_label, "Helvetica-Bold", 12)
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 580, invoice_number)
-
-    # Customer information
-    c.drawString(50, 560, "")
-    client_label = "Client: "
-    client_name = invoice_data['customer_name']
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 540, client_label)
-
-    label_width = c.stringWidth(client_label, "Helvetica-Bold", 12)
-
-    # Client name next to the label
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 540, client_name)
+    draw_labelled_value(c, 580, "Invoice No:", invoice_data['invoice_number'])
+    draw_labelled_value(c, 540, "Client: ", invoice_data['customer_name'])
 
     # Items table
     data = [
@@ -4472,21 +6567,7 @@ def create_invoice(invoice_data, filename):
             f"Ksh {item['unit_price']:,.1f}",
             f"Ksh {item['total']:,.1f}"
         ])
-
-    table = Table(data, colWidths=[3 * inch, 1 * inch, 1.5 * inch, 1.5 * inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.gray),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)]))
-
-    table_height = len(data) * 20
-    table.wrapOn(c, 0, 0)
-    table.drawOn(c, 50, 500 - table_height)
+    table_height = draw_items_table(c, data, INVOICE_TABLE_STYLE)
 
     # Add total amount
     c.setFont("Helvetica-Bold", 12)
@@ -4496,18 +6577,11 @@ def create_invoice(invoice_data, filename):
     if invoice_data['notes']:
         c.setFont("Helvetica-Bold", 12)
         c.drawString(50, 360, "Notes:")
-        c.setFont("Helvetica", 10)
-        notes = Paragraph(invoice_data['notes'].replace('\n', '<br/>'),
-                          ParagraphStyle(name='Normal', alignment=TA_LEFT, parent=style_normal, fontName='Helvetica',
-                                         fontSize=10, leading=14))
+        notes = Paragraph(invoice_data['notes'].replace('\n', '<br/>'), NOTES_STYLE)
         w, h = notes.wrap(400, 100)
         notes.drawOn(c, 50, 340 - h)
 
-    # Accountant details
-    c.setFont("Helvetica", 12)
-    c.drawString(50, 200, "John Kungu")
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 180, "ACCOUNTANT")
+    draw_signature(c)
     c.save()
 
 
@@ -4535,7 +6609,7 @@ def products():
 
                 # Main query
                 query = sql.SQL(f"""
-                    SELECT * FROM {org_id}_products WHERE status = 'Active'
+                    SELECT * FROM {tenant_prefix(org_id)}products WHERE status = 'Active'
                 """)
 
                 # Add WHERE clause only if not showing all and search term exists
@@ -4596,7 +6670,7 @@ def products():
                 with get_db_connection2() as conn:
                     cur = conn.cursor()
                     cur.execute(f"""
-                                UPDATE {org_id}_products SET status = 'Inactive' WHERE product_number = %s
+                                UPDATE {tenant_prefix(org_id)}products SET status = 'Inactive' WHERE product_number = %s
                             """, (product_number,))
                     return jsonify({'success': True, 'message': 'Product deleted successfully'})
             except Exception as e:
@@ -4620,7 +6694,7 @@ def products():
 
                     # Update query
                     update_query = sql.SQL(f"""
-                            UPDATE {org_id}_products
+                            UPDATE {tenant_prefix(org_id)}products
                             SET 
                                 product = %s,
                                 edition = %s,
@@ -4648,6 +6722,8 @@ def products():
 
                     # Get the updated record
                     updated_record = cur.fetchone()
+
+                bump_lookup_version(org_id, 'product_names')
                 # Format the updated record for response
 
                 date_created = ''
@@ -4707,7 +6783,7 @@ def products():
                     cur = conn.cursor()
 
                     insert_query = f"""
-                                INSERT INTO {org_id}_products (
+                                INSERT INTO {tenant_prefix(org_id)}products (
                                     product, edition, isbn, date_published, publisher, 
                                     author, date_created, frequency, status
                                 ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'Active')
@@ -4726,6 +6802,8 @@ def products():
 
                     product, date_created = result
 
+                bump_lookup_version(org_id, 'product_names')
+
                 # Format the date safely
                 formatted_date = ''
                 try:
@@ -4790,7 +6868,7 @@ def suppliers():
 
                 # Main query
                 query = sql.SQL(f"""
-                    SELECT * FROM {org_id}_suppliers WHERE status = 'Active'
+                    SELECT * FROM {tenant_prefix(org_id)}suppliers WHERE status = 'Active'
                 """)
 
                 # Add WHERE clause only if not showing all and search term exists
@@ -4858,7 +6936,7 @@ def suppliers():
                 with get_db_connection2() as conn:
                     cur = conn.cursor()
                     cur.execute(f"""
-                        UPDATE {org_id}_suppliers SET status = 'Not Active' WHERE supplier_id = %s
+                        UPDATE {tenant_prefix(org_id)}suppliers SET status = 'Not Active' WHERE supplier_id = %s
                     """, (supplier_id,))
                     return jsonify({'success': True, 'message': 'Supplier deleted successfully'})
             except Exception as e:
@@ -4879,7 +6957,7 @@ def suppliers():
 
                     # Update query
                     update_query = sql.SQL(f"""
-                        UPDATE {org_id}_suppliers
+                        UPDATE {tenant_prefix(org_id)}suppliers
                         SET 
                             supplier = %s,
                             contact = %s,
@@ -4959,7 +7037,7 @@ def suppliers():
                     cur = conn.cursor()
 
                     insert_query = f"""
-                        INSERT INTO {org_id}_suppliers (
+                        INSERT INTO {tenant_prefix(org_id)}suppliers (
                             supplier, contact, telephone, email
                         ) VALUES (%s, %s, %s, %s)
                         RETURNING supplier_id, supplier, contact, telephone, email, created_date
@@ -5068,7 +7146,7 @@ def search_billing_account():
 
             # Start building query
             query = f"""
-                       SELECT * FROM {org_id}_billing_account
+                       SELECT * FROM {tenant_prefix(org_id)}billing_account
                        WHERE 1=1 AND status = 'Active'
                    """
             params = []
@@ -5152,7 +7230,7 @@ def edit_billing_account(billing_acc_id):
             cur = conn.cursor()
             # Deactivate the old billing account
             cur.execute(f"""
-                        UPDATE {org_id}_billing_account
+                        UPDATE {tenant_prefix(org_id)}billing_account
                         SET status = 'Not Active'
                         WHERE invoice_number = %s RETURNING invoice_number
                         """, (invoice_number,))
@@ -5163,7 +7241,7 @@ def edit_billing_account(billing_acc_id):
 
             # Create a new billing account
             cur.execute(f"""
-                        INSERT INTO {org_id}_billing_account (service_provider, account_name, account_number, category,
+                        INSERT INTO {tenant_prefix(org_id)}billing_account (service_provider, account_name, account_number, category,
                                                      paybill_number, ussd_number, frequency, billing_date, account_owner,
                                                      invoice_number, status, bank_account, bill_amount)
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'Active', %s, %s) RETURNING *
@@ -5177,7 +7255,7 @@ def edit_billing_account(billing_acc_id):
 
             # Insert the new invoice
             cur.execute(f"""
-                        INSERT INTO {org_id}_invoices (invoice_number)
+                        INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                         VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                         """, (new_invoice_no,))
 
@@ -5197,15 +7275,16 @@ def edit_billing_account(billing_acc_id):
             delta = None
 
         if delta:
-            next_due_date = billing_date
-            while next_due_date <= today + delta:
+            due_dates = recurring_due_dates(billing_date, delta, today + delta)
+            bill_invoice_numbers = generate_invoice_numbers(len(due_dates))
+
+            for next_due_date, bill_invoice_number in zip(due_dates, bill_invoice_numbers):
                 bill_status = 'Active'
                 pay_status = 'Not Paid'
-                bill_invoice_number = generate_next_invoice_number()
 
                 # Insert into bills table
                 cur.execute(f"""
-                            INSERT INTO {org_id}_bills (service_provider, account_name, account_number, category,
+                            INSERT INTO {tenant_prefix(org_id)}bills (service_provider, account_name, account_number, category,
                                                paybill_number, ussd_number, billing_date, bill_amount,
                                                account_owner, created_date, pay_status, bill_invoice_number,
                                                invoice_number, status, bank_account)
@@ -5219,7 +7298,7 @@ def edit_billing_account(billing_acc_id):
 
                 # Insert into invoices table
                 cur.execute(f"""
-                            INSERT INTO {org_id}_invoices (invoice_number)
+                            INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                             VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                             """, (bill_invoice_number,))
 
@@ -5228,8 +7307,6 @@ def edit_billing_account(billing_acc_id):
                     'invoice_no': bill_invoice_number
                 })
 
-                next_due_date += delta
-
         return jsonify({
             'status': 'success',
             'message': 'Billing account updated successfully',
@@ -5278,7 +7355,7 @@ def add_billing_account():
 
             # Insert into billing_account table
             insert_billing_query = f"""
-                INSERT INTO {org_id}_billing_account (service_provider, account_name, account_number,
+                INSERT INTO {tenant_prefix(org_id)}billing_account (service_provider, account_name, account_number,
                     category, paybill_number, ussd_number, frequency, billing_date, \
                     bill_amount, account_owner, status, bank_account, invoice_number)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, \
@@ -5295,7 +7372,7 @@ def add_billing_account():
 
             # Insert into invoices table
             cur.execute(f"""
-                INSERT INTO {org_id}_invoices (invoice_number)
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                 VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
             """, (invoice_number,))
 
@@ -5310,14 +7387,14 @@ def add_billing_account():
             delta = None
 
         generated_bills = []  # List to store the generated bills
-        next_due_date = billing_date
+        due_dates = recurring_due_dates(billing_date, delta, today + delta)
+        bill_invoice_numbers = generate_invoice_numbers(len(due_dates))
 
-        while next_due_date <= today + delta:
+        for next_due_date, bill_invoice_number in zip(due_dates, bill_invoice_numbers):
             bill_status = 'Active'
             pay_status = 'Not Paid'
-            bill_invoice_number = generate_next_invoice_number()
             cur.execute(f"""
-                INSERT INTO {org_id}_bills (service_provider, account_name, account_number, category,
+                INSERT INTO {tenant_prefix(org_id)}bills (service_provider, account_name, account_number, category,
                                    paybill_number, ussd_number, billing_date, bill_amount,
                                    account_owner, created_date, pay_status, bill_invoice_number,
                                    invoice_number, status, bank_account)
@@ -5330,7 +7407,7 @@ def add_billing_account():
             ))
 
             cur.execute(f"""
-                INSERT INTO {org_id}_invoices (invoice_number)
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                 VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                 """, (bill_invoice_number,))
 
@@ -5338,7 +7415,6 @@ def add_billing_account():
                 'due_date': next_due_date.strftime('%d-%m-%Y'),
                 'invoice_no': bill_invoice_number
             })
-            next_due_date += delta
 
         return jsonify({
             'success': True,
@@ -5383,7 +7459,7 @@ def delete_billing_account():
 
             # Update the status to 'Not active'
             update_query = sql.SQL(f"""
-                UPDATE {org_id}_billing_account
+                UPDATE {tenant_prefix(org_id)}billing_account
                 SET status = 'Not Active'
                 WHERE invoice_number = %s
                 RETURNING invoice_number, account_name
@@ -5412,34 +7488,79 @@ def delete_billing_account():
         }), 500
 
 
-def generate_next_invoice_number_for_org(org_id):
-    """Generate invoice number for a specific organization (no session required)"""
-    try:
+def invoice_number_period():
+    """Return (MM, YY) for the current invoice numbering period"""
+    now = datetime.now()
+    return f"{now.month:02d}", f"{now.year % 100:02d}"
+
+
+def seed_invoice_sequence(cur, org_id, month, year_short):
+    """Highest sequence already used this month, from format TKB/MM###/YY"""
+    cur.execute(f"""
+        SELECT COALESCE(MAX(substring(invoice_number FROM '^TKB/[0-9]{{2}}([0-9]+)/')::int), 0)
+        FROM {tenant_prefix(org_id)}invoices 
+        WHERE invoice_number LIKE %s
+    """, (f"TKB/{month}%/{year_short}",))
+    return cur.fetchone()[0]
+
+
+def allocate_invoice_numbers(org_id, count=1):
+    """
+    Atomically reserve `count` invoice numbers for an organization.
+    Numbers come from a per-org, per-month sequence (created and seeded from the
+    invoices table on first use), so concurrent requests never get the same number.
+    Numbers of rolled back transactions are not reused.
+    """
+    month, year_short = invoice_number_period()
+    sequence = f"{tenant_prefix(org_id)}invoice_seq_{month}{year_short}"
+
+    for attempt in range(2):
         with get_db_connection2() as conn:
             cur = conn.cursor()
+            # nextval(NULL) is NULL, so a missing sequence does not abort the transaction
+            cur.execute("""
+                SELECT nextval(to_regclass(%s)) FROM generate_series(1, %s)
+            """, (sequence, count))
+            values = [row[0] for row in cur.fetchall()]
 
-            now = datetime.now()
-            month = f"{now.month:02d}"
-            year_short = f"{now.year % 100:02d}"
+        if values and values[0] is not None:
+            return [f"TKB/{month}{seq:03d}/{year_short}" for seq in sorted(values)]
 
-            # Query the tenant-specific invoices table
-            cur.execute(f"""
-                SELECT invoice_number FROM {org_id}_invoices 
-                WHERE invoice_number LIKE %s 
-                ORDER BY id DESC LIMIT 1
-            """, (f"TKB/{month}%/{year_short}",))
+        try:
+            with get_db_connection2() as conn:
+                cur = conn.cursor()
+                last_seq = seed_invoice_sequence(cur, org_id, month, year_short)
+                cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence} START WITH {last_seq + 1}")
+        except (errors.UniqueViolation, errors.DuplicateTable):
+            # Another request created it first
+            pass
 
-            last_invoice = cur.fetchone()
+    raise RuntimeError(f"Could not allocate invoice numbers for org {org_id}")
 
-            if last_invoice:
-                # Extract sequence number from format: TKB/MM###/YY
-                last_seq = int(last_invoice[0].split("/")[1][2:])  # Get digits after MM
-                next_seq = last_seq + 1
-            else:
-                next_seq = 1
 
-            invoice_number = f"TKB/{month}{next_seq:03d}/{year_short}"
-            return invoice_number
+def peek_next_invoice_number(org_id):
+    """Next invoice number for display only; it is not reserved"""
+    month, year_short = invoice_number_period()
+    sequence = f"{tenant_prefix(org_id)}invoice_seq_{month}{year_short}"
+    try:
+        with get_db_connection2() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT COALESCE(pg_sequence_last_value(seqrelid) + 1, seqstart) FROM pg_sequence 
+                WHERE seqrelid = to_regclass(%s)
+            """, (sequence,))
+            result = cur.fetchone()
+            next_seq = result[0] if result else seed_invoice_sequence(cur, org_id, month, year_short) + 1
+            return f"TKB/{month}{next_seq:03d}/{year_short}"
+    except Exception as e:
+        log_error_to_file(f"Error reading next invoice number for org {org_id}: {str(e)}")
+        return None
+
+
+def generate_next_invoice_number_for_org(org_id):
+    """Generate invoice number for a specific organization (no session required)"""
+    try:
+        return allocate_invoice_numbers(org_id)[0]
     except Exception as e:
         log_error_to_file(f"Error generating invoice number for org {org_id}: {str(e)}")
         return None
@@ -5455,6 +7576,23 @@ def generate_next_invoice_number():
     return generate_next_invoice_number_for_org(org_id)
 
 
+def generate_invoice_numbers(count):
+    """Reserve a block of invoice numbers using session org_id (recurring invoice backfills)"""
+    if count <= 0:
+        return []
+    return allocate_invoice_numbers(session['org_id'], count)
+
+
+def recurring_due_dates(start_date, delta, until):
+    """Due dates from start_date stepping by delta, up to and including until"""
+    due_dates = []
+    next_due_date = start_date
+    while next_due_date <= until:
+        due_dates.append(next_due_date)
+        next_due_date += delta
+    return due_dates
+
+
 @app.route('/get_next_invoice_number')
 def get_next_invoice_number():
     invoice_number = generate_next_invoice_number()
@@ -5493,7 +7631,7 @@ def search_bills():
 
             # Start building query
             query = f"""
-                       SELECT * FROM {org_id}_bills 
+                       SELECT * FROM {tenant_prefix(org_id)}bills 
                        WHERE status = 'Active'
                        AND 1=1
                    """
@@ -5589,7 +7727,7 @@ def edit_bill(bill_id):
             with get_db_connection2() as conn:
                 cur = conn.cursor()
                 cur.execute(f"""
-                    UPDATE {org_id}_bills SET
+                    UPDATE {tenant_prefix(org_id)}bills SET
                         billing_date = %s,
                         invoice_number = %s,
                         service_provider = %s,
@@ -5601,12 +7739,13 @@ def edit_bill(bill_id):
                         bill_amount = %s,
                         account_owner = %s,
                         bill_invoice_number = %s,
-                        bank_account = %s
+                        bank_account = %s,
+                        pay_status = CASE WHEN %s - total_paid <= 0 THEN 'Paid' ELSE 'Not Paid' END
                     WHERE bill_id = %s
                 """, (
                     billing_date, invoice_number, service_provider, account_name,
                     account_number, category, paybill_number, ussd_number, bill_amount,
-                    account_owner, bill_invoice_number, bank_account, bill_id
+                    account_owner, bill_invoice_number, bank_account, bill_amount, bill_id
                 ))
 
                 return jsonify({
@@ -5630,7 +7769,7 @@ def edit_bill(bill_id):
         with get_db_connection2() as conn:
             cur = conn.cursor()
             # Fallback for GET (not used in modal AJAX)
-            cur.execute("SELECT * FROM bills WHERE bill_id = %s", (bill_id,))
+            cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}bills WHERE bill_id = %s", (bill_id,))
             bill = cur.fetchone()
             return jsonify({"bill": bill})
     except Exception as e:
@@ -5662,7 +7801,7 @@ def delete_bill():
 
             # Update the status to 'Not active'
             update_query = sql.SQL(f"""
-                UPDATE {org_id}_bills
+                UPDATE {tenant_prefix(org_id)}bills
                 SET status = 'Not Active'
                 WHERE bill_invoice_number = %s
                 RETURNING bill_invoice_number, account_name
@@ -5727,7 +7866,7 @@ def add_bill():
             cur = conn.cursor()
             # Insert into bills table
             cur.execute(f"""
-                INSERT INTO {org_id}_bills (service_provider, account_name, account_number, category,
+                INSERT INTO {tenant_prefix(org_id)}bills (service_provider, account_name, account_number, category,
                     paybill_number, ussd_number, billing_date, bill_amount,
                     account_owner, created_date, pay_status, bill_invoice_number,
                     status, bank_account)
@@ -5745,7 +7884,7 @@ def add_bill():
 
             # Insert into invoices table
             cur.execute(f"""
-                INSERT INTO {org_id}_invoices (invoice_number)
+                INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                 VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
             """, (bill_invoice_number,))
 
@@ -5797,13 +7936,10 @@ def view_bills():
             category = request.form.get('category', '')
             with get_db_connection2() as conn:
                 cur = conn.cursor()
-                # Build the query with filters
+                # Build the query with filters; total_paid and balance are the last two columns of bills
                 query = f"""
-                        SELECT b.*,
-                               COALESCE(SUM(p.paid_amount), 0) as total_paid,
-                               (b.bill_amount - COALESCE(SUM(p.paid_amount), 0)) as actual_balance
-                        FROM {org_id}_bills b
-                                 LEFT JOIN {org_id}_payments p ON b.bill_invoice_number = p.invoice_number
+                        SELECT b.*
+                        FROM {tenant_prefix(org_id)}bills b
                         WHERE b.billing_date BETWEEN %s AND %s \
                         """
                 params = [start_date, end_date]
@@ -5816,22 +7952,10 @@ def view_bills():
                     query += " AND b.category = %s"
                     params.append(category)
 
-                query += " GROUP BY b.bill_id ORDER BY b.billing_date DESC"
+                query += " ORDER BY b.billing_date DESC"
 
                 cur.execute(query, params)
-                bills_raw = cur.fetchall()
-
-            # Process the bills to include calculated balance
-            bills = []
-            for bill in bills_raw:
-                # bill now includes total_paid and actual_balance at the end
-                bill_list = list(bill[:-2])  # Remove the calculated fields
-                total_paid = bill[-2]
-                actual_balance = bill[-1]
-
-                # Add the calculated values to the bill data
-                bill_list.extend([total_paid, actual_balance])
-                bills.append(bill_list)
+                bills = cur.fetchall()
         return render_template('bills/view-bills.html',
                                bills=bills,
                                account_owners=account_owners,
@@ -5850,99 +7974,28 @@ def view_bills():
 
 # Generate payment pdf route
 def create_payment(payment_data, filename):
-    # Create a canvas
     c = canvas.Canvas(filename, pagesize=letter)
+    draw_letterhead(c, "Payment")
 
-    # Set up styles
-    styles = getSampleStyleSheet()
-    style_normal = styles["Normal"]
-
-    # Add company logo as the letterhead
-    # logo_path = 'teknobyte-tagline.jpg'
-    # logo_width = 2 * inch
-    # logo_height = 0.5 * inch
-    # logo_x = 430
-    # logo_y = 750
-    # c.drawImage(logo_path, logo_x, logo_y, width=logo_width, height=logo_height)
-
-    # # Add company information
-    address = "Brightwoods Apartment, Chania Ave "
-    city_state_zip = "PO. Box 74080-00200, Nairobi, KENYA "
-    phone = "Phone: +254-705917383"
-    email = "Email: info@teknobyte.ltd"
-    kra_pin = "PIN: P051155522R"
-    c.setFont("Helvetica", 8)
-    c.drawString(430, 740, "")
-    c.drawString(430, 730, address)
-    c.drawString(430, 720, city_state_zip)
-    c.drawString(430, 710, phone)
-    c.drawString(430, 700, email)
-    c.drawString(430, 690, kra_pin)
-    c.drawString(430, 660, "")
-    # Add invoice details
-    c.setFont("Helvetica-Bold", 20)
-    c.drawString(280, 640, "Payment")
+    # Payment details
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 620, "")
-
     c.drawString(50, 600, f"Date:               {payment_data['payment_date']}")
-    invoice_label = "Payment No:"
-    invoice_number = payment_data['invoice_number']
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 580, invoice_label)
-    label_width = c.stringWidth(invoice_label, "Helvetica-Bold", 12)
-
-    # Draw the client name in regular font next to the label
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 580, invoice_number)
-
-    # c.drawString(50, 610, f"Invoice Number: {invoice_data['invoice_number']}")
-    c.drawString(50, 560, "")
-    client_label = "Account:"
-    account_name = payment_data['account_name']
-
-    # Draw the bold label
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 540, client_label)
-
-    # Calculate the width of the label text to position the client name
-    label_width = c.stringWidth(client_label, "Helvetica-Bold", 12)
-
-    # Draw the client name in regular font next to the label
-    c.setFont("Helvetica", 12)
-    c.drawString(50 + label_width + 5, 540, account_name)
+    draw_labelled_value(c, 580, "Payment No:", payment_data['invoice_number'])
+    draw_labelled_value(c, 540, "Account:", payment_data['account_name'])
 
     # Add line items table
     data = [['Service Provider', 'Account Name', 'Account No', 'Bill Amt']]
     for item in payment_data['items']:
         data.append([item['description'], item['quantity'], item['unit-price'], item['total']])
-
-    # Set the width of each column
-    col_widths = [1.5 * inch, 2 * inch, 1.5 * inch, 2 * inch]  # Adjust widths as needed
-    t = Table(data, colWidths=col_widths)
-    t.setStyle(TableStyle([('BACKGROUND', (0, 0), (-1, 0), colors.gray),
-                           ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                           ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                           ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                           ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                           ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                           ('GRID', (0, 0), (-1, -1), 1, colors.black)]))
-
-    table_height = len(data) * 20
-    t.wrapOn(c, 0, 0)
-    t.drawOn(c, 50, 500 - table_height)
+    table_height = draw_items_table(c, data, ITEMS_TABLE_STYLE,
+                                    col_widths=[1.5 * inch, 2 * inch, 1.5 * inch, 2 * inch])
 
     # Add total amount
     c.setFont("Helvetica-Bold", 12)
     c.drawString(400, 480 - table_height, f"Total Paid: {payment_data['total_amount']}")
     c.drawString(400, 460 - table_height, f"Balance:    {payment_data['balance']}")
 
-    c.setFont("Helvetica", 12)
-    c.drawString(50, 200, "John Kungu")
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, 180, "ACCOUNTANT")
-
-    # Save the PDF
+    draw_signature(c)
     c.save()
 
 
@@ -5966,24 +8019,15 @@ def pay_bill(bill_id):
         with get_db_connection2() as conn:
             cur = conn.cursor()
 
-            # Get bill details
-            cur.execute(f"SELECT * FROM {org_id}_bills WHERE bill_id = %s", (bill_id,))
+            # Get bill details, locked so a concurrent payment cannot slip past the balance check
+            cur.execute(f"SELECT * FROM {tenant_prefix(org_id)}bills WHERE bill_id = %s FOR UPDATE", (bill_id,))
             bill = cur.fetchone()
 
             if not bill:
                 return jsonify({'success': False, 'message': 'Bill not found'})
 
-            # Get current balance (original amount minus any existing payments)
-            cur.execute(f"""
-                        SELECT COALESCE(SUM(paid_amount), 0) as total_paid
-                        FROM {org_id}_payments
-                        WHERE invoice_number = %s
-                        """, (bill[12],))  # bill[12] is invoice_number
-
-            result = cur.fetchone()
-            total_paid = float(result[0]) if result else 0
             bill_amount = float(bill[8])  # Original bill amount
-            current_balance = bill_amount - total_paid
+            current_balance = float(bill[17])  # bill[17] is balance (bill_amount minus total_paid)
 
             # Validate payment amount
             if paid_amount <= 0:
@@ -5994,15 +8038,22 @@ def pay_bill(bill_id):
                     {'success': False,
                      'message': f'Payment amount cannot exceed current balance of Ksh {current_balance:,.2f}'})
 
-            # Calculate new balance after this payment
-            new_balance = current_balance - paid_amount
+            # Move the bill's running total by this payment
+            cur.execute(f"""
+                        UPDATE {tenant_prefix(org_id)}bills
+                        SET total_paid = total_paid + %s,
+                            pay_status = CASE WHEN bill_amount - (total_paid + %s) <= 0 THEN 'Paid' ELSE 'Not Paid' END
+                        WHERE bill_id = %s
+                        RETURNING balance
+                        """, (paid_amount, paid_amount, bill_id))
+            new_balance = float(cur.fetchone()[0])
 
             # Generate payment reference number
             payment_reference_no = generate_next_invoice_number()
 
             # Record payment
             cur.execute(f"""
-                        INSERT INTO {org_id}_payments (service_provider, account_name, account_number, category,
+                        INSERT INTO {tenant_prefix(org_id)}payments (service_provider, account_name, account_number, category,
                                               paybill_number, ussd_number, due_date, bill_amount,
                                               balance, paid_amount, invoice_number, payment_reference_number,
                                               account_owner, paid_date, bank_account)
@@ -6032,7 +8083,7 @@ def pay_bill(bill_id):
 
             payment_id = payment_result[0]
             cur.execute(f"""
-                        INSERT INTO {org_id}_invoices (invoice_number)
+                        INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                         VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                         """, (payment_reference_no,))
 
@@ -6042,12 +8093,10 @@ def pay_bill(bill_id):
             should_generate_next_bill = False
 
             if new_balance <= 0:
-                cur.execute(f"UPDATE {org_id}_bills SET pay_status = 'Paid' WHERE bill_id = %s", (bill_id,))
-
                 # Check if this bill has a corresponding billing account
                 cur.execute(f"""
                             SELECT *
-                            FROM {org_id}_billing_account
+                            FROM {tenant_prefix(org_id)}billing_account
                             WHERE invoice_number = %s
                             """, (bill[13],))
 
@@ -6057,7 +8106,7 @@ def pay_bill(bill_id):
                     # CHECK IF THIS IS THE MOST RECENT BILL FOR THIS BILLING ACCOUNT
                     cur.execute(f"""
                                 SELECT MAX(billing_date) as latest_bill_date
-                                FROM {org_id}_bills 
+                                FROM {tenant_prefix(org_id)}bills 
                                 WHERE invoice_number = %s
                                 """, (bill[13],))
 
@@ -6089,7 +8138,7 @@ def pay_bill(bill_id):
 
                         # Create the next bill
                         cur.execute(f"""
-                                    INSERT INTO {org_id}_bills (service_provider, account_name, account_number, category,
+                                    INSERT INTO {tenant_prefix(org_id)}bills (service_provider, account_name, account_number, category,
                                                        paybill_number, ussd_number, billing_date, bill_amount,
                                                        account_owner, bill_invoice_number, invoice_number)
                                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
@@ -6107,17 +8156,14 @@ def pay_bill(bill_id):
                             billing_account[11]  # billing account invoice number
                         ))
                         cur.execute(f"""
-                                    INSERT INTO {org_id}_invoices (invoice_number)
+                                    INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                                     VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                                     """, (next_invoice_number,))
 
-            else:
-                cur.execute(f"UPDATE {org_id}_bills SET pay_status = 'Not Paid' WHERE bill_id = %s", (bill_id,))
-
             # Get the complete payment details for PDF generation
             cur.execute(f"""
                         SELECT *
-                        FROM {org_id}_payments p
+                        FROM {tenant_prefix(org_id)}payments p
                         WHERE p.payment_id = %s
                         """, (payment_id,))
             payment_details = cur.fetchone()
@@ -6145,7 +8191,7 @@ def pay_bill(bill_id):
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-            create_payment(payment_data, filepath)
+            submit_render(create_payment, payment_data, filepath)
 
             # Determine message based on payment status
             if new_balance <= 0:
@@ -6200,7 +8246,8 @@ def view_payments():
                 cur = conn.cursor()
                 # Build the query with filters
                 query = f"""
-                        SELECT * FROM {org_id}_payments
+                        SELECT * FROM {tenant_prefix(org_id)}payments
+                        WHERE paid_date BETWEEN %s AND %s
                         """
                 params = [start_date, end_date]
 
@@ -6255,15 +8302,14 @@ def update_payment(payment_id):
         with get_db_connection2() as conn:
             cur = conn.cursor()
 
-            # Get current payment details and associated bill information
+            # Get current payment details and associated bill information, locking both rows
             cur.execute(f"""
                         SELECT p.*, b.bill_id, b.bill_amount, b.billing_date, b.invoice_number as billing_account_ref,
-                               COALESCE(SUM(p2.paid_amount), 0) as total_paid_excluding_current
-                        FROM {org_id}_payments p
-                        JOIN {org_id}_bills b ON p.invoice_number = b.bill_invoice_number
-                        LEFT JOIN {org_id}_payments p2 ON p.invoice_number = p2.invoice_number AND p2.payment_id != p.payment_id
+                               b.total_paid - p.paid_amount as total_paid_excluding_current
+                        FROM {tenant_prefix(org_id)}payments p
+                        JOIN {tenant_prefix(org_id)}bills b ON p.invoice_number = b.bill_invoice_number
                         WHERE p.payment_id = %s
-                        GROUP BY p.payment_id, b.bill_id
+                        FOR UPDATE OF b, p
                         """, (payment_id,))
 
             payment_info = cur.fetchone()
@@ -6280,7 +8326,7 @@ def update_payment(payment_id):
             # Calculate new total paid amount and balance
             total_paid_excluding = float(payment_info[-1] if payment_info[-1] else 0)  # total_paid_excluding_current
             new_total_paid = total_paid_excluding + paid_amount
-            bill_amount = float(payment_info[8] if payment_info[8] else 0)  # bill_amount from bills table
+            bill_amount = float(payment_info[18] if payment_info[18] else 0)  # bill_amount from bills table
             new_balance = bill_amount - new_total_paid
 
             print("=== BALANCE CALCULATION DEBUG ===")
@@ -6293,17 +8339,19 @@ def update_payment(payment_id):
 
             # Update payment with the calculated balance
             cur.execute(f"""
-                        UPDATE {org_id}_payments 
+                        UPDATE {tenant_prefix(org_id)}payments 
                         SET paid_amount = %s, paid_date = %s, bank_account = %s, balance = %s
                         WHERE payment_id = %s
                         """, (paid_amount, payment_date, bank_account, new_balance, payment_id))
 
-            # Update bill status based on new balance
+            # Update the bill's running total and status by the change in this payment
             bill_id = payment_info[17]  # bill_id
-            if new_balance <= 0:
-                cur.execute("UPDATE bills SET pay_status = 'Paid' WHERE bill_id = %s", (bill_id,))
-            else:
-                cur.execute("UPDATE bills SET pay_status = 'Not Paid' WHERE bill_id = %s", (bill_id,))
+            cur.execute(f"""
+                        UPDATE {tenant_prefix(org_id)}bills
+                        SET total_paid = %s,
+                            pay_status = CASE WHEN %s <= 0 THEN 'Paid' ELSE 'Not Paid' END
+                        WHERE bill_id = %s
+                        """, (new_total_paid, new_balance, bill_id))
 
             billing_account = None
             next_due_date = None
@@ -6317,7 +8365,7 @@ def update_payment(payment_id):
                 # Check if this bill has a corresponding billing account
                 cur.execute(f"""
                             SELECT *
-                            FROM {org_id}_billing_account
+                            FROM {tenant_prefix(org_id)}billing_account
                             WHERE invoice_number = %s
                             """, (billing_account_ref,))
 
@@ -6327,7 +8375,7 @@ def update_payment(payment_id):
                     # CHECK IF THIS IS THE MOST RECENT BILL FOR THIS BILLING ACCOUNT
                     cur.execute(f"""
                                 SELECT MAX(billing_date) as latest_bill_date
-                                FROM {org_id}_bills 
+                                FROM {tenant_prefix(org_id)}bills 
                                 WHERE invoice_number = %s
                                 """, (billing_account_ref,))
 
@@ -6358,7 +8406,7 @@ def update_payment(payment_id):
                         # CHECK IF A BILL WITH THE SAME BILLING DATE ALREADY EXISTS
                         cur.execute(f"""
                                     SELECT COUNT(*) as bill_count
-                                    FROM {org_id}_bills 
+                                    FROM {tenant_prefix(org_id)}bills 
                                     WHERE invoice_number = %s AND billing_date = %s
                                     """, (billing_account_ref, next_due_date.strftime('%Y-%m-%d')))
 
@@ -6373,7 +8421,7 @@ def update_payment(payment_id):
 
                             # Create the next bill
                             cur.execute(f"""
-                                        INSERT INTO {org_id}_bills (service_provider, account_name, account_number, category,
+                                        INSERT INTO {tenant_prefix(org_id)}bills (service_provider, account_name, account_number, category,
                                                            paybill_number, ussd_number, billing_date, bill_amount,
                                                            account_owner, bill_invoice_number, invoice_number)
                                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
@@ -6392,7 +8440,7 @@ def update_payment(payment_id):
                             ))
 
                             cur.execute(f"""
-                                        INSERT INTO {org_id}_invoices (invoice_number)
+                                        INSERT INTO {tenant_prefix(org_id)}invoices (invoice_number)
                                         VALUES (%s) ON CONFLICT (invoice_number) DO NOTHING
                                         """, (next_invoice_number,))
 
@@ -6427,7 +8475,7 @@ def update_payment(payment_id):
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-            create_payment(payment_data, filepath)
+            submit_render(create_payment, payment_data, filepath)
 
             # Prepare response message
             if new_balance <= 0:
@@ -6454,6 +8502,11 @@ if __name__ == '__main__':
     # Create tables when the app starts
     with app.app_context():
         create_subscription_tables()
+        create_user_directory_table()
+        create_mpesa_request_routes_table()
+        create_document_cache_table()
+        create_tenant_schema_migrations_table()
+        create_customer_search_for_all_tenants()
 
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['RECEIPT_FOLDER'], exist_ok=True)
@@ -0,0 +1,57 @@
+import sys
+
+from Sales import (TENANT_MIGRATIONS, create_tenant_schema_migrations_table, move_tenant_to_partitions,
+                   move_tenant_to_schema, recount_bill_totals, run_tenant_migrations, tenant_migration_status)
+
+# Applies outstanding tenant schema migrations (indexes are built CONCURRENTLY, so the app can keep running)
+# Usage: python migrate-tenants.py             migrate every tenant
+#        python migrate-tenants.py AAAB AAAC   migrate only these tenants
+#        python migrate-tenants.py --status    show the latest version applied per tenant
+#        python migrate-tenants.py --recount-bills [AAAB ...]
+#                                              recompute bills.total_paid from payments (once, after deploying)
+#        TENANCY_MODE=schema python migrate-tenants.py --to-schema [AAAB ...]
+#                                              move {org_id}_ tables into per-org schemas (app stopped)
+#        TENANCY_MODE=partitioned python migrate-tenants.py --to-partitions [AAAB ...]
+#                                              attach {org_id}_ tables to the shared_* partitioned tables
+
+
+if __name__ == '__main__':
+    create_tenant_schema_migrations_table()
+    latest = TENANT_MIGRATIONS[-1]['version']
+
+    if sys.argv[1:] == ['--status']:
+        print(f"{'org_id':<8}{'version':>8}  (latest {latest})")
+        for org_id, version in tenant_migration_status():
+            print(f"{org_id:<8}{version if version is not None else '-':>8}")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['--recount-bills']:
+        # Tenant migration 4 adds the bill totals
+        org_ids = sys.argv[2:] or [org_id for org_id, version in tenant_migration_status() if version and version >= 4]
+        for org_id in org_ids:
+            print(f"✅ {org_id}: {recount_bill_totals(org_id)} bill(s) corrected")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['--to-schema']:
+        org_ids = sys.argv[2:] or [org_id for org_id, version in tenant_migration_status()]
+        for org_id in org_ids:
+            if move_tenant_to_schema(org_id):
+                print(f"✅ {org_id}: moved into its schema")
+            else:
+                print(f"{org_id}: no prefixed tables to move")
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['--to-partitions']:
+        # Every org needs the same columns before its tables can become partitions
+        results = run_tenant_migrations(sys.argv[2:] or None)
+        for org_id, versions in results.items():
+            if versions is None:
+                print(f"❌ {org_id}: not attached, its migrations failed")
+            elif move_tenant_to_partitions(org_id):
+                print(f"✅ {org_id}: attached to the shared tables")
+        sys.exit(0)
+
+    results = run_tenant_migrations(sys.argv[1:] or None)
+    failed = [org_id for org_id, versions in results.items() if versions is None]
+    print(f"{len(results) - len(failed)} tenant(s) at version {latest}, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+from datetime import date
+
+from Sales import create_invoice, generate_receipt, create_payment
+
+# Renders invoices, receipts and payments in-process and prints documents/sec
+# Usage: python pdf-benchmark.py  (set PDF_BENCH_SECONDS to change the time per case)
+
+BENCH_SECONDS = float(os.getenv('PDF_BENCH_SECONDS', 3))
+LINE_COUNTS = [1, 10, 100]
+
+
+def invoice_data(lines):
+    return {
+        'customer_name': 'Benchmark Client',
+        'invoice_number': 'TKB/10001/24',
+        'invoice_date': date(2024, 10, 1),
+        'items': [{'description': f'Item {i}', 'quantity': 2, 'unit_price': 150.0, 'total': 300.0}
+                  for i in range(lines)],
+        'total_amount': 300.0 * lines,
+        'notes': 'Payment due within 30 days',
+        'payment_status': 'Unpaid'
+    }
+
+
+def receipt_data(lines):
+    return {
+        'receipt_id': 1,
+        'invoice_no': 'TKB/10001/24',
+        'customer_name': 'Benchmark Client',
+        'invoice_date': '2024-10-01',
+        'amount_paid': 300.0 * lines,
+        'new_bal': 0.0,
+        'payment_date': date(2024, 10, 2),
+        'receipt_invoice_number': 'RCT-1',
+        'category': 'Sales',
+        'account_owner': 'Benchmark',
+        'items': [{'product': f'Item {i}', 'quantity': 2, 'unit_price': 150.0, 'total': 300.0}
+                  for i in range(lines)]
+    }
+
+
+def payment_data(lines):
+    return {
+        'payment_date': date(2024, 10, 2),
+        'invoice_number': 'PAY-1',
+        'account_name': 'Benchmark Account',
+        'items': [{'description': f'Provider {i}', 'quantity': 'Account', 'unit-price': '0001', 'total': 300.0}
+                  for i in range(lines)],
+        'total_amount': 300.0 * lines,
+        'balance': 0.0
+    }
+
+
+def documents_per_second(render_func, data, filepath):
+    render_func(data, filepath)  # warm-up
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < BENCH_SECONDS:
+        render_func(data, filepath)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    cases = [
+        ('invoice', create_invoice, invoice_data),
+        ('receipt', generate_receipt, receipt_data),
+        ('payment', create_payment, payment_data),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'benchmark.pdf')
+        print(f"{'document':<10}{'lines':>6}{'docs/sec':>12}")
+        for name, render_func, build_data in cases:
+            for lines in LINE_COUNTS:
+                rate = documents_per_second(render_func, build_data(lines), filepath)
+                print(f"{name:<10}{lines:>6}{rate:>12.1f}")
@@ -167,11 +167,7 @@ function loadAllCustomers() {
                 tbody.empty();
 
                 if (data.status === "success" && data.invoices && data.invoices.length > 0) {
-                    let totalBalance = 0;
-
                     data.invoices.forEach(function(invoice) {
-                        totalBalance += parseFloat(invoice.balance || 0);
-
                         // Format invoice date properly
                         const invoiceDate = new Date(invoice.invoice_date);
                         const formattedInvoiceDate = isNaN(invoiceDate.getTime()) ?
@@ -205,7 +201,7 @@ function loadAllCustomers() {
                         tbody.append(row);
                     });
 
-                    $('#totalBalance').text(`Ksh ${totalBalance.toFixed(2)}`);
+                    $('#totalBalance').text(`Ksh ${parseFloat(data.outstanding || 0).toFixed(2)}`);
                 } else {
                     tbody.append(`
                         <tr>